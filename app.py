@@ -1,36 +1,71 @@
 import os
 import secrets
-import base64
 import io
-import html
 from datetime import datetime, timedelta, timezone
 from functools import wraps
 
-import requests
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_file
+from flask import Flask, render_template, request, redirect, url_for, session, flash, send_file, jsonify
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from token_store import init_db, save_tokens
+from token_store import init_db, save_tokens, list_realms, enqueue_cache_events, get_default_realm_id
 from qbo_client import (
     get_valid_access_token,
-    get_customers,
-    get_accounts,
-    get_profit_and_loss_detail,
-    get_vat_tax_detail,
-    parse_report_to_table,
+    exchange_authorization_code,
+    get_company_name,
+    stream_profit_and_loss_detail,
+    stream_vat_tax_detail,
     get_vendors,
     get_vendor_detail,
     extract_vendor_otro,
+    get_transfer_stats,
+    json_loads,
 )
+from entity_sync import refresh_vendor_cache, get_synced_customers, get_synced_accounts, ensure_synced
+from cache_invalidation import verify_signature, parse_webhook_payload, subscribe, start_listener
+from caching import SWRCache
+from report_snapshots import create_snapshot, load_snapshot
+from qbo_transactions import get_profit_and_loss_detail_from_transactions
+from report_stream import ReportRowStream
+from report_table import ReportTable
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "dev-secret-change-me")
 
+# Verifier token del webhook (Intuit Developer -> Webhooks)
+QBO_WEBHOOK_VERIFIER_TOKEN = os.environ.get("QBO_WEBHOOK_VERIFIER_TOKEN", "")
+
+# Listas de clientes / cuentas del formulario, por realm (stale-while-revalidate)
+REPORT_LISTS_CACHE_TTL_SECONDS = int(os.environ.get("REPORT_LISTS_CACHE_TTL_SECONDS", "300"))
+REPORT_LISTS_CACHE_MAX_STALE_SECONDS = int(os.environ.get("REPORT_LISTS_CACHE_MAX_STALE_SECONDS", "86400"))
+REPORT_LISTS_CACHE_MAX_REALMS = int(os.environ.get("REPORT_LISTS_CACHE_MAX_REALMS", "50"))
+
+report_lists_cache = SWRCache(
+    "report_lists",
+    ttl_seconds=REPORT_LISTS_CACHE_TTL_SECONDS,
+    max_entries=REPORT_LISTS_CACHE_MAX_REALMS,
+    max_stale_seconds=REPORT_LISTS_CACHE_MAX_STALE_SECONDS,
+)
+
+
+def _invalidate_report_lists(events: list[dict]):
+    # Webhook de Customer / Account -> fuera del cache de ese realm
+    for realm_id in {e["realm_id"] for e in events}:
+        report_lists_cache.invalidate(realm_id)
+
+
+subscribe(("Customer", "Account"), _invalidate_report_lists)
+
 try:
     init_db()
+    start_listener()
 except Exception as e:
     print("DB init skipped:", e)
 
+# Si no hay proceso "worker" aparte, el refresher puede correr como thread de la app
+if os.environ.get("QBO_REFRESHER_IN_PROCESS", "").strip() == "1":
+    from token_refresher import start_background_refresher
+    start_background_refresher()
+
 def load_users_from_env():
     """
     APP_USERS:
@@ -64,6 +99,25 @@ REPORT_TYPES = [
     {"id": "vat_tax_detail", "name": "VAT - Detalle de Impuestos", "qbo": "TaxDetail"},
 ]
 
+# Columnas que lee cada INFORME 43: si una descarga tiene que volver a traer el reporte, sólo esas.
+# Las personalizadas (vendor id, RUC) no tienen ColKey fijo: se buscan por título y su ColKey se
+# toma del reporte generado (meta["informe43_columns"], ver informe43_columns)
+INFORME43_VENDOR_ID_TITLES = ("vendor id", "proveedor id", "vendorid", "id proveedor")
+INFORME43_RUC_CLIENTE_TITLES = ("ruc no. de cliente", "ruc cliente")
+INFORME43_RUC_PROVEEDOR_TITLES = ("ruc no. de proveedor", "ruc proveedor")
+INFORME43_COLUMNS = {
+    "profit_and_loss_detail": (("tx_date", "doc_num", "name", "subt_nat_amount", "split_acc"),
+                               (INFORME43_VENDOR_ID_TITLES,)),
+    "vat_tax_detail": (("tx_date", "doc_num", "name", "taxable_amount", "tax_amount", "tax_name"),
+                       (INFORME43_RUC_CLIENTE_TITLES, INFORME43_RUC_PROVEEDOR_TITLES, INFORME43_VENDOR_ID_TITLES)),
+}
+
+# Fuente del Detalle de P&L: Reports API o transacciones (periodos grandes)
+REPORT_SOURCES = [
+    {"id": "report", "name": "Reporte de QuickBooks"},
+    {"id": "transactions", "name": "Transacciones: sólo gastos (periodos grandes)"},
+]
+
 
 def login_required(f):
     @wraps(f)
@@ -79,38 +133,117 @@ def parse_date(date_str: str) -> str:
     return date_str
 
 
-def fetch_qbo_report(report_type: str, start_date: str, end_date: str, client_id: str, excluded_accounts: list[str]):
-    access_token, realm_id = get_valid_access_token()
+def current_realm_id() -> str | None:
+    """
+    Empresa (realm_id) activa: la que venga en el request o la guardada en sesión.
+    """
+    return (request.values.get("realm_id") or "").strip() or session.get("realm_id")
+
+
+def fetch_qbo_report(report_type: str, start_date: str, end_date: str, client_id: str, excluded_accounts: list[str],
+                     realm_id: str | None = None, use_cache: bool = True, source: str = "report", columns=None,
+                     stream_rows: bool = False):
+    """
+    {"meta", "table"}. La tabla sale de report_stream (se parsea mientras baja el body).
+    stream_rows=True: table["rows"] es el stream (una sola pasada, para exportar mientras
+    descarga); si no, un ReportTable (tabla compacta por columnas).
+    """
+    access_token, realm_id = get_valid_access_token(realm_id)
 
     if report_type == "profit_and_loss_detail":
-        report_json = get_profit_and_loss_detail(
-            access_token=access_token,
-            realm_id=realm_id,
-            start_date=start_date,
-            end_date=end_date,
-            accounting_method="Accrual",
-            customer_id=None if client_id == "all" else client_id
-        )
-        table = parse_report_to_table(report_json)
+        if source == "transactions":
+            rows = ReportRowStream.from_report_json(get_profit_and_loss_detail_from_transactions(
+                access_token, realm_id, start_date, end_date,
+                customer_id=None if client_id == "all" else client_id,
+            ))
+        else:
+            source = "report"
+            rows = stream_profit_and_loss_detail(
+                access_token=access_token,
+                realm_id=realm_id,
+                start_date=start_date,
+                end_date=end_date,
+                accounting_method="Accrual",
+                customer_id=None if client_id == "all" else client_id,
+                use_cache=use_cache,
+                columns=columns,
+            )
 
-        return {"meta": {"report_type": report_type, "qbo_report_name": "ProfitAndLossDetail",
+        return {"meta": {"report_type": report_type, "qbo_report_name": "ProfitAndLossDetail", "realm_id": realm_id,
                          "start_date": start_date, "end_date": end_date, "client_id": client_id,
-                         "accounting_method": "Accrual",
+                         "accounting_method": "Accrual", "source": source,
                          "excluded_accounts": excluded_accounts},
-                "table": table, "raw": report_json}
+                "table": _report_table(rows, stream_rows)}
 
     if report_type == "vat_tax_detail":
-        report_json = get_vat_tax_detail(access_token, realm_id, start_date, end_date)
-        table = parse_report_to_table(report_json)
+        rows = stream_vat_tax_detail(access_token, realm_id, start_date, end_date, use_cache=use_cache,
+                                     columns=columns)
 
-        return {"meta": {"report_type": report_type, "qbo_report_name": "TaxDetail",
+        return {"meta": {"report_type": report_type, "qbo_report_name": "TaxDetail", "realm_id": realm_id,
                          "start_date": start_date, "end_date": end_date, "client_id": client_id,
                          "excluded_accounts": excluded_accounts},
-                "table": table, "raw": report_json}
+                "table": _report_table(rows, stream_rows)}
 
     raise RuntimeError(f"Tipo de reporte inválido: {report_type}")
 
 
+def _report_table(rows: ReportRowStream, stream_rows: bool):
+    if not stream_rows:
+        return ReportTable.from_stream(rows)
+    return {"columns": rows.read_columns(), "col_types": rows.col_types, "col_keys": rows.col_keys, "rows": rows}
+
+
+def informe43_columns(report_type: str, table) -> list[str] | None:
+    """
+    ColKeys que lee el INFORME 43 de `report_type`: las estándar + las de las columnas
+    personalizadas (vendor id / RUC) que trae `table`, buscadas por título igual que el builder.
+    None (columnas por defecto) si alguna de esas columnas no trae ColKey.
+    """
+    keys, custom_titles = INFORME43_COLUMNS.get(report_type) or ((), ())
+    if not keys:
+        return None
+
+    out = list(keys)
+    col_keys = table.get("col_keys") or []
+    for i, c in enumerate(table.get("columns") or []):
+        c = (c or "").strip().lower()
+        if not any(k in c for titles in custom_titles for k in titles):
+            continue
+        key = col_keys[i] if i < len(col_keys) else ""
+        if not key:
+            return None
+        if key not in out:
+            out.append(key)
+    return out
+
+
+def load_report_for_download(report_type: str | None = None, informe43: bool = False, stream_rows: bool = False):
+    """
+    (meta, table) para las descargas:
+      1) snapshot (?snapshot=ID o el del último reporte generado): sin QBO ni parseo
+      2) si venció o no hay Postgres: se vuelve a traer con los parámetros de last_report_meta
+         (informe43=True: sólo las columnas del INFORME 43, meta["informe43_columns"]; con
+         stream_rows=True las filas se leen una sola vez mientras llegan)
+    (None, None) si no hay reporte generado; (meta, None) si no es del report_type pedido.
+    """
+    last_meta = session.get("last_report_meta") or {}
+    snapshot = load_snapshot(request.args.get("snapshot") or last_meta.get("snapshot_id"))
+    if snapshot and report_type in (None, snapshot["meta"].get("report_type")):
+        return snapshot["meta"], snapshot["table"]
+
+    if not last_meta:
+        return None, None
+    if report_type and last_meta.get("report_type") != report_type:
+        return last_meta, None
+
+    data = fetch_qbo_report(last_meta["report_type"], last_meta["start_date"], last_meta["end_date"],
+                            last_meta.get("client_id") or "all", last_meta.get("excluded_accounts") or [],
+                            last_meta.get("realm_id"), source=last_meta.get("source") or "report",
+                            columns=last_meta.get("informe43_columns") if informe43 else None,
+                            stream_rows=stream_rows)
+    return last_meta, data["table"]
+
+
 @app.get("/")
 def home():
     return redirect(url_for("reports")) if session.get("logged_in") else redirect(url_for("login"))
@@ -146,6 +279,38 @@ def logout_beacon():
     return ("", 204)
 
 
+@app.get("/stats/qbo")
+@login_required
+def qbo_stats():
+    # Bytes transferidos (gzip) vs. body y tiempo de decode de las últimas llamadas a QBO
+    return jsonify(get_transfer_stats())
+
+
+
+@app.post("/webhooks/qbo")
+def qbo_webhook():
+    # Intuit exige respuesta rápida: sólo se verifica, se encola y se responde
+    body = request.get_data()
+    if not verify_signature(body, request.headers.get("intuit-signature", ""), QBO_WEBHOOK_VERIFIER_TOKEN):
+        print("WEBHOOK REJECTED -> firma inválida")
+        return ("", 401)
+
+    try:
+        events = parse_webhook_payload(json_loads(body))
+    except ValueError as e:
+        print("WEBHOOK BAD PAYLOAD ->", repr(e))
+        return ("", 400)
+
+    try:
+        enqueue_cache_events(events)
+    except Exception as e:
+        # != 2xx: Intuit reintenta la notificación
+        print("WEBHOOK ERROR ->", repr(e))
+        return ("", 500)
+
+    print("WEBHOOK ->", len(events), "eventos")
+    return ("", 200)
+
 
 @app.get("/connect")
 def connect():
@@ -189,51 +354,86 @@ def callback():
     if not code or not realm_id:
         return "Faltan parámetros code o realmId.", 400
 
-    client_id = os.environ.get("QBO_CLIENT_ID", "")
-    client_secret = os.environ.get("QBO_CLIENT_SECRET", "")
     redirect_uri = os.environ.get("QBO_REDIRECT_URI", "")
-    if not client_id or not client_secret or not redirect_uri:
+    if not os.environ.get("QBO_CLIENT_ID") or not os.environ.get("QBO_CLIENT_SECRET") or not redirect_uri:
         return "Faltan env vars QBO_CLIENT_ID/SECRET/REDIRECT_URI", 500
 
-    token_url = "https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer"
-    basic = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
-
-    headers = {
-        "Authorization": f"Basic {basic}",
-        "Accept": "application/json",
-        "Content-Type": "application/x-www-form-urlencoded",
-    }
-    data = {"grant_type": "authorization_code", "code": code, "redirect_uri": redirect_uri}
-
-    r = requests.post(token_url, headers=headers, data=data, timeout=30)
-    if r.status_code >= 400:
-        return f"Token exchange failed ({r.status_code}): {r.text}", 400
+    try:
+        payload = exchange_authorization_code(code, redirect_uri)
+    except Exception as e:
+        return str(e), 400
 
-    payload = r.json()
     access_token = payload.get("access_token")
     refresh_token = payload.get("refresh_token")
     expires_in = int(payload.get("expires_in", 3600))
 
     expires_at = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
-    save_tokens(realm_id=realm_id, access_token=access_token, refresh_token=refresh_token, access_expires_at=expires_at)
 
+    try:
+        company_name = get_company_name(access_token, realm_id)
+    except Exception as e:
+        print("COMPANY INFO ERROR ->", repr(e))
+        company_name = None
+
+    save_tokens(realm_id=realm_id, access_token=access_token, refresh_token=refresh_token,
+                access_expires_at=expires_at, company_name=company_name)
+
+    # ✅ La empresa recién conectada queda como activa en esta sesión
+    session["realm_id"] = realm_id
     session.pop("oauth_state", None)
     flash("QuickBooks conectado ✅")
     return redirect(session.pop("after_auth", url_for("reports")))
 
 
+def load_report_lists(realm_id: str | None, force: bool = False) -> dict:
+    """
+    Clientes y cuentas del formulario (cache sincronizado vía CDC; force = delta de QBO ya).
+    """
+    access_token, realm_id = get_valid_access_token(realm_id)
+    if force:
+        ensure_synced(access_token, realm_id, ("Customer", "Account"), force=True)
+    return {
+        "realm_id": realm_id,
+        "customers": get_synced_customers(access_token, realm_id),
+        "accounts": get_synced_accounts(access_token, realm_id),
+    }
+
+
 @app.get("/reports")
 @login_required
 def reports():
+    realms = []
+    realm_id = current_realm_id()
+    force = request.args.get("refresh") == "1"
     try:
-        access_token, realm_id = get_valid_access_token()
-        clients = [{"id": "all", "name": "Todos los clientes"}] + get_customers(access_token, realm_id)
-        accounts = get_accounts(access_token, realm_id)
-        return render_template("reports.html", clients=clients, accounts=accounts, report_types=REPORT_TYPES)
+        realms = list_realms()
+        realm_id = realm_id or get_default_realm_id()
+        lists = report_lists_cache.get(realm_id, lambda: load_report_lists(realm_id, force), force=force)
+        realm_id = lists["realm_id"]
+        session["realm_id"] = realm_id
+        clients = [{"id": "all", "name": "Todos los clientes"}] + lists["customers"]
+        accounts = lists["accounts"]
+        return render_template("reports.html", clients=clients, accounts=accounts, report_types=REPORT_TYPES, report_sources=REPORT_SOURCES,
+                               realms=realms, current_realm=realm_id)
     except Exception as e:
         print("REPORTS ERROR ->", repr(e))
         flash(f"QuickBooks no conectado o error: {e}. Ve a /connect.")
-        return render_template("reports.html", clients=[{"id": "all", "name": "Todos los clientes"}], accounts=[], report_types=REPORT_TYPES)
+        return render_template("reports.html", clients=[{"id": "all", "name": "Todos los clientes"}], accounts=[], report_types=REPORT_TYPES, report_sources=REPORT_SOURCES,
+                               realms=realms, current_realm=realm_id)
+
+
+@app.post("/vendors/refresh")
+@login_required
+def refresh_vendors():
+    # Recarga manual del cache de vendors (p.ej. después de editar "Otro" en QuickBooks)
+    try:
+        access_token, realm_id = get_valid_access_token(current_realm_id())
+        refresh_vendor_cache(access_token, realm_id)
+        flash("Directorio de proveedores actualizado ✅")
+    except Exception as e:
+        print("VENDOR REFRESH ERROR ->", repr(e))
+        flash(f"Error actualizando proveedores: {e}")
+    return redirect(url_for("reports"))
 
 
 @app.post("/run-report")
@@ -245,10 +445,19 @@ def run_report():
         end_date = parse_date(request.form.get("end_date", ""))
         client_id = request.form.get("client_id", "all")
         excluded_accounts = request.form.getlist("excluded_accounts")
+        source = request.form.get("source", "report")
+        realm_id = current_realm_id()
+
+        print("RUN REPORT -> realm:", realm_id, "report_type:", report_type, "start:", start_date, "end:", end_date, "client:", client_id)
 
-        print("RUN REPORT -> report_type:", report_type, "start:", start_date, "end:", end_date, "client:", client_id)
+        # "Generar" siempre trae datos frescos; las descargas de este mismo reporte usan el cache
+        data = fetch_qbo_report(report_type, start_date, end_date, client_id, excluded_accounts, realm_id,
+                                use_cache=False, source=source)
+        session["realm_id"] = data["meta"]["realm_id"]
+        data["meta"]["informe43_columns"] = informe43_columns(report_type, data["table"])
 
-        data = fetch_qbo_report(report_type, start_date, end_date, client_id, excluded_accounts)
+        # Snapshot de la tabla parseada: las descargas salen de aquí (sin volver a QBO)
+        data["meta"]["snapshot_id"] = create_snapshot(data["meta"], data["table"])
 
         # Guardar meta para download
         session["last_report_meta"] = data["meta"]
@@ -261,36 +470,36 @@ def run_report():
         return redirect(url_for("reports"))
 
 
+@app.get("/results")
+@login_required
+def results():
+    # Volver a la vista previa de un reporte ya generado (?snapshot=ID)
+    snapshot = load_snapshot(request.args.get("snapshot", ""))
+    if not snapshot:
+        flash("El reporte ya no está disponible. Genera uno nuevo.")
+        return redirect(url_for("reports"))
+
+    snapshot["meta"]["snapshot_id"] = request.args.get("snapshot")
+    return render_template("results.html", data=snapshot)
+
+
 @app.get("/download/qbo/report.xlsx")
 @login_required
 def download_qbo_report_xlsx():
-    meta = session.get("last_report_meta")
+    # 🔹 Reporte tal cual la vista previa (snapshot; si venció, se vuelve a traer de QuickBooks
+    #    y las filas se escriben al Excel a medida que llegan)
+    meta, table = load_report_for_download(stream_rows=True)
     if not meta:
         flash("No hay parámetros del reporte. Genera uno primero.")
         return redirect(url_for("reports"))
 
-    access_token, realm_id = get_valid_access_token()
-
-    # 🔹 Re-descargar el reporte original de QuickBooks (preview completo)
     if meta["report_type"] == "profit_and_loss_detail":
-        report_json = get_profit_and_loss_detail(
-            access_token=access_token,
-            realm_id=realm_id,
-            start_date=meta["start_date"],
-            end_date=meta["end_date"],
-            accounting_method="Accrual",
-            customer_id=None if meta.get("client_id") in (None, "", "all") else meta["client_id"],
-        )
         sheet_title = "Profit & Loss Detail"
+        if meta.get("source") == "transactions":
+            sheet_title = "P&L Detail (sólo gastos)"
         filename = f"QBO_ProfitAndLossDetail_{meta['start_date']}_{meta['end_date']}.xlsx"
 
     elif meta["report_type"] == "vat_tax_detail":
-        report_json = get_vat_tax_detail(
-            access_token=access_token,
-            realm_id=realm_id,
-            start_date=meta["start_date"],
-            end_date=meta["end_date"],
-        )
         sheet_title = "VAT Tax Detail"
         filename = f"QBO_TaxDetail_{meta['start_date']}_{meta['end_date']}.xlsx"
 
@@ -298,30 +507,32 @@ def download_qbo_report_xlsx():
         flash("Tipo de reporte no soportado.")
         return redirect(url_for("reports"))
 
-    table = parse_report_to_table(report_json)
-
     # --- Crear Excel genérico (tal cual QuickBooks) ---
+    # write_only: las filas van directo al archivo, sin armar la hoja en memoria
     from openpyxl import Workbook
-    from openpyxl.styles import Font, Alignment
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
     from openpyxl.utils import get_column_letter
     import io
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = sheet_title
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_title)
+
+    for i in range(1, len(table["columns"]) + 1):
+        ws.column_dimensions[get_column_letter(i)].width = 22
 
     # headers
-    ws.append(table["columns"])
-    for c in range(1, len(table["columns"]) + 1):
-        ws.cell(row=1, column=c).font = Font(bold=True)
+    header = []
+    for title in table["columns"]:
+        c = WriteOnlyCell(ws, value=title)
+        c.font = Font(bold=True)
+        header.append(c)
+    ws.append(header)
 
     # rows
     for r in table["rows"]:
         ws.append(r["cells"])
 
-    for i in range(1, ws.max_column + 1):
-        ws.column_dimensions[get_column_letter(i)].width = 22
-
     stream = io.BytesIO()
     wb.save(stream)
     stream.seek(0)
@@ -336,7 +547,8 @@ def download_qbo_report_xlsx():
 @app.get("/download/informe43.xlsx")
 @login_required
 def download_informe43_xlsx():
-    meta = session.get("last_report_meta")
+    # Tabla del snapshot (la misma de la vista previa); si venció, se vuelve a traer
+    meta, table = load_report_for_download("profit_and_loss_detail", informe43=True)
     if not meta:
         flash("No hay parámetros del reporte. Genera uno primero.")
         return redirect(url_for("reports"))
@@ -346,29 +558,18 @@ def download_informe43_xlsx():
         flash("El INFORME 43 se genera desde Detalle de Pérdidas y Ganancias.")
         return redirect(url_for("reports"))
 
-    access_token, realm_id = get_valid_access_token()
-
-    report_json = get_profit_and_loss_detail(
-        access_token=access_token,
-        realm_id=realm_id,
-        start_date=meta["start_date"],
-        end_date=meta["end_date"],
-        accounting_method="Accrual",
-        customer_id=None if meta.get("client_id") in (None, "", "all") else meta["client_id"],
-    )
-
-    table = parse_report_to_table(report_json)
+    access_token, realm_id = get_valid_access_token(meta.get("realm_id"))
 
     # -------------------------
     # Helpers
     # -------------------------
     import re, io
-    from datetime import datetime
     from openpyxl import Workbook
     from openpyxl.styles import Font, Alignment, PatternFill
     from openpyxl.utils import get_column_letter
 
     cols = [(c or "").strip().lower() for c in (table.get("columns") or [])]
+    col_keys = table.get("col_keys") or []
 
     def find_col_contains(*keys):
         keys = [k.lower() for k in keys]
@@ -378,6 +579,12 @@ def download_informe43_xlsx():
                     return i
         return None
 
+    def find_col(col_key, *keys):
+        # ColKey de QBO primero (determinístico); títulos sólo si el reporte no lo trae
+        if col_key in col_keys:
+            return col_keys.index(col_key)
+        return find_col_contains(*keys)
+
     def cell(row, idx):
         if idx is None:
             return ""
@@ -386,44 +593,7 @@ def download_informe43_xlsx():
             return ""
         return (cells[idx] or "").strip()
 
-    def to_float(x):
-        s = (x or "").strip()
-        if not s:
-            return 0.0
-
-        # soporta unicode minus, paréntesis, y trailing minus
-        s = s.replace("−", "-")  # unicode minus
-        neg = False
-
-        if s.startswith("(") and s.endswith(")"):
-            neg = True
-            s = s[1:-1].strip()
-
-        if s.endswith("-"):
-            neg = True
-            s = s[:-1].strip()
-
-        s = s.replace(",", "")
-
-        try:
-            val = float(s)
-            return -val if neg else val
-        except:
-            return 0.0
-
-
-    def to_yyyymmdd(s):
-        s = (s or "").strip()
-        if not s:
-            return ""
-        for f in ("%Y-%m-%d", "%m/%d/%Y", "%d/%m/%Y"):
-            try:
-                return datetime.strptime(s, f).strftime("%Y%m%d")
-            except:
-                pass
-        if len(s) == 8 and s.isdigit():
-            return s
-        return ""
+    # Montos y fechas: ya decodificados en la tabla (row.amount / row.yyyymmdd, por col_types)
 
     def is_panama_cedula(ruc: str) -> bool:
         s = (ruc or "").strip().upper()
@@ -473,25 +643,6 @@ def download_informe43_xlsx():
         return ("", "", "", raw.replace("/", " ").strip())
     
 
-    def norm_key(s: str) -> str:
-        s = html.unescape((s or "").strip())
-        s = re.sub(r"\s+", " ", s)
-        return s.lower().strip()
-
-    def extract_ruc_dv_from_display(display_name: str):
-        """
-        From vendor DisplayName like:
-        "ABOLU, S.A/2/16429-109-156121/61"
-        returns ("16429-109-156121", "61")
-        """
-        dn = html.unescape((display_name or "").strip())
-        m = re.match(r"^(.+?)/([123])/([^/]+)/([^/]+)\s*$", dn)
-        if not m:
-            return ("", "")
-        ruc = (m.group(3) or "").strip()
-        dv  = (m.group(4) or "").strip()
-        return (ruc, dv)
-
     def parse_otros(notes_raw: str):
         """
         NOTES puede venir como:
@@ -513,83 +664,45 @@ def download_informe43_xlsx():
     # -------------------------
     # Column mapping (P&L Detail)
     # -------------------------
-    idx_fecha   = find_col_contains("fecha", "date")
-    idx_no      = find_col_contains("n.", "no", "nº", "numero", "number")
-    idx_nombre  = find_col_contains("nombre", "name")
-    idx_importe = find_col_contains("importe", "amount")
-    idx_vendor_id = find_col_contains("vendor id", "proveedor id", "vendorid", "id proveedor")
+    idx_fecha   = find_col("tx_date", "fecha", "date")
+    idx_no      = find_col("doc_num", "n.", "no", "nº", "numero", "number")
+    idx_nombre  = find_col("name", "nombre", "name")
+    idx_importe = find_col("subt_nat_amount", "importe", "amount")
+    idx_vendor_id = find_col_contains(*INFORME43_VENDOR_ID_TITLES)
     # ✅ Cuenta contable viene como "Dividir" en tu P&L Detail
-    idx_cuenta_contable = find_col_contains("dividir", "split")
+    idx_cuenta_contable = find_col("split_acc", "dividir", "split")
 
     # -------------------------
-    # 1) Sacar lista de vendors del reporte (NOMBRE limpio)
+    # 1) Sacar lista de vendors del reporte (nombre completo, NOMBRE limpio y RUC|DV)
     # -------------------------
     vendor_names_needed = set()
-    
+    vendor_rucdvs_needed = set()
+
     for r in (table.get("rows") or []):
         if r.get("is_header") or r.get("is_summary"):
             continue
         nombre_raw = cell(r, idx_nombre)
         if not nombre_raw:
             continue
-        _, _, _, nombre_limpio = parse_vendor(nombre_raw)
+        _, ruc_from_name, dv, nombre_limpio = parse_vendor(nombre_raw)
+        vendor_names_needed.add(nombre_raw)
         if nombre_limpio:
-            vendor_names_needed.add(nombre_limpio.strip().lower())
+            vendor_names_needed.add(nombre_limpio)
+        if ruc_from_name and dv:
+            vendor_rucdvs_needed.add((ruc_from_name, dv))
 
     # -------------------------
-    # 2) Construir mapa DisplayName->Id y luego Id->Other usando Batch
+    # 2) Directorio de vendors (cache en Postgres; sólo los vendors del reporte)
     # -------------------------
-    from qbo_client import get_all_vendors_map, get_vendor_notes_by_ids
-
- 
-    vendors_map = get_all_vendors_map(access_token, realm_id) or {}
-    # vendors_map esperado: {display_lower: id}
-
-    # ✅ índice por RUC|DV (lo más confiable)
-    rucdv_to_id = {}
-    # ✅ índice por display exacto (por si el reporte trae el nombre completo)
-    display_to_id = { norm_key(k): str(v) for k, v in vendors_map.items() }
-
-    for disp_key, vid in display_to_id.items():
-        ruc, dv = extract_ruc_dv_from_display(disp_key)
-        if ruc and dv:
-            rucdv_to_id[f"{ruc}|{dv}"] = str(vid)
-
-
-    # ✅ ahora decidimos qué IDs buscar (de los vendors del reporte)
-    ids_to_fetch = set()
-
-    for r in (table.get("rows") or []):
-        if r.get("is_header") or r.get("is_summary"):
-            continue
-
-        nombre_raw = cell(r, idx_nombre)
-        if not nombre_raw:
-            continue
-
-        tipo_from_name, ruc_from_name, dv, nombre = parse_vendor(nombre_raw)
-
-        # 1) intentar por RUC|DV
-        vid = rucdv_to_id.get(f"{ruc_from_name}|{dv}")
-
-        # 2) si no, intentar por display exacto (si el raw venía completo)
-        if not vid:
-            vid = display_to_id.get(norm_key(nombre_raw))
-
-        # 3) si no, intentar por nombre limpio (último fallback)
-        if not vid:
-            vid = display_to_id.get(norm_key(nombre))
-
-        if vid:
-            ids_to_fetch.add(str(vid))
-
-    ids_to_fetch = list(ids_to_fetch)
-
-    # ✅ traer Notes por IDs
-    vendor_notes_by_id = get_vendor_notes_by_ids(access_token, realm_id, ids_to_fetch) or {}
-   
-
-
+    from entity_sync import get_cached_vendor_directory
+    from qbo_client import find_vendor_in_directory
+
+    vendor_directory = get_cached_vendor_directory(
+        access_token, realm_id,
+        names=vendor_names_needed,
+        rucdvs=vendor_rucdvs_needed,
+        force_refresh=request.args.get("refresh_vendors") == "1",
+    )
 
     # -------------------------
     # 3) Construir filas INFORME 43
@@ -615,19 +728,17 @@ def download_informe43_xlsx():
         seq += 1
 
         # Montos
-        monto_balboas = to_float(cell(r, idx_importe))
+        monto_balboas = r.amount(idx_importe)
         itbms_pagado = 0.00  # ✅ autocompletar ITBMS con cero en P&L
 
         # Cuenta contable
         cuenta_contable = cell(r, idx_cuenta_contable)
 
-        # ✅ Vendor Notes -> Concepto/Compras
-        vid = rucdv_to_id.get(f"{ruc_from_name}|{dv}")
-
-        if not vid:
-            vid = display_to_id.get(norm_key(nombre_raw)) or display_to_id.get(norm_key(nombre))
+        # ✅ Vendor Otro (fallback Notes) -> Concepto/Compras
+        vendor = find_vendor_in_directory(vendor_directory, nombre_raw, nombre, ruc_from_name, dv)
+        vid = vendor["id"] if vendor else None
 
-        notes_raw = vendor_notes_by_id.get(str(vid), "") if vid else ""
+        notes_raw = (vendor["other"] or vendor["notes"]) if vendor else ""
         concepto, compras = parse_otros(notes_raw)
 
 
@@ -647,7 +758,7 @@ def download_informe43_xlsx():
             dv,                          # DV
             nombre,                      # NOMBRE O RAZON SOCIAL
             factura,                     # FACTURA
-            to_yyyymmdd(cell(r, idx_fecha)),  # FECHA
+            r.yyyymmdd(idx_fecha),       # FECHA
             concepto,                    # CONCEPTO (Vendor->Otro: antes del /)
             compras,                     # COMPRAS (Vendor->Otro: después del /)
             monto_balboas,               # MONTO EN BALBOAS
@@ -725,7 +836,8 @@ def download_informe43_xlsx():
 @app.get("/download/informe43_vat.xlsx")
 @login_required
 def download_informe43_vat_xlsx():
-    meta = session.get("last_report_meta")
+    # Tabla del snapshot (la misma de la vista previa); si venció, se vuelve a traer
+    meta, table = load_report_for_download("vat_tax_detail", informe43=True)
     if not meta:
         flash("No hay parámetros del reporte. Genera uno primero.")
         return redirect(url_for("reports"))
@@ -734,22 +846,12 @@ def download_informe43_vat_xlsx():
         flash("Para este INFORME 43 (VAT) primero genera el reporte: VAT - Detalle de Impuestos.")
         return redirect(url_for("reports"))
 
-    access_token, realm_id = get_valid_access_token()
-
-    report_json = get_vat_tax_detail(
-        access_token=access_token,
-        realm_id=realm_id,
-        start_date=meta["start_date"],
-        end_date=meta["end_date"],
-    )
-
-    table = parse_report_to_table(report_json)
+    access_token, realm_id = get_valid_access_token(meta.get("realm_id"))
 
     # -------------------------
     # Helpers
     # -------------------------
     import re, io
-    from datetime import datetime
     from openpyxl import Workbook
     from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
     from openpyxl.utils import get_column_letter
@@ -772,22 +874,7 @@ def download_informe43_vat_xlsx():
             return ""
         return (cells[idx] or "").strip()
 
-    def to_float(x):
-        try:
-            return float(str(x).replace(",", "").strip())
-        except:
-            return 0.0
-
-    def to_yyyymmdd(s):
-        s = (s or "").strip()
-        if not s:
-            return ""
-        for f in ("%Y-%m-%d", "%m/%d/%Y", "%d/%m/%Y"):
-            try:
-                return datetime.strptime(s, f).strftime("%Y%m%d")
-            except:
-                pass
-        return ""
+    # Montos y fechas: ya decodificados en la tabla (row.amount / row.yyyymmdd, por col_types)
 
     def parse_vendor(name):
         """
@@ -826,6 +913,7 @@ def download_informe43_vat_xlsx():
     # MAP COLUMNAS VAT
     # -------------------------
     cols = [(c or "").strip().lower() for c in table.get("columns", [])]
+    col_keys = table.get("col_keys") or []
 
     def find_col_contains(*keywords):
         for k in keywords:
@@ -835,70 +923,66 @@ def download_informe43_vat_xlsx():
                     return i
         return None
 
-    idx_fecha = find_col_contains("fecha", "date")
-    idx_no = find_col_contains("n.", "no", "numero")
-    idx_ruc_cliente = find_col_contains("ruc no. de cliente", "ruc cliente")
-    idx_ruc_proveedor = find_col_contains("ruc no. de proveedor", "ruc proveedor")
-    idx_nombre = find_col_contains("nombre", "name")
+    def find_col(col_key, *keywords):
+        # ColKey de QBO primero (determinístico); títulos sólo si el reporte no lo trae
+        if col_key in col_keys:
+            return col_keys.index(col_key)
+        return find_col_contains(*keywords)
+
+    idx_fecha = find_col("tx_date", "fecha", "date")
+    idx_no = find_col("doc_num", "n.", "no", "numero")
+    idx_ruc_cliente = find_col_contains(*INFORME43_RUC_CLIENTE_TITLES)
+    idx_ruc_proveedor = find_col_contains(*INFORME43_RUC_PROVEEDOR_TITLES)
+    idx_nombre = find_col("name", "nombre", "name")
 
     # ✅ Base imponible = "Importe sujeto a impuestos"
-    idx_base = find_col_contains("importe sujeto a impuestos", "importe sujeto", "taxable")
+    idx_base = find_col("taxable_amount", "importe sujeto a impuestos", "importe sujeto", "taxable")
 
     # ✅ ITBMS = "Importe" (pero no el que dice sujeto)
-    idx_itbms = None
-    for i, c in enumerate(cols):
-        c2 = (c or "").strip().lower()
-        if (c2 == "importe" or c2.startswith("importe")) and ("sujeto" not in c2):
-            idx_itbms = i
-            break
+    idx_itbms = col_keys.index("tax_amount") if "tax_amount" in col_keys else None
+    if idx_itbms is None:
+        for i, c in enumerate(cols):
+            c2 = (c or "").strip().lower()
+            if (c2 == "importe" or c2.startswith("importe")) and ("sujeto" not in c2):
+                idx_itbms = i
+                break
 
     # ✅ Nombre del impuesto
-    idx_tax_name = find_col_contains("nombre del impuesto", "tax name", "impuesto")
-    idx_vendor_id = find_col_contains("vendor id", "vendorid", "proveedor id", "id proveedor")
-
-    from qbo_client import get_all_vendors_map, get_vendor_other_by_ids
-    def norm_key(s: str) -> str:
-        s = html.unescape((s or "").strip())
-        s = re.sub(r"\s+", " ", s)
-        return s.lower().strip()
-    vendors_map = get_all_vendors_map(access_token, realm_id) or {}
-    # vendors_map esperado: { display_lower : id }
+    idx_tax_name = find_col("tax_name", "nombre del impuesto", "tax name", "impuesto")
+    idx_vendor_id = find_col_contains(*INFORME43_VENDOR_ID_TITLES)
 
-    display_to_id = {norm_key(k): str(v) for k, v in vendors_map.items()}
-
-    ids_to_fetch = set()
+    from entity_sync import get_cached_vendor_directory
+    from qbo_client import find_vendor_in_directory, get_vendor_other_by_ids_batch
 
+    # Vendors que usa el reporte: VendorId directo o nombre (fallback)
+    vendor_ids_needed = set()
+    vendor_names_needed = set()
     for r in (table.get("rows") or []):
         if r.get("is_header") or r.get("is_summary"):
             continue
-
-        # 1) si VAT trae VendorId directo
         vid = cell(r, idx_vendor_id) if idx_vendor_id is not None else ""
         if vid:
-            ids_to_fetch.add(str(vid))
+            vendor_ids_needed.add(str(vid))
             continue
-
-        # 2) fallback: resolver por nombre (DisplayName)
         nombre_raw = (cell(r, idx_nombre) if idx_nombre is not None else "").strip()
-        if not nombre_raw:
-            continue
-
-        # intentamos con el raw completo, o con el nombre limpio
-        _, _, _, nombre_limpio = parse_vendor(nombre_raw)
-        vid = display_to_id.get(norm_key(nombre_raw)) or display_to_id.get(norm_key(nombre_limpio))
-        if vid:
-            ids_to_fetch.add(str(vid))
+        if nombre_raw:
+            vendor_names_needed.add(nombre_raw)
+            vendor_names_needed.add(parse_vendor(nombre_raw)[3])
+
+    # ✅ Directorio de vendors (cache en Postgres; sólo los vendors del reporte)
+    vendor_directory = get_cached_vendor_directory(
+        access_token, realm_id,
+        names=vendor_names_needed,
+        vendor_ids=vendor_ids_needed,
+        force_refresh=request.args.get("refresh_vendors") == "1",
+    )
+    vendor_other_by_id = {vid: rec["other"] for vid, rec in vendor_directory["by_id"].items()}
 
-    vendor_other_by_id = get_vendor_other_by_ids(access_token, realm_id, list(ids_to_fetch)) or {}
-    # -------------------------
-    # Helpers extra
-    # -------------------------
-    def to_float_safe(x):
-        try:
-            return float(str(x).replace(",", "").strip() or "0")
-        except:
-            return 0.0
+    # VendorId directo del VAT que no está en el directorio (p.ej. inactivo) -> Batch API
+    missing_ids = {vid for vid in vendor_ids_needed if vid not in vendor_other_by_id}
 
+    if missing_ids:
+        vendor_other_by_id.update(get_vendor_other_by_ids_batch(access_token, realm_id, list(missing_ids)) or {})
     def is_no_tax(base, itbms, tax_name):
         # "no tiene impuesto" = ITBMS 0 o sin nombre de impuesto
         if itbms == 0 and (not (tax_name or "").strip()):
@@ -1039,8 +1123,8 @@ def download_informe43_vat_xlsx():
 
         fecha_raw = (cell(r, idx_fecha) if idx_fecha is not None else "").strip()
 
-        # primero intenta tu convertidor
-        fecha_fmt = to_yyyymmdd(fecha_raw)
+        # primero la fecha decodificada de la tabla
+        fecha_fmt = r.yyyymmdd(idx_fecha)
 
         # si por alguna razón no pudo, limpia todo lo que no sea número
         if not fecha_fmt:
@@ -1049,8 +1133,8 @@ def download_informe43_vat_xlsx():
         # ✅ garantizar sin guiones (por si acaso)
         fecha_fmt = fecha_fmt.replace("-", "")
 
-        base = to_float_safe(cell(r, idx_base) if idx_base is not None else "")
-        itbms = to_float_safe(cell(r, idx_itbms) if idx_itbms is not None else "")
+        base = r.amount(idx_base)
+        itbms = r.amount(idx_itbms)
 
         tax_name = (cell(r, idx_tax_name) if idx_tax_name is not None else "").strip()
         tax_name_l = tax_name.lower()
@@ -1060,7 +1144,8 @@ def download_informe43_vat_xlsx():
 
         if not vid:
             # fallback por nombre -> id
-            vid = display_to_id.get(norm_key(nombre_raw)) or display_to_id.get(norm_key(nombre))
+            vendor = find_vendor_in_directory(vendor_directory, nombre_raw, nombre)
+            vid = vendor["id"] if vendor else ""
 
         other_raw = vendor_other_by_id.get(str(vid), "") if vid else ""
         concepto, compras = parse_concepto_compras(other_raw)
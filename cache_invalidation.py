@@ -0,0 +1,178 @@
+"""
+Invalidación de caches a partir de los webhooks de QuickBooks.
+
+Flujo:
+  1) POST /webhooks/qbo (app.py) verifica intuit-signature, guarda los eventos en Postgres
+     (qbo_cache_events) y marca "dirty" los caches sincronizados afectados. Responde 200 enseguida.
+  2) Cada proceso que tenga caches en memoria corre un listener (thread) que lee los eventos
+     nuevos de la tabla y llama a los callbacks registrados con subscribe().
+
+Evento = {"realm_id", "entity", "entity_id", "operation"}   (entity con el nombre de QBO: "Vendor", "Bill", ...)
+"""
+import os
+import hmac
+import base64
+import hashlib
+import threading
+
+from token_store import get_last_cache_event_id, get_cache_events_after
+
+CACHE_EVENTS_POLL_SECONDS = float(os.environ.get("CACHE_EVENTS_POLL_SECONDS", "2"))
+
+# Nombres de entidad tal como los usa la API (los CloudEvents traen "qbo.journalentry.updated.v1")
+_ENTITY_NAMES = {
+    n.lower(): n for n in (
+        "Vendor", "Customer", "Account", "Employee", "Item", "Class", "Department", "TaxCode",
+        "Bill", "BillPayment", "Purchase", "JournalEntry", "Invoice", "Payment", "SalesReceipt",
+        "CreditMemo", "RefundReceipt", "Deposit", "Transfer", "VendorCredit", "Estimate", "PurchaseOrder",
+    )
+}
+
+# Operación clásica <-> verbo de CloudEvents ("qbo.vendor.updated.v1")
+CLOUDEVENT_OPERATIONS = {
+    "Create": "created",
+    "Update": "updated",
+    "Delete": "deleted",
+    "Merge": "merged",
+    "Void": "voided",
+    "Emailed": "emailed",
+}
+_CLOUDEVENT_TO_OPERATION = {v: k for k, v in CLOUDEVENT_OPERATIONS.items()}
+
+_subscribers: list[tuple[frozenset | None, object]] = []
+_subscribers_lock = threading.Lock()
+
+_listener_started = False
+_listener_lock = threading.Lock()
+
+
+# -------------------------
+# ✅ Webhook: firma + payload
+# -------------------------
+def verify_signature(body: bytes, signature: str, verifier_token: str) -> bool:
+    """
+    intuit-signature = base64(HMAC-SHA256(verifier_token, body crudo)).
+    """
+    if not verifier_token or not signature:
+        return False
+    expected = base64.b64encode(hmac.new(verifier_token.encode("utf-8"), body, hashlib.sha256).digest()).decode()
+    return hmac.compare_digest(expected, signature.strip())
+
+
+def _entity_name(name: str) -> str:
+    name = (name or "").strip()
+    return _ENTITY_NAMES.get(name.lower(), name)
+
+
+def parse_webhook_payload(payload) -> list[dict]:
+    """
+    Acepta los dos formatos de webhook de Intuit:
+      - clásico:     {"eventNotifications": [{"realmId", "dataChangeEvent": {"entities": [{"name", "id", "operation"}]}}]}
+      - CloudEvents: [{"type": "qbo.vendor.updated.v1", "intuitaccountid", "intuitentityid", ...}]
+    Cualquier otra forma (null, {}, {"eventNotifications": {}}, listas de no-objetos, ...)
+    -> ValueError (el endpoint responde 400).
+    """
+    events = []
+
+    if isinstance(payload, list):
+        for ce in _list_of_dicts(payload, "CloudEvents"):
+            if not isinstance(ce.get("type") or "", str):
+                raise ValueError("webhook payload inválido: CloudEvent.type no es texto")
+            parts = (ce.get("type") or "").split(".")
+            if len(parts) < 3 or not ce.get("intuitaccountid"):
+                continue
+            events.append({
+                "realm_id": str(ce["intuitaccountid"]),
+                "entity": _entity_name(parts[1]),
+                "entity_id": str(ce.get("intuitentityid") or ""),
+                "operation": _CLOUDEVENT_TO_OPERATION.get(parts[2], parts[2]),
+            })
+        return events
+
+    if not isinstance(payload, dict) or "eventNotifications" not in payload:
+        raise ValueError("webhook payload inválido: se esperaba {\"eventNotifications\": [...]} o una lista de CloudEvents")
+
+    for n in _list_of_dicts(payload["eventNotifications"], "eventNotifications"):
+        realm_id = str(n.get("realmId") or "")
+        if not realm_id:
+            continue
+        change = n.get("dataChangeEvent", {})
+        if not isinstance(change, dict):
+            raise ValueError("webhook payload inválido: dataChangeEvent no es un objeto")
+        for ent in _list_of_dicts(change.get("entities", []), "dataChangeEvent.entities"):
+            if not isinstance(ent.get("name") or "", str):
+                raise ValueError("webhook payload inválido: entities[].name no es texto")
+            events.append({
+                "realm_id": realm_id,
+                "entity": _entity_name(ent.get("name")),
+                "entity_id": str(ent.get("id") or ""),
+                "operation": ent.get("operation") or "",
+            })
+    return events
+
+
+def _list_of_dicts(value, what: str) -> list[dict]:
+    if not isinstance(value, list) or not all(isinstance(x, dict) for x in value):
+        raise ValueError(f"webhook payload inválido: {what} debe ser una lista de objetos")
+    return value
+
+
+# -------------------------
+# ✅ Suscriptores (caches en memoria de este proceso)
+# -------------------------
+def subscribe(entities, callback):
+    """
+    callback(events) recibe, por lote, los eventos de `entities` (None = todas).
+    """
+    with _subscribers_lock:
+        _subscribers.append((frozenset(entities) if entities is not None else None, callback))
+
+
+def publish(events: list[dict]):
+    """
+    Entrega eventos a los suscriptores de este proceso (lo usa el listener; también sirve
+    para invalidar localmente sin pasar por Postgres).
+    """
+    with _subscribers_lock:
+        subscribers = list(_subscribers)
+
+    for entities, callback in subscribers:
+        batch = [e for e in events if entities is None or e["entity"] in entities]
+        if not batch:
+            continue
+        try:
+            callback(batch)
+        except Exception as e:
+            print("CACHE INVALIDATION ERROR ->", getattr(callback, "__name__", callback), repr(e))
+
+
+def _listen_forever(stop_event: threading.Event):
+    last_id = None
+    while not stop_event.is_set():
+        try:
+            if last_id is None:
+                # Sólo eventos nuevos: lo anterior ya está reflejado al arrancar (caches vacíos)
+                last_id = get_last_cache_event_id()
+            events = get_cache_events_after(last_id)
+            if events:
+                last_id = events[-1]["id"]
+                publish(events)
+                continue  # puede haber más de un lote pendiente
+        except Exception as e:
+            print("CACHE EVENTS LISTENER ERROR ->", repr(e))
+        stop_event.wait(CACHE_EVENTS_POLL_SECONDS)
+
+
+def start_listener(stop_event: threading.Event | None = None) -> bool:
+    """
+    Arranca el listener de qbo_cache_events como thread daemon (una vez por proceso).
+    """
+    global _listener_started
+    with _listener_lock:
+        if _listener_started:
+            return False
+        _listener_started = True
+
+    threading.Thread(target=_listen_forever, args=(stop_event or threading.Event(),),
+                     name="qbo-cache-events", daemon=True).start()
+    return True
@@ -0,0 +1,221 @@
+"""
+Cache en memoria (por proceso) con TTL, límite LRU y stale-while-revalidate.
+
+  - fresco (edad < ttl):              se devuelve tal cual
+  - vencido pero < max_stale:         se devuelve el valor viejo y se recarga en background
+  - sin valor / muy viejo / force:    se carga en el momento (single-flight por llave)
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+# Recargas en background compartidas por todos los caches del proceso
+_refresh_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="swr-refresh")
+
+# Locks de carga por llave: arreglo fijo indexado por hash(key), independiente de la eviction
+# LRU (dos llaves del mismo stripe sólo comparten la espera de carga)
+_KEY_LOCK_STRIPES = 64
+
+
+class _Entry:
+    __slots__ = ("value", "loaded_at")
+
+    def __init__(self, value, loaded_at: float):
+        self.value = value
+        self.loaded_at = loaded_at
+
+
+class SWRCache:
+    def __init__(self, name: str, ttl_seconds: float, max_entries: int, max_stale_seconds: float | None = None):
+        self.name = name
+        self.ttl_seconds = float(ttl_seconds)
+        self.max_entries = max(1, int(max_entries))
+        self.max_stale_seconds = float(max_stale_seconds) if max_stale_seconds is not None else None
+
+        self._entries: "OrderedDict[object, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = [threading.RLock() for _ in range(_KEY_LOCK_STRIPES)]
+        self._refreshing: set = set()
+
+    # -------------------------
+    # lectura
+    # -------------------------
+    def get(self, key, loader, force: bool = False):
+        """
+        loader() -> valor nuevo para `key`. Errores del loader se propagan (nunca se cachean).
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is not None and not force:
+            age = now - entry.loaded_at
+            if age < self.ttl_seconds:
+                return entry.value
+            if self.max_stale_seconds is None or age < self.max_stale_seconds:
+                self._refresh_in_background(key, loader)
+                return entry.value
+
+        return self._load(key, loader, loaded_after=now if force else None)
+
+    def _key_lock(self, key) -> threading.RLock:
+        # RLock: un loader puede leer otra llave del mismo cache que caiga en su stripe
+        return self._key_locks[hash(key) % _KEY_LOCK_STRIPES]
+
+    def _load(self, key, loader, loaded_after: float | None = None):
+        with self._key_lock(key):
+            # Otro thread pudo cargarlo mientras esperábamos (single-flight)
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None:
+                fresh = time.monotonic() - entry.loaded_at < self.ttl_seconds
+                if (loaded_after is None and fresh) or (loaded_after is not None and entry.loaded_at >= loaded_after):
+                    return entry.value
+
+            value = loader()
+            self.set(key, value)
+            return value
+
+    def _refresh_in_background(self, key, loader):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self._load(key, loader, loaded_after=time.monotonic())
+            except Exception as e:
+                print("SWR REFRESH ERROR ->", self.name, key, repr(e))
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        _refresh_pool.submit(run)
+
+    # -------------------------
+    # escritura / invalidación
+    # -------------------------
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = _Entry(value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """
+        Borra `key` (o todo si key=None): la próxima lectura carga en el momento.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+class ByteLRUCache:
+    """
+    LRU acotado por BYTES (valores = bytes) con vencimiento por entrada y un tag por entrada
+    (p.ej. realm_id) para invalidar en grupo.
+    """
+
+    def __init__(self, name: str, max_bytes: int):
+        self.name = name
+        self.max_bytes = max(0, int(max_bytes))
+        self._entries: "OrderedDict[object, tuple[bytes, float, object]]" = OrderedDict()  # key -> (value, expires_at, tag)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key) -> bytes | None:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[1] <= time.time():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value: bytes, ttl_seconds: float, tag=None):
+        size = len(value)
+        if size > self.max_bytes or ttl_seconds <= 0:
+            return  # más grande que todo el presupuesto: no se cachea en memoria
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (value, time.time() + ttl_seconds, tag)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        value, _, _ = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def invalidate_tag(self, tag) -> int:
+        with self._lock:
+            keys = [k for k, (_, _, t) in self._entries.items() if t == tag]
+            for k in keys:
+                self._drop(k)
+        return len(keys)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._bytes = 0
+            elif key in self._entries:
+                self._drop(key)
+
+
+class SingleFlight:
+    """
+    Coalescing por llave: mientras una llamada está en curso, las llamadas idénticas del
+    mismo proceso esperan su resultado (o su excepción) en vez de repetir el trabajo.
+    """
+
+    def __init__(self):
+        self._calls: dict[object, Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """
+        Retorna (resultado, shared); shared=True si se reutilizó la llamada de otro thread.
+        """
+        future, leader = self.claim(key)
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            self.resolve(key, future, exception=e)
+            raise
+        self.resolve(key, future, result=result)
+        return result, False
+
+    def claim(self, key) -> tuple[Future, bool]:
+        """
+        Para llamadas que terminan después de retornar (p.ej. un stream): (future, leader).
+        El leader debe llamar resolve() sí o sí; los demás esperan future.result().
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def resolve(self, key, future: Future, result=None, exception: BaseException | None = None):
+        with self._lock:
+            if self._calls.get(key) is future:
+                self._calls.pop(key)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
@@ -0,0 +1,278 @@
+"""
+Sincronización incremental de Vendor / Customer / Account con Change Data Capture (CDC) de QBO.
+
+- Primera vez (o high-water mark de más de 30 días, o CDC con 1000 objetos = truncado):
+  recarga completa de la entidad con las queries paginadas de qbo_client.
+- Después: GET /cdc?entities=...&changedSince=<high-water mark> y sólo se aplican los cambios
+  (upsert de los modificados; se borran los "Deleted" y los que pasaron a inactivos).
+- El high-water mark queda en Postgres (qbo_sync_state) por realm + entidad: todos los
+  workers comparten el mismo cache.
+
+Caches que mantiene:
+  Vendor   -> qbo_vendor_cache  (INFORME 43: nombre, RUC|DV, Otro, Notes)
+  Customer -> qbo_entity_cache  (lista de clientes del formulario)
+  Account  -> qbo_entity_cache  (lista de cuentas del formulario)
+"""
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from token_store import (
+    get_sync_watermarks,
+    get_sync_state,
+    clear_sync_dirty,
+    replace_vendor_cache,
+    apply_vendor_changes,
+    lookup_cached_vendors,
+    replace_entity_cache,
+    apply_entity_changes,
+    list_cached_entities,
+)
+from qbo_client import (
+    get_cdc,
+    get_customers,
+    get_accounts,
+    get_vendor_directory,
+    vendor_directory_record,
+    new_vendor_directory,
+    add_to_vendor_directory,
+    normalize_vendor_key,
+    rucdv_key,
+)
+
+SYNC_ENTITIES = ("Vendor", "Customer", "Account")
+
+# Antigüedad máxima del cache antes de pedir el delta a QBO (al usarlo desde la app)
+ENTITY_SYNC_MAX_AGE_SECONDS = int(os.environ.get("ENTITY_SYNC_MAX_AGE_SECONDS", "900"))
+
+QBO_CDC_MAX_LOOKBACK = timedelta(days=30) - timedelta(hours=1)  # límite de QBO con margen
+QBO_CDC_MAX_PER_ENTITY = 1000
+# Solape del high-water mark: re-aplicar un cambio es idempotente, perderlo no
+_WATERMARK_OVERLAP = timedelta(minutes=5)
+
+_sync_locks: dict[str, threading.Lock] = {}
+_sync_locks_guard = threading.Lock()
+
+
+def _realm_sync_lock(realm_id: str) -> threading.Lock:
+    with _sync_locks_guard:
+        lock = _sync_locks.get(realm_id)
+        if lock is None:
+            lock = _sync_locks[realm_id] = threading.Lock()
+        return lock
+
+
+# -------------------------
+# ✅ Conversión QBO -> filas de cache
+# -------------------------
+def _vendor_cache_item(rec: dict) -> dict:
+    # rec = vendor_directory_record(...)
+    return {
+        "vendor_id": rec["id"],
+        "display_name": rec["display_name"],
+        "name_key": rec["name_key"],
+        "ruc": rec["ruc"],
+        "dv": rec["dv"],
+        "otro": rec["other"],
+        "notes": rec["notes"],
+    }
+
+
+def _entity_cache_item(entity: str, obj: dict) -> dict:
+    if entity == "Customer":
+        return {"id": obj["Id"], "name": obj.get("DisplayName", f"Customer {obj['Id']}")}
+    return {
+        "id": obj["Id"],
+        "name": obj.get("Name", f"Account {obj['Id']}"),
+        "type": obj.get("AccountType"),
+        "subtype": obj.get("AccountSubType"),
+    }
+
+
+def _is_removed(obj: dict) -> bool:
+    # El cache refleja las queries "activas": borrado o inactivo = fuera
+    return obj.get("status") == "Deleted" or obj.get("Active") is False
+
+
+# -------------------------
+# ✅ Recarga completa / delta
+# -------------------------
+def _full_reload(access_token: str, realm_id: str, entity: str) -> int:
+    synced_at = datetime.now(timezone.utc) - _WATERMARK_OVERLAP
+
+    if entity == "Vendor":
+        directory = get_vendor_directory(access_token, realm_id)
+        items = [_vendor_cache_item(rec) for rec in directory["by_id"].values()]
+        replace_vendor_cache(realm_id, items, synced_at)
+    elif entity == "Customer":
+        items = get_customers(access_token, realm_id)
+        replace_entity_cache(realm_id, entity, items, synced_at)
+    elif entity == "Account":
+        items = get_accounts(access_token, realm_id)
+        replace_entity_cache(realm_id, entity, items, synced_at)
+    else:
+        raise RuntimeError(f"Entidad no soportada para sync: {entity}")
+
+    return len(items)
+
+
+def _apply_changes(realm_id: str, entity: str, objects: list[dict], synced_at) -> int:
+    upserts, deleted_ids = [], []
+    for obj in objects:
+        if _is_removed(obj):
+            deleted_ids.append(str(obj.get("Id")))
+        elif entity == "Vendor":
+            upserts.append(_vendor_cache_item(vendor_directory_record(obj)))
+        else:
+            upserts.append(_entity_cache_item(entity, obj))
+
+    if entity == "Vendor":
+        apply_vendor_changes(realm_id, upserts, deleted_ids, synced_at)
+    else:
+        apply_entity_changes(realm_id, entity, upserts, deleted_ids, synced_at)
+    return len(objects)
+
+
+def sync_realm(access_token: str, realm_id: str, entities=SYNC_ENTITIES, full: bool = False,
+               watermarks: dict | None = None) -> dict:
+    """
+    Sincroniza `entities` del realm. Retorna {entity: "full:N" | "cdc:N"}.
+    full=True fuerza recarga completa (p.ej. botón "Actualizar proveedores").
+    """
+    now = datetime.now(timezone.utc)
+    if watermarks is None:
+        watermarks = get_sync_watermarks(realm_id)
+
+    full_entities, cdc_entities = [], []
+    for entity in entities:
+        mark = watermarks.get(entity)
+        if full or mark is None or now - mark > QBO_CDC_MAX_LOOKBACK:
+            full_entities.append(entity)
+        else:
+            cdc_entities.append(entity)
+
+    result = {}
+    if cdc_entities:
+        # Una sola llamada CDC desde el mark más viejo (re-aplicar cambios es idempotente)
+        changed_since = min(watermarks[e] for e in cdc_entities)
+        changes, server_time = get_cdc(access_token, realm_id, cdc_entities, changed_since)
+        synced_at = (server_time or now) - _WATERMARK_OVERLAP
+
+        for entity in cdc_entities:
+            objects = changes.get(entity) or []
+            if len(objects) >= QBO_CDC_MAX_PER_ENTITY:
+                # CDC no pagina: con 1000 objetos puede haber más -> recarga completa
+                full_entities.append(entity)
+                continue
+            result[entity] = f"cdc:{_apply_changes(realm_id, entity, objects, synced_at)}"
+
+    for entity in full_entities:
+        result[entity] = f"full:{_full_reload(access_token, realm_id, entity)}"
+
+    print("ENTITY SYNC -> realm:", realm_id, result)
+    return result
+
+
+def ensure_synced(access_token: str, realm_id: str, entities=SYNC_ENTITIES, force: bool = False,
+                  max_age_seconds: int = ENTITY_SYNC_MAX_AGE_SECONDS) -> dict:
+    """
+    Sincroniza sólo las entidades cuyo high-water mark tiene más de max_age_seconds, las que
+    un webhook marcó como "dirty" (o todas si force=True). Single-flight por realm dentro del proceso.
+    """
+    with _realm_sync_lock(realm_id):
+        state = get_sync_state(realm_id)
+        watermarks = {e: st["synced_at"] for e, st in state.items()}
+        now = datetime.now(timezone.utc)
+        # synced_at ya incluye el solape; se descuenta para comparar contra la edad real
+        stale = [
+            e for e in entities
+            if force or e not in state or state[e]["dirty"]
+            or (now - watermarks[e] - _WATERMARK_OVERLAP).total_seconds() >= max_age_seconds
+        ]
+        if not stale:
+            return {}
+
+        result = sync_realm(access_token, realm_id, stale, watermarks=watermarks)
+        dirty = [e for e in stale if state.get(e, {}).get("dirty")]
+        if dirty:
+            clear_sync_dirty(realm_id, dirty, now)
+        return result
+
+
+def refresh_vendor_cache(access_token: str, realm_id: str) -> dict:
+    """
+    Recarga completa del directorio de vendors del realm (acción manual).
+    """
+    with _realm_sync_lock(realm_id):
+        return sync_realm(access_token, realm_id, ("Vendor",), full=True)
+
+
+# -------------------------
+# ✅ Lecturas del cache
+# -------------------------
+def _vendor_record_from_cache(row: dict) -> dict:
+    return {
+        "id": row["vendor_id"],
+        "display_name": row["display_name"],
+        "name_key": row["name_key"],
+        "ruc": row["ruc"],
+        "dv": row["dv"],
+        "other": row["otro"],
+        "notes": row["notes"],
+    }
+
+
+def get_cached_vendor_directory(access_token: str, realm_id: str, names=(), rucdvs=(), vendor_ids=(),
+                                force_refresh: bool = False) -> dict:
+    """
+    Igual que get_vendor_directory pero sólo con los vendors que pide el reporte, resueltos
+    con búsquedas indexadas en Postgres (name_key / RUC|DV / Id) en vez de bajar todo el
+    directorio en cada descarga.
+      names:      nombres tal como vienen en el reporte (se normalizan con normalize_vendor_key)
+      rucdvs:     [(ruc, dv), ...]
+      vendor_ids: IDs de vendor
+    Si Postgres no está disponible, cae al directorio completo desde QBO.
+    """
+    try:
+        if force_refresh:
+            refresh_vendor_cache(access_token, realm_id)
+        else:
+            ensure_synced(access_token, realm_id, ("Vendor",))
+        rows = lookup_cached_vendors(
+            realm_id,
+            name_keys={normalize_vendor_key(n) for n in names if n},
+            rucdv_keys={rucdv_key(ruc, dv) for ruc, dv in rucdvs if ruc and dv},
+            vendor_ids={str(v).strip() for v in vendor_ids if str(v).strip()},
+        )
+    except Exception as e:
+        print("VENDOR CACHE ERROR -> realm:", realm_id, "error:", repr(e), "(usando QBO directo)")
+        return get_vendor_directory(access_token, realm_id)
+
+    directory = new_vendor_directory()
+    for row in rows:
+        add_to_vendor_directory(directory, _vendor_record_from_cache(row))
+    return directory
+
+
+def get_synced_customers(access_token: str, realm_id: str) -> list[dict]:
+    """
+    Igual que get_customers (activos), leído del cache sincronizado. Fallback: QBO directo.
+    """
+    try:
+        ensure_synced(access_token, realm_id, ("Customer",))
+        return [{"id": row["id"], "name": row["name"]} for row in list_cached_entities(realm_id, "Customer")]
+    except Exception as e:
+        print("ENTITY CACHE ERROR -> realm:", realm_id, "Customer", repr(e), "(usando QBO directo)")
+        return get_customers(access_token, realm_id)
+
+
+def get_synced_accounts(access_token: str, realm_id: str) -> list[dict]:
+    """
+    Igual que get_accounts (activas), leído del cache sincronizado. Fallback: QBO directo.
+    """
+    try:
+        ensure_synced(access_token, realm_id, ("Account",))
+        return [dict(row) for row in list_cached_entities(realm_id, "Account")]
+    except Exception as e:
+        print("ENTITY CACHE ERROR -> realm:", realm_id, "Account", repr(e), "(usando QBO directo)")
+        return get_accounts(access_token, realm_id)
@@ -0,0 +1,327 @@
+"""
+Cliente asyncio de QuickBooks (httpx), al lado del cliente sync de qbo_client.
+
+- Comparte con qbo_client: configuración (QBO_*), URLs, backoff/Retry-After y el _RealmLimiter
+  del realm (semáforo de concurrencia + token bucket): sync + async usan UN solo límite por realm.
+- Reportes: mismo report_cache, SingleFlight y lock PG que qbo_client.get_report.
+- Un solo event loop en un thread de fondo con UN httpx.AsyncClient (pool keep-alive
+  compartido entre llamadas).
+- Fachada sync (fetch_reports, fetch_vendor_other_by_ids, ...) para usarlo desde Flask:
+  el fan-out de vendors por ID y de tramos de reportes corre como corutinas.
+"""
+import os
+import asyncio
+import threading
+import time
+from contextlib import ExitStack
+
+import httpx
+
+from qbo_client import (
+    QBO_ENV,
+    QBO_MINORVERSION,
+    QBO_MAX_RETRIES,
+    QBO_HTTP_POOL_MAXSIZE,
+    QBO_HTTP_CONNECT_TIMEOUT,
+    QBO_HTTP_READ_TIMEOUT,
+    QBO_VENDOR_FETCH_CONCURRENCY,
+    VENDOR_DIRECTORY_FIELDS,
+    QBOTransientError,
+    _api_base,
+    _company_url,
+    _get_realm_limiter,
+    _retry_after_seconds,
+    _backoff_seconds,
+    _is_transient_status,
+    _decode_cached_report,
+    _report_flights,
+    json_loads,
+    record_transfer,
+    report_col_keys,
+    vendor_other_value,
+    vendor_directory_record,
+    new_vendor_directory,
+    add_to_vendor_directory,
+)
+from token_store import report_fetch_lock
+from report_cache import report_cache_key, get_cached_report, store_report, REPORT_SINGLEFLIGHT_PG
+
+# Cada cuánto reintenta tomar un lugar del semáforo del realm (es un threading.BoundedSemaphore
+# compartido con los threads sync: no se puede esperar con await, se sondea sin bloquear el loop)
+QBO_ASYNC_SLOT_POLL_SECONDS = float(os.environ.get("QBO_ASYNC_SLOT_POLL_SECONDS", "0.02"))
+
+
+class AsyncQBOClient:
+    """
+    Espejo async de qbo_query / get_report / get_all_vendors_map / helpers de vendors.
+    Usar dentro de un event loop; una instancia por loop.
+    """
+
+    def __init__(self, client: httpx.AsyncClient | None = None):
+        self._client = client or httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=QBO_HTTP_POOL_MAXSIZE, max_keepalive_connections=QBO_HTTP_POOL_MAXSIZE),
+            timeout=httpx.Timeout(QBO_HTTP_READ_TIMEOUT, connect=QBO_HTTP_CONNECT_TIMEOUT),
+        )
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def request(self, method: str, url: str, access_token: str, realm_id: str, **kwargs) -> httpx.Response:
+        """
+        Mismo contrato que qbo_client._request: lugar en el _RealmLimiter del realm (el mismo que
+        usan los threads sync) + reintentos ante 429/5xx/red.
+        """
+        headers = kwargs.pop("headers", {})
+        headers.update({
+            "Authorization": f"Bearer {access_token}",
+            "Accept": "application/json",
+        })
+        limiter = _get_realm_limiter(realm_id)
+
+        attempt = 0
+        while True:
+            try:
+                while not limiter.semaphore.acquire(blocking=False):
+                    await asyncio.sleep(QBO_ASYNC_SLOT_POLL_SECONDS)
+                try:
+                    wait = limiter.bucket.reserve()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    r = await self._client.request(method, url, headers=headers, **kwargs)
+                finally:
+                    limiter.semaphore.release()
+            except httpx.TransportError as e:
+                if attempt >= QBO_MAX_RETRIES:
+                    raise QBOTransientError(f"QBO {method} {url} failed after {attempt + 1} attempts: {e!r}") from e
+                delay = _backoff_seconds(attempt)
+                print("QBO ASYNC RETRY ->", method, url, "error:", repr(e), "attempt:", attempt + 1, "sleep:", round(delay, 2))
+            else:
+                if not _is_transient_status(r.status_code) or attempt >= QBO_MAX_RETRIES:
+                    return r
+
+                retry_after = _retry_after_seconds(r.headers.get("Retry-After"))
+                delay = retry_after if retry_after is not None else _backoff_seconds(attempt)
+                if r.status_code == 429:
+                    # Frena a todos los callers del realm (sync y async)
+                    limiter.bucket.block_for(delay)
+                print("QBO ASYNC RETRY ->", method, url, "status:", r.status_code, "attempt:", attempt + 1, "sleep:", round(delay, 2))
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def qbo_query(self, select_statement: str, access_token: str, realm_id: str) -> dict:
+        url = _company_url(realm_id, "query")
+        params = {"query": select_statement, "minorversion": QBO_MINORVERSION}
+        r = await self.request("GET", url, access_token, realm_id, params=params)
+        if r.status_code >= 400:
+            raise RuntimeError(f"QBO query failed ({r.status_code}): {r.text}")
+        return r.json()
+
+    async def get_report(self, access_token: str, realm_id: str, report_name: str, use_cache: bool = True,
+                         columns=None, **params) -> dict:
+        """
+        Igual que qbo_client.get_report (cache, coalescing con los callers sync, columns con
+        fallback a las columnas por defecto).
+        """
+        if columns:
+            data = await self._get_report(access_token, realm_id, report_name, use_cache,
+                                          dict(params, columns=",".join(columns)))
+            missing = set(columns) - set(report_col_keys(data))
+            if not missing:
+                return data
+            print("QBO COLUMNS ->", report_name, "sin:", sorted(missing), "(columnas por defecto)")
+
+        return await self._get_report(access_token, realm_id, report_name, use_cache, params)
+
+    async def _get_report(self, access_token: str, realm_id: str, report_name: str, use_cache: bool,
+                          params: dict) -> dict:
+        params = {k: v for k, v in params.items() if v is not None}
+        params["minorversion"] = QBO_MINORVERSION
+
+        cache_key = report_cache_key(realm_id, report_name, params)
+        if use_cache:
+            body = await asyncio.to_thread(get_cached_report, cache_key, realm_id)
+            if body is not None:
+                return _decode_cached_report("report_cache", report_name, body)
+
+        future, leader = _report_flights.claim(cache_key)
+        if not leader:
+            body, _ = await asyncio.wrap_future(future)
+            if body is not None:
+                return _decode_cached_report("report_shared", report_name, body)
+            # El líder no pudo compartir el body (stream muy grande o cortado): GET propio
+            return (await self._fetch_report(access_token, realm_id, report_name, params, cache_key))[1]
+
+        locks = ExitStack()
+        try:
+            result = None
+            if REPORT_SINGLEFLIGHT_PG:
+                requested_at = await asyncio.to_thread(locks.enter_context, report_fetch_lock(cache_key))
+                # Otro worker pudo traerlo mientras esperábamos el lock
+                body = await asyncio.to_thread(get_cached_report, cache_key, realm_id,
+                                               None if use_cache else requested_at)
+                if body is not None:
+                    result = (body, None)
+            if result is None:
+                result = await self._fetch_report(access_token, realm_id, report_name, params, cache_key)
+        except BaseException as e:
+            await asyncio.to_thread(locks.close)
+            _report_flights.resolve(cache_key, future, exception=e)
+            raise
+        await asyncio.to_thread(locks.close)
+        _report_flights.resolve(cache_key, future, result=result)
+
+        body, data = result
+        if data is None:
+            return _decode_cached_report("report_shared", report_name, body)
+        return data
+
+    async def _fetch_report(self, access_token: str, realm_id: str, report_name: str, params: dict,
+                            cache_key: str) -> tuple[bytes, dict]:
+        print("QBO ASYNC DEBUG -> ENV:", QBO_ENV, "BASE:", _api_base(), "realm:", realm_id, "report:", report_name,
+              "params:", params)
+
+        url = _company_url(realm_id, f"reports/{report_name}")
+        r = await self.request("GET", url, access_token, realm_id, params=params)
+        if r.status_code >= 400:
+            raise RuntimeError(f"QBO report '{report_name}' failed ({r.status_code}): {r.text}")
+
+        body = r.content
+        t0 = time.perf_counter()
+        data = json_loads(body)
+        record_transfer("report", report_name, r.num_bytes_downloaded, len(body), (time.perf_counter() - t0) * 1000)
+        # Sólo respuestas válidas (Fault con 200 también llega como JSON, pero sin "Rows")
+        if "Fault" not in data:
+            await asyncio.to_thread(store_report, cache_key, realm_id, report_name, params, body)
+        return body, data
+
+    async def _query_pages(self, access_token: str, realm_id: str, entity: str, select: str, max_per_page: int):
+        start = 1
+        while True:
+            q = f"SELECT {select} FROM {entity} STARTPOSITION {start} MAXRESULTS {max_per_page}"
+            data = await self.qbo_query(q, access_token, realm_id)
+            rows = data.get("QueryResponse", {}).get(entity, []) or []
+            yield rows
+            if len(rows) < max_per_page:
+                return
+            start += max_per_page
+
+    async def get_all_vendors_map(self, access_token: str, realm_id: str, max_per_page: int = 1000) -> dict:
+        """
+        Igual que qbo_client.get_all_vendors_map: {displayname_lower: vendor_id}.
+        """
+        out = {}
+        async for vendors in self._query_pages(access_token, realm_id, "Vendor", "Id, DisplayName", max_per_page):
+            for v in vendors:
+                dn = (v.get("DisplayName") or "").strip()
+                if dn:
+                    out[dn.lower()] = v.get("Id")
+        return out
+
+    async def get_vendor_directory(self, access_token: str, realm_id: str, max_per_page: int = 1000) -> dict:
+        """
+        Igual que qbo_client.get_vendor_directory (by_id / by_name / by_rucdv).
+        """
+        directory = new_vendor_directory()
+        async for vendors in self._query_pages(access_token, realm_id, "Vendor", VENDOR_DIRECTORY_FIELDS, max_per_page):
+            for v in vendors:
+                add_to_vendor_directory(directory, vendor_directory_record(v))
+        return directory
+
+    async def get_vendor_detail(self, access_token: str, realm_id: str, vendor_id: str) -> dict:
+        url = _company_url(realm_id, f"vendor/{vendor_id}")
+        r = await self.request("GET", url, access_token, realm_id, params={"minorversion": QBO_MINORVERSION})
+        if r.status_code >= 400:
+            raise RuntimeError(f"QBO vendor/{vendor_id} failed ({r.status_code}): {r.text}")
+        return r.json()
+
+    async def get_vendor_other_by_ids(self, access_token: str, realm_id: str, vendor_ids, notes_fallback: bool = False,
+                                      concurrency: int | None = None, timeout: float | None = None) -> dict:
+        """
+        {vendor_id: "2/1"} como get_vendor_other_by_ids (notes_fallback=True = get_vendor_notes_by_ids),
+        con los GET en paralelo: hasta `concurrency` a la vez, dentro del límite del realm.
+        """
+        ids = list(dict.fromkeys(str(x).strip() for x in (vendor_ids or []) if str(x).strip()))
+        sem = asyncio.Semaphore(max(1, concurrency or QBO_VENDOR_FETCH_CONCURRENCY))
+        kwargs = {"timeout": timeout} if timeout else {}
+
+        async def fetch_one(vid: str) -> str:
+            async with sem:
+                r = await self.request("GET", _company_url(realm_id, f"vendor/{vid}"), access_token, realm_id, **kwargs)
+            # throttling / 5xx que persistió: NO se convierte en "" (perdería el dato)
+            if _is_transient_status(r.status_code):
+                raise QBOTransientError(f"QBO vendor/{vid} failed ({r.status_code}): {r.text}")
+            if r.status_code != 200:
+                return ""
+            try:
+                vendor = (r.json() or {}).get("Vendor") or {}
+            except (KeyError, ValueError):
+                return ""
+            return vendor_other_value(vendor, notes_fallback)
+
+        values = await asyncio.gather(*(fetch_one(vid) for vid in ids))
+        return dict(zip(ids, values))
+
+    async def get_vendor_notes_by_ids(self, access_token: str, realm_id: str, vendor_ids,
+                                      concurrency: int | None = None, timeout: float | None = None) -> dict:
+        return await self.get_vendor_other_by_ids(access_token, realm_id, vendor_ids, notes_fallback=True,
+                                                  concurrency=concurrency, timeout=timeout)
+
+    async def get_reports(self, access_token: str, realm_id: str, report_requests: list[tuple[str, dict]],
+                          use_cache: bool = True) -> list[dict]:
+        """
+        Fan-out de reportes: [(report_name, params), ...] -> [report_json, ...] en el mismo orden.
+        """
+        return await asyncio.gather(*(self.get_report(access_token, realm_id, name, use_cache=use_cache, **(params or {}))
+                                      for name, params in report_requests))
+
+
+# -------------------------
+# ✅ Fachada sync: event loop de fondo + cliente compartido
+# -------------------------
+_loop: asyncio.AbstractEventLoop | None = None
+_client: AsyncQBOClient | None = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop() -> tuple[asyncio.AbstractEventLoop, AsyncQBOClient]:
+    global _loop, _client
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="qbo-async-loop", daemon=True).start()
+
+            async def make_client():
+                return AsyncQBOClient()
+
+            _client = asyncio.run_coroutine_threadsafe(make_client(), loop).result()
+            _loop = loop
+        return _loop, _client
+
+
+def run_sync(fn, *args, timeout: float | None = None, **kwargs):
+    """
+    Ejecuta fn(client, *args, **kwargs) (una corutina) en el loop de fondo y espera el resultado.
+    No llamar desde el propio loop (se bloquearía esperándose a sí mismo).
+    """
+    loop, client = _get_loop()
+    return asyncio.run_coroutine_threadsafe(fn(client, *args, **kwargs), loop).result(timeout)
+
+
+def fetch_reports(access_token: str, realm_id: str, report_requests: list[tuple[str, dict]],
+                  use_cache: bool = True) -> list[dict]:
+    return run_sync(AsyncQBOClient.get_reports, access_token, realm_id, report_requests, use_cache)
+
+
+def fetch_vendor_other_by_ids(access_token: str, realm_id: str, vendor_ids, notes_fallback: bool = False,
+                              concurrency: int | None = None, timeout: float | None = None) -> dict:
+    return run_sync(AsyncQBOClient.get_vendor_other_by_ids, access_token, realm_id, vendor_ids, notes_fallback,
+                    concurrency, timeout)
+
+
+def fetch_vendor_directory(access_token: str, realm_id: str) -> dict:
+    return run_sync(AsyncQBOClient.get_vendor_directory, access_token, realm_id)
+
+
+def fetch_all_vendors_map(access_token: str, realm_id: str) -> dict:
+    return run_sync(AsyncQBOClient.get_all_vendors_map, access_token, realm_id)
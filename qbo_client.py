@@ -1,11 +1,36 @@
 import os
+import re
+import html
 import base64
 from datetime import datetime, timedelta, timezone
 from urllib.parse import urlencode
 
 import requests
 import json
-from token_store import get_tokens, save_tokens, is_access_token_valid
+import threading
+import time
+import random
+from collections import deque
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson  # opcional: decode JSON mucho más rápido para reportes grandes
+except ImportError:
+    orjson = None
+from token_store import (
+    get_tokens,
+    save_tokens,
+    is_access_token_valid,
+    token_refresh_lock,
+    report_fetch_lock,
+    TOKEN_SKEW_SECONDS,
+)
+from report_cache import report_cache_key, get_cached_report, store_report, REPORT_SINGLEFLIGHT_PG
+from caching import SingleFlight
+from report_stream import ReportRowStream
 
 QBO_ENV = os.environ.get("QBO_ENV", "sandbox").lower()
 QBO_CLIENT_ID = os.environ.get("QBO_CLIENT_ID", "")
@@ -15,36 +40,335 @@ QBO_MINORVERSION = os.environ.get("QBO_MINORVERSION", "75")
 
 TOKEN_URL = "https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer"
 
+# HTTP keep-alive compartido (QBO API + OAuth)
+QBO_HTTP_POOL_CONNECTIONS = int(os.environ.get("QBO_HTTP_POOL_CONNECTIONS", "4"))   # hosts distintos
+QBO_HTTP_POOL_MAXSIZE = int(os.environ.get("QBO_HTTP_POOL_MAXSIZE", "20"))          # conexiones por host
+QBO_HTTP_CONNECT_TIMEOUT = float(os.environ.get("QBO_HTTP_CONNECT_TIMEOUT", "10"))
+QBO_HTTP_READ_TIMEOUT = float(os.environ.get("QBO_HTTP_READ_TIMEOUT", "30"))
+
+# Límites de Intuit por realm (~10 requests concurrentes, ~500 por minuto): son del realm, no del
+# proceso. Cada proceso que llama a QBO (workers de gunicorn + token_refresher) tiene su propio
+# limitador, así que cada uno usa límite / QBO_PROCESSES
+#   QBO_PROCESSES: default WEB_CONCURRENCY (workers de gunicorn, default 1) + 1 (token_refresher)
+QBO_MAX_CONCURRENCY = max(1, min(10, int(os.environ.get("QBO_MAX_CONCURRENCY", "10"))))
+QBO_RATE_LIMIT_PER_MINUTE = int(os.environ.get("QBO_RATE_LIMIT_PER_MINUTE", "500"))
+QBO_VENDOR_FETCH_CONCURRENCY = int(os.environ.get("QBO_VENDOR_FETCH_CONCURRENCY", "8"))
+QBO_RATE_BURST = int(os.environ.get("QBO_RATE_BURST", "20"))
+QBO_PROCESSES = max(1, int(os.environ.get("QBO_PROCESSES") or int(os.environ.get("WEB_CONCURRENCY", "1")) + 1))
+
+# Reintentos ante 429 / 5xx / errores de red (backoff exponencial con jitter, respeta Retry-After)
+QBO_MAX_RETRIES = int(os.environ.get("QBO_MAX_RETRIES", "5"))
+QBO_BACKOFF_BASE_SECONDS = float(os.environ.get("QBO_BACKOFF_BASE_SECONDS", "0.5"))
+QBO_BACKOFF_MAX_SECONDS = float(os.environ.get("QBO_BACKOFF_MAX_SECONDS", "30"))
+QBO_RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Cortes al leer un body en stream (conexión reseteada / chunked incompleto / read timeout)
+_STREAM_RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+# Reportes grandes: gzip + decode rápido + métricas por llamada
+QBO_FAST_JSON_MIN_BYTES = int(os.environ.get("QBO_FAST_JSON_MIN_BYTES", "65536"))
+QBO_TRANSFER_STATS_SIZE = int(os.environ.get("QBO_TRANSFER_STATS_SIZE", "200"))
+# Una línea "QBO STATS" por llamada (páginas, tramos, ...): sólo para depurar; si no, ver /stats/qbo
+QBO_LOG_TRANSFER_STATS = os.environ.get("QBO_LOG_TRANSFER_STATS", "0") == "1"
+
+# Reportes por tramos de fechas (P&L Detail / TaxDetail)
+#   QBO_REPORT_CHUNKING: "month" (default) | "adaptive" (mes y se parte en mitades si trae muchas filas) | "off"
+QBO_REPORT_CHUNKING = os.environ.get("QBO_REPORT_CHUNKING", "month").strip().lower()
+QBO_REPORT_CHUNK_MAX_ROWS = int(os.environ.get("QBO_REPORT_CHUNK_MAX_ROWS", "5000"))
+
+# Reportes de un solo tramo: parsear mientras se descarga (report_stream) en vez de armar el JSON
+QBO_REPORT_STREAMING = os.environ.get("QBO_REPORT_STREAMING", "1") == "1"
+QBO_REPORT_STREAM_CHUNK_BYTES = int(os.environ.get("QBO_REPORT_STREAM_CHUNK_BYTES", str(64 * 1024)))
+# Body en stream hasta este tamaño se guarda en report_cache / se comparte con llamadas idénticas
+REPORT_STREAM_CACHE_MAX_BYTES = int(os.environ.get("REPORT_STREAM_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# Serializa el refresh dentro del proceso, un lock por realm (entre procesos: advisory lock en token_store)
+_refresh_locks: dict[str, threading.Lock] = {}
+_refresh_locks_guard = threading.Lock()
+
 
 def _api_base() -> str:
     return "https://quickbooks.api.intuit.com" if QBO_ENV == "production" else "https://sandbox-quickbooks.api.intuit.com"
 
 
+# -------------------------
+# ✅ Cliente HTTP compartido (pool keep-alive)
+# -------------------------
+_http_adapter: HTTPAdapter | None = None
+_http_adapter_lock = threading.Lock()
+_http_local = threading.local()
+
+
+def _get_http_adapter() -> HTTPAdapter:
+    global _http_adapter
+    if _http_adapter is None:
+        with _http_adapter_lock:
+            if _http_adapter is None:
+                _http_adapter = HTTPAdapter(
+                    pool_connections=QBO_HTTP_POOL_CONNECTIONS,
+                    pool_maxsize=QBO_HTTP_POOL_MAXSIZE,
+                )
+    return _http_adapter
+
+
+def _http() -> requests.Session:
+    """
+    Session por thread montada sobre UN HTTPAdapter compartido:
+    el pool de conexiones (urllib3, thread-safe) se reutiliza entre threads y requests,
+    y cada thread tiene su propio estado de Session (cookies/headers), sin compartir nada mutable.
+    """
+    s = getattr(_http_local, "session", None)
+    if s is None:
+        s = requests.Session()
+        adapter = _get_http_adapter()
+        s.mount("https://", adapter)
+        s.mount("http://", adapter)
+        s.headers.update({"Connection": "keep-alive", "Accept-Encoding": "gzip, deflate"})
+        _http_local.session = s
+    return s
+
+
+def _http_timeout() -> tuple[float, float]:
+    return (QBO_HTTP_CONNECT_TIMEOUT, QBO_HTTP_READ_TIMEOUT)
+
+
+# -------------------------
+# ✅ Límite por realm (concurrencia + requests por minuto)
+# -------------------------
+class QBOTransientError(RuntimeError):
+    """
+    429 / 5xx / error de red que siguió fallando después de QBO_MAX_RETRIES.
+    Los loops de vendors NO la convierten en "" (eso corrompe CONCEPTO/COMPRAS).
+    """
+
+
+class _TokenBucket:
+    """
+    Token bucket thread-safe: `rate` tokens/segundo, hasta `capacity` de ráfaga.
+    reserve() reserva un token y devuelve cuántos segundos esperar antes de usarlo
+    (el saldo puede quedar negativo: cada caller reserva su turno en la fila).
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = max(rate, 0.001)
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+            return max(wait, self.blocked_until - now)
+
+    def block_for(self, seconds: float):
+        """
+        Pausa a TODOS los callers del realm (p.ej. Intuit respondió 429 con Retry-After).
+        """
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class _RealmLimiter:
+    """
+    Por realm: semáforo de concurrencia + token bucket (requests/minuto).
+    Compartido por todos los threads del proceso; con la parte del proceso de los límites del
+    realm (ver QBO_PROCESSES).
+    """
+
+    def __init__(self, max_concurrent: int, per_minute: int, burst: int):
+        self.semaphore = threading.BoundedSemaphore(max_concurrent)
+        self.bucket = _TokenBucket(per_minute / 60.0, burst)
+
+
+_realm_limiters: dict[str, _RealmLimiter] = {}
+_realm_limiters_guard = threading.Lock()
+
+
+def _get_realm_limiter(realm_id: str) -> _RealmLimiter:
+    with _realm_limiters_guard:
+        limiter = _realm_limiters.get(realm_id)
+        if limiter is None:
+            limiter = _realm_limiters[realm_id] = _RealmLimiter(
+                max(1, QBO_MAX_CONCURRENCY // QBO_PROCESSES),
+                max(1, QBO_RATE_LIMIT_PER_MINUTE // QBO_PROCESSES),
+                max(1, QBO_RATE_BURST // QBO_PROCESSES),
+            )
+        return limiter
+
+
+@contextmanager
+def _realm_slot(realm_id: str):
+    limiter = _get_realm_limiter(realm_id)
+    with limiter.semaphore:
+        wait = limiter.bucket.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        yield
+
+
+def _retry_after_seconds(value: str | None) -> float | None:
+    """
+    Retry-After puede venir en segundos o como fecha HTTP.
+    """
+    value = (value or "").strip()
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def _backoff_seconds(attempt: int) -> float:
+    # Exponencial con "full jitter": evita que todos los threads reintenten al mismo tiempo
+    return random.uniform(0, min(QBO_BACKOFF_MAX_SECONDS, QBO_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+
+# -------------------------
+# ✅ Decode JSON (orjson opcional) + métricas de transferencia
+# -------------------------
+_transfer_stats = deque(maxlen=QBO_TRANSFER_STATS_SIZE)
+_transfer_stats_lock = threading.Lock()
+
+
+def json_loads(body: bytes | str):
+    """
+    orjson si está instalado y el body es grande; si no, json de la stdlib.
+    """
+    if orjson is not None and len(body) >= QBO_FAST_JSON_MIN_BYTES:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def record_transfer(kind: str, name: str, wire_bytes: int | None, body_bytes: int, decode_ms: float):
+    """
+    Guarda bytes transferidos (comprimidos) vs. body (descomprimido) y tiempo de decode.
+    Ver get_transfer_stats() / GET /stats/qbo.
+    """
+    stat = {
+        "at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "kind": kind,
+        "name": name,
+        "wire_bytes": wire_bytes,
+        "body_bytes": body_bytes,
+        "decode_ms": round(decode_ms, 2),
+        "decoder": "orjson" if (orjson is not None and body_bytes >= QBO_FAST_JSON_MIN_BYTES) else "json",
+    }
+    with _transfer_stats_lock:
+        _transfer_stats.append(stat)
+    if QBO_LOG_TRANSFER_STATS:
+        print("QBO STATS ->", stat)
+
+
+def get_transfer_stats() -> list[dict]:
+    with _transfer_stats_lock:
+        return list(_transfer_stats)
+
+
+def _wire_bytes(r: requests.Response) -> int | None:
+    # urllib3 cuenta los bytes leídos del socket (antes de descomprimir gzip)
+    try:
+        return int(r.raw.tell())
+    except Exception:
+        return None
+
+
+def _decode_json(r: requests.Response, kind: str, name: str) -> dict:
+    body = r.content
+    t0 = time.perf_counter()
+    data = json_loads(body)
+    record_transfer(kind, name, _wire_bytes(r), len(body), (time.perf_counter() - t0) * 1000)
+    return data
+
+
 def _basic_auth_header() -> str:
     raw = f"{QBO_CLIENT_ID}:{QBO_CLIENT_SECRET}".encode("utf-8")
     return base64.b64encode(raw).decode("utf-8")
 
 
-def get_valid_access_token() -> tuple[str, str]:
+def get_valid_access_token(realm_id: str | None = None) -> tuple[str, str]:
     """
-    Devuelve (access_token, realm_id) usando DB como fuente de verdad.
-    - Si access_token vigente -> lo usa
+    Devuelve (access_token, realm_id) de una empresa usando DB como fuente de verdad.
+    - realm_id=None -> empresa por defecto (QBO_DEFAULT_REALM_ID o la última conectada)
+    - Si access_token vigente -> lo usa (normalmente desde el cache en memoria de token_store)
     - Si expiró -> refresca con refresh_token, guarda el refresh_token nuevo (rotación)
     """
-    row = get_tokens() or {}
-    realm_id = row.get("realm_id")
+    row = get_tokens(realm_id) or {}
+    realm_id = row.get("realm_id") or realm_id
+    if not realm_id:
+        raise RuntimeError("No hay empresa conectada. Conecta QuickBooks en /connect.")
 
     # 1) Si el access token todavía sirve
     if row.get("access_token") and row.get("access_expires_at") and is_access_token_valid(row["access_expires_at"]):
-        if not realm_id:
-            raise RuntimeError("No hay realm_id guardado. Conecta QuickBooks en /connect.")
         return row["access_token"], realm_id
 
-    # 2) Refrescar tokens
-    refresh_token = row.get("refresh_token")
-    if not refresh_token:
-        raise RuntimeError("No hay refresh_token guardado. Conecta QuickBooks en /connect.")
+    # 2) Refrescar tokens (un solo refresh a la vez por empresa, entre threads y workers)
+    return _refresh_tokens_single_flight(realm_id)
+
+
+def _realm_refresh_lock(realm_id: str) -> threading.Lock:
+    with _refresh_locks_guard:
+        lock = _refresh_locks.get(realm_id)
+        if lock is None:
+            lock = _refresh_locks[realm_id] = threading.Lock()
+        return lock
+
+
+def _refresh_tokens_single_flight(realm_id: str, min_valid_seconds: int = TOKEN_SKEW_SECONDS) -> tuple[str, str]:
+    """
+    Refresca el access_token de UNA empresa garantizando que solo un caller hable con TOKEN_URL:
+      - threading.Lock por realm para los threads del proceso
+      - pg_advisory_xact_lock por realm para los demás workers/procesos
+    Dentro del lock se relee la fila desde la DB: si otro caller ya refrescó, se reutiliza
+    su resultado en vez de gastar (y rotar) el refresh_token otra vez.
+    """
+    with _realm_refresh_lock(realm_id):
+        with token_refresh_lock(realm_id):
+            row = get_tokens(realm_id, use_cache=False) or {}
+            if not row:
+                raise RuntimeError(f"Empresa {realm_id} no conectada. Conecta QuickBooks en /connect.")
+
+            if row.get("access_token") and is_access_token_valid(row.get("access_expires_at"), min_valid_seconds):
+                return row["access_token"], realm_id
+
+            return _refresh_tokens(row)
+
+
+def refresh_access_token_if_needed(margin_seconds: int, realm_id: str | None = None) -> datetime | None:
+    """
+    Refresco proactivo (lo usa token_refresher): si al access_token de la empresa le quedan
+    menos de margin_seconds, lo renueva (single-flight). Devuelve el access_expires_at vigente.
+    """
+    row = get_tokens(realm_id, use_cache=False) or {}
+    if not row.get("refresh_token"):
+        return None
+
+    realm_id = row["realm_id"]
+    if row.get("access_token") and is_access_token_valid(row.get("access_expires_at"), margin_seconds):
+        return row["access_expires_at"]
+
+    _refresh_tokens_single_flight(realm_id, min_valid_seconds=margin_seconds)
+    return (get_tokens(realm_id) or {}).get("access_expires_at")
+
+
+def get_company_name(access_token: str, realm_id: str) -> str:
+    data = qbo_get(access_token, realm_id, f"companyinfo/{realm_id}")
+    return ((data.get("CompanyInfo") or {}).get("CompanyName") or "").strip()
 
+
+def _token_post(data: dict) -> requests.Response:
     if not QBO_CLIENT_ID or not QBO_CLIENT_SECRET:
         raise RuntimeError("Faltan QBO_CLIENT_ID / QBO_CLIENT_SECRET en env vars.")
 
@@ -53,12 +377,31 @@ def get_valid_access_token() -> tuple[str, str]:
         "Accept": "application/json",
         "Content-Type": "application/x-www-form-urlencoded",
     }
+    return _http().post(TOKEN_URL, headers=headers, data=data, timeout=_http_timeout())
+
+
+def exchange_authorization_code(code: str, redirect_uri: str) -> dict:
+    """
+    OAuth callback: cambia el authorization code por tokens. Devuelve el payload de Intuit.
+    """
+    r = _token_post({"grant_type": "authorization_code", "code": code, "redirect_uri": redirect_uri})
+    if r.status_code >= 400:
+        raise RuntimeError(f"Token exchange failed ({r.status_code}): {r.text}")
+    return r.json()
+
+
+def _refresh_tokens(row: dict) -> tuple[str, str]:
+    realm_id = row.get("realm_id")
+    refresh_token = row.get("refresh_token")
+    if not refresh_token:
+        raise RuntimeError(f"No hay refresh_token guardado para {realm_id}. Conecta QuickBooks en /connect.")
+
     data = {
         "grant_type": "refresh_token",
         "refresh_token": refresh_token,
     }
 
-    r = requests.post(TOKEN_URL, headers=headers, data=data, timeout=30)
+    r = _token_post(data)
     if r.status_code >= 400:
         raise RuntimeError(f"Token refresh failed ({r.status_code}): {r.text}")
 
@@ -72,9 +415,6 @@ def get_valid_access_token() -> tuple[str, str]:
 
     expires_at = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
 
-    if not realm_id:
-        raise RuntimeError("No hay realm_id guardado. Re-conecta en /connect.")
-
     save_tokens(
         realm_id=realm_id,
         access_token=access_token,
@@ -84,17 +424,63 @@ def get_valid_access_token() -> tuple[str, str]:
     return access_token, realm_id
 
 
-def _request(method: str, url: str, access_token: str, **kwargs):
+def _request(method: str, url: str, access_token: str, realm_id: str | None = None, **kwargs):
+    """
+    Request a la API de QBO pasando por el throttle del realm (concurrencia + token bucket).
+    429 / 5xx / errores de red se reintentan con backoff exponencial + jitter, respetando
+    Retry-After. Devuelve la última respuesta (el caller decide qué hacer con >= 400);
+    si el error de red persiste levanta QBOTransientError.
+    """
     headers = kwargs.pop("headers", {})
     headers.update({
         "Authorization": f"Bearer {access_token}",
         "Accept": "application/json",
     })
-    return requests.request(method, url, headers=headers, timeout=30, **kwargs)
+    timeout = kwargs.pop("timeout", None) or _http_timeout()
+
+    realm_id = realm_id or _realm_from_url(url)
+    limiter = _get_realm_limiter(realm_id or "_")
+
+    attempt = 0
+    while True:
+        try:
+            with _realm_slot(realm_id or "_"):
+                r = _http().request(method, url, headers=headers, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= QBO_MAX_RETRIES:
+                raise QBOTransientError(f"QBO {method} {url} failed after {attempt + 1} attempts: {e!r}") from e
+            delay = _backoff_seconds(attempt)
+            print("QBO RETRY ->", method, url, "error:", repr(e), "attempt:", attempt + 1, "sleep:", round(delay, 2))
+        else:
+            if r.status_code not in QBO_RETRY_STATUSES or attempt >= QBO_MAX_RETRIES:
+                return r
+
+            retry_after = _retry_after_seconds(r.headers.get("Retry-After"))
+            delay = retry_after if retry_after is not None else _backoff_seconds(attempt)
+            if r.status_code == 429:
+                # Frena a todos los threads del realm, no solo a este
+                limiter.bucket.block_for(delay)
+            print("QBO RETRY ->", method, url, "status:", r.status_code, "attempt:", attempt + 1, "sleep:", round(delay, 2))
+
+        time.sleep(delay)
+        attempt += 1
+
+
+def _is_transient_status(status_code: int) -> bool:
+    return status_code in QBO_RETRY_STATUSES
+
+
+def _realm_from_url(url: str) -> str | None:
+    m = re.search(r"/v3/company/([^/?]+)", url or "")
+    return m.group(1) if m else None
+
+
+def _company_url(realm_id: str, path: str) -> str:
+    return f"{_api_base()}/v3/company/{realm_id}/{path.lstrip('/')}"
 
 
 def qbo_query(select_statement: str, access_token: str, realm_id: str) -> dict:
-    url = f"{_api_base()}/v3/company/{realm_id}/query"
+    url = _company_url(realm_id, "query")
     params = {"query": select_statement, "minorversion": QBO_MINORVERSION}
     r = _request("GET", url, access_token, params=params)
     if r.status_code >= 400:
@@ -102,25 +488,109 @@ def qbo_query(select_statement: str, access_token: str, realm_id: str) -> dict:
     return r.json()
 
 
-def get_customers(access_token: str, realm_id: str, active_only: bool = True, max_results: int = 1000):
-    where = " WHERE Active = true" if active_only else ""
-    q = f"SELECT Id, DisplayName, Active FROM Customer{where} MAXRESULTS {max_results}"
-    data = qbo_query(q, access_token, realm_id)
-    customers = data.get("QueryResponse", {}).get("Customer", []) or []
-    return [{"id": c["Id"], "name": c.get("DisplayName", f"Customer {c['Id']}")} for c in customers]
+QBO_QUERY_PAGE_SIZE = 1000  # máximo que acepta MAXRESULTS
 
 
-def get_accounts(access_token: str, realm_id: str, active_only: bool = True, max_results: int = 1000):
-    where = " WHERE Active = true" if active_only else ""
-    q = f"SELECT Id, Name, AccountType, AccountSubType, Active FROM Account{where} MAXRESULTS {max_results}"
+def iter_query(access_token: str, realm_id: str, entity: str, select: str = "*", where: str = "",
+               page_size: int = QBO_QUERY_PAGE_SIZE, prefetch: bool = True):
+    """
+    Generador sobre TODAS las filas de un SELECT, siguiendo STARTPOSITION página por página:
+      for v in iter_query(tok, realm, "Vendor", "Id, DisplayName"): ...
+    Memoria acotada a ~2 páginas. Con prefetch=True la página siguiente se pide en un thread
+    mientras el caller consume la actual.
+    """
+    base = f"SELECT {select} FROM {entity}" + (f" WHERE {where}" if where else "")
+
+    def fetch_page(start: int) -> list[dict]:
+        q = f"{base} STARTPOSITION {start} MAXRESULTS {page_size}"
+        data = qbo_query(q, access_token, realm_id)
+        return data.get("QueryResponse", {}).get(entity, []) or []
+
+    if not prefetch:
+        start = 1
+        while True:
+            page = fetch_page(start)
+            yield from page
+            if len(page) < page_size:
+                return
+            start += page_size
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="qbo-query") as pool:
+        start = 1
+        pending = pool.submit(fetch_page, start)
+        while pending is not None:
+            page = pending.result()
+            pending = None
+            if len(page) >= page_size:
+                start += page_size
+                pending = pool.submit(fetch_page, start)
+            yield from page
+
+
+def query_count(access_token: str, realm_id: str, entity: str, where: str = "") -> int:
+    q = f"SELECT COUNT(*) FROM {entity}" + (f" WHERE {where}" if where else "")
     data = qbo_query(q, access_token, realm_id)
-    accounts = data.get("QueryResponse", {}).get("Account", []) or []
-    return [{
-        "id": a["Id"],
-        "name": a.get("Name", f"Account {a['Id']}"),
-        "type": a.get("AccountType"),
-        "subtype": a.get("AccountSubType"),
-    } for a in accounts]
+    return int((data.get("QueryResponse") or {}).get("totalCount") or 0)
+
+
+def query_all(access_token: str, realm_id: str, entity: str, select: str = "*", where: str = "",
+              page_size: int = QBO_QUERY_PAGE_SIZE, concurrency: int | None = None) -> list[dict]:
+    """
+    Todas las filas de un SELECT pidiendo las páginas EN PARALELO: primero COUNT(*) para
+    saber cuántas páginas hay, después un STARTPOSITION por página (orden conservado).
+    Si entre el COUNT y las páginas aparecieron filas nuevas, se sigue página por página.
+    """
+    base = f"SELECT {select} FROM {entity}" + (f" WHERE {where}" if where else "")
+
+    def fetch_page(start: int) -> list[dict]:
+        q = f"{base} STARTPOSITION {start} MAXRESULTS {page_size}"
+        data = qbo_query(q, access_token, realm_id)
+        return data.get("QueryResponse", {}).get(entity, []) or []
+
+    total = query_count(access_token, realm_id, entity, where)
+    starts = list(range(1, max(total, 1) + 1, page_size))
+    workers = max(1, min(concurrency or QBO_MAX_CONCURRENCY, len(starts)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="qbo-query") as pool:
+        pages = list(pool.map(fetch_page, starts))
+
+    out = [row for page in pages for row in page]
+    start = starts[-1]
+    while len(pages[-1]) >= page_size:
+        start += page_size
+        pages.append(fetch_page(start))
+        out.extend(pages[-1])
+    return out
+
+
+def get_customers(access_token: str, realm_id: str, active_only: bool = True, max_results: int | None = None):
+    """
+    Todos los customers (paginado). max_results opcional para cortar el total.
+    """
+    where = "Active = true" if active_only else ""
+    out = []
+    for c in iter_query(access_token, realm_id, "Customer", "Id, DisplayName, Active", where):
+        out.append({"id": c["Id"], "name": c.get("DisplayName", f"Customer {c['Id']}")})
+        if max_results and len(out) >= max_results:
+            break
+    return out
+
+
+def get_accounts(access_token: str, realm_id: str, active_only: bool = True, max_results: int | None = None):
+    """
+    Todas las cuentas (paginado). max_results opcional para cortar el total.
+    """
+    where = "Active = true" if active_only else ""
+    out = []
+    for a in iter_query(access_token, realm_id, "Account", "Id, Name, AccountType, AccountSubType, Active", where):
+        out.append({
+            "id": a["Id"],
+            "name": a.get("Name", f"Account {a['Id']}"),
+            "type": a.get("AccountType"),
+            "subtype": a.get("AccountSubType"),
+        })
+        if max_results and len(out) >= max_results:
+            break
+    return out
 
 # -------------------------
 # ✅ Vendors: lista + detalle + leer "Otro"
@@ -134,7 +604,7 @@ def get_vendors(access_token: str, realm_id: str, active_only: bool = True, max_
 
 
 def get_vendor_detail(access_token: str, realm_id: str, vendor_id: str) -> dict:
-    url = f"{_api_base()}/v3/company/{realm_id}/vendor/{vendor_id}"
+    url = _company_url(realm_id, f"vendor/{vendor_id}")
     params = {"minorversion": QBO_MINORVERSION}
     r = _request("GET", url, access_token, params=params)
     if r.status_code >= 400:
@@ -169,26 +639,229 @@ def extract_vendor_otro(vendor_payload: dict) -> str:
 # -------------------------
 # ✅ REPORTS API (GENÉRICO)
 # -------------------------
-def get_report(access_token: str, realm_id: str, report_name: str, **params) -> dict:
+# Reportes idénticos en vuelo dentro del proceso (realm + reporte + parámetros)
+_report_flights = SingleFlight()
+
+
+def _decode_cached_report(kind: str, report_name: str, body: bytes) -> dict:
+    t0 = time.perf_counter()
+    data = json_loads(body)
+    record_transfer(kind, report_name, 0, len(body), (time.perf_counter() - t0) * 1000)
+    return data
+
+
+def report_col_keys(report_json: dict) -> list[str]:
+    """
+    ColKey de cada columna ("tx_date", "subt_nat_amount", ...); "" si la columna no trae.
+    """
+    out = []
+    for c in (report_json.get("Columns") or {}).get("Column") or []:
+        keys = [m.get("Value") or "" for m in (c.get("MetaData") or []) if m.get("Name") == "ColKey"]
+        out.append(keys[0] if keys else "")
+    return out
+
+
+def get_report(access_token: str, realm_id: str, report_name: str, use_cache: bool = True,
+               columns=None, **params) -> dict:
     """
     Llama Reports API genérico:
       /v3/company/{realm_id}/reports/{report_name}
+    Con use_cache=True pasa por report_cache (misma llamada repetida = sin ir a QBO).
+    Llamadas idénticas simultáneas se combinan en un solo GET (también entre workers con
+    REPORT_SINGLEFLIGHT_PG=1).
+    columns: ColKeys a pedir (parámetro "columns" de Reports API) en vez de las columnas por
+    defecto. Si la respuesta no trae alguna, se vuelve a pedir con las columnas por defecto.
     """
-    print("QBO DEBUG -> ENV:", QBO_ENV, "BASE:", _api_base(), "realm:", realm_id, "report:", report_name, "params:", params)
+    if columns:
+        data = _get_report(access_token, realm_id, report_name, use_cache,
+                           dict(params, columns=",".join(columns)))
+        missing = set(columns) - set(report_col_keys(data))
+        if not missing:
+            return data
+        print("QBO COLUMNS ->", report_name, "sin:", sorted(missing), "(columnas por defecto)")
 
-    url = f"{_api_base()}/v3/company/{realm_id}/reports/{report_name}"
+    return _get_report(access_token, realm_id, report_name, use_cache, params)
 
+
+def _get_report(access_token: str, realm_id: str, report_name: str, use_cache: bool, params: dict) -> dict:
     # minorversion siempre
     params = {k: v for k, v in params.items() if v is not None}
     params["minorversion"] = QBO_MINORVERSION
 
+    cache_key = report_cache_key(realm_id, report_name, params)
+    if use_cache:
+        body = get_cached_report(cache_key, realm_id)
+        if body is not None:
+            return _decode_cached_report("report_cache", report_name, body)
+
+    def fetch():
+        if not REPORT_SINGLEFLIGHT_PG:
+            return _fetch_report(access_token, realm_id, report_name, params, cache_key)
+        with report_fetch_lock(cache_key) as requested_at:
+            # Otro worker pudo traerlo mientras esperábamos el lock
+            body = get_cached_report(cache_key, realm_id, newer_than=None if use_cache else requested_at)
+            if body is not None:
+                return body, None
+            return _fetch_report(access_token, realm_id, report_name, params, cache_key)
+
+    (body, data), shared = _report_flights.do(cache_key, fetch)
+    if body is None:
+        # Líder en stream que no pudo compartir el body (ver stream_report)
+        return _fetch_report(access_token, realm_id, report_name, params, cache_key)[1]
+    if shared or data is None:
+        # Cada caller recibe su propia copia (los dicts del reporte se modifican aguas abajo)
+        return _decode_cached_report("report_shared", report_name, body)
+    return data
+
+
+def stream_report(access_token: str, realm_id: str, report_name: str, use_cache: bool = True,
+                  columns=None, **params) -> ReportRowStream:
+    """
+    Igual que get_report + parse_report_to_table, pero las filas salen a medida que llega el
+    body (ReportRowStream). Cache hit: se parsea el body guardado.
+    El GET en stream pasa por el mismo SingleFlight / lock PG que get_report; el body se copia
+    (hasta REPORT_STREAM_CACHE_MAX_BYTES) a report_cache y a las llamadas idénticas que esperan.
+    Si la conexión se corta antes de la primera fila, se vuelve a pedir.
+    """
+    params = {k: v for k, v in params.items() if v is not None}
+    params["minorversion"] = QBO_MINORVERSION
+    if columns:
+        params["columns"] = ",".join(columns)
+
+    cache_key = report_cache_key(realm_id, report_name, params)
+    stream = _open_report_stream(access_token, realm_id, report_name, params, cache_key, use_cache)
+
+    if columns:
+        stream.read_columns()
+        missing = set(columns) - set(stream.col_keys)
+        if missing:
+            stream.close()
+            print("QBO COLUMNS ->", report_name, "sin:", sorted(missing), "(columnas por defecto)")
+            params.pop("minorversion")
+            params.pop("columns")
+            return stream_report(access_token, realm_id, report_name, use_cache=use_cache, **params)
+    return stream
+
+
+def _open_report_stream(access_token: str, realm_id: str, report_name: str, params: dict, cache_key: str,
+                        use_cache: bool) -> ReportRowStream:
+    if use_cache:
+        body = get_cached_report(cache_key, realm_id)
+        if body is not None:
+            return ReportRowStream((body,))
+
+    future, leader = _report_flights.claim(cache_key)
+    if not leader:
+        body, _ = future.result()
+        if body is not None:
+            return ReportRowStream((body,))
+        # El líder no pudo compartir el body (muy grande o cortado): GET propio
+        future = None
+    return _StreamedReportFetch(access_token, realm_id, report_name, params, cache_key, use_cache, future).open()
+
+
+class _StreamedReportFetch:
+    """
+    GET de un reporte en stream. Al terminar (o cortarse / abandonarse) resuelve el
+    SingleFlight con (body, None) -- body=None si no se pudo guardar -- y suelta el lock PG.
+    """
+
+    def __init__(self, access_token: str, realm_id: str, report_name: str, params: dict, cache_key: str,
+                 use_cache: bool, flight):
+        self.access_token = access_token
+        self.realm_id = realm_id
+        self.report_name = report_name
+        self.params = params
+        self.cache_key = cache_key
+        self.use_cache = use_cache
+        self.flight = flight
+        self._locks = ExitStack()
+        self._finished = False
+        self._attempts = 0
+
+    def open(self) -> ReportRowStream:
+        try:
+            if REPORT_SINGLEFLIGHT_PG:
+                requested_at = self._locks.enter_context(report_fetch_lock(self.cache_key))
+                # Otro worker pudo traerlo mientras esperábamos el lock
+                body = get_cached_report(self.cache_key, self.realm_id,
+                                         newer_than=None if self.use_cache else requested_at)
+                if body is not None:
+                    self._finish(body)
+                    return ReportRowStream((body,))
+            chunks = self._open_chunks()
+        except BaseException as e:
+            self._finish(None, e)
+            raise
+        return ReportRowStream(chunks, reopen=self._open_chunks, retry_on=_STREAM_RETRY_ERRORS,
+                               max_retries=QBO_MAX_RETRIES, on_close=lambda: self._finish(None))
+
+    def _open_chunks(self):
+        if self._attempts:
+            time.sleep(_backoff_seconds(self._attempts - 1))
+        self._attempts += 1
+        print("QBO DEBUG -> ENV:", QBO_ENV, "BASE:", _api_base(), "realm:", self.realm_id, "report:", self.report_name,
+              "params:", self.params, "(stream)")
+        r = _request("GET", _company_url(self.realm_id, f"reports/{self.report_name}"), self.access_token,
+                     params=self.params, stream=True)
+        if r.status_code >= 400:
+            text = r.text
+            r.close()
+            raise RuntimeError(f"QBO report '{self.report_name}' failed ({r.status_code}): {text}")
+        return self._iter_body(r)
+
+    def _iter_body(self, r: requests.Response):
+        t0 = time.perf_counter()
+        total = 0
+        buf = bytearray()
+        try:
+            for chunk in r.iter_content(QBO_REPORT_STREAM_CHUNK_BYTES):
+                total += len(chunk)
+                if buf is not None:
+                    buf += chunk
+                    if len(buf) > REPORT_STREAM_CACHE_MAX_BYTES:
+                        buf = None
+                        self._finish(None)
+                yield chunk
+        finally:
+            wire = _wire_bytes(r)
+            r.close()
+            record_transfer("report_stream", self.report_name, wire, total, (time.perf_counter() - t0) * 1000)
+
+        if buf is not None:
+            body = bytes(buf)
+            # Sólo respuestas válidas (Fault con 200 llega al inicio del body)
+            if b'"Fault"' not in body[:64]:
+                store_report(self.cache_key, self.realm_id, self.report_name, self.params, body)
+            self._finish(body)
+
+    def _finish(self, body: bytes | None, exception: BaseException | None = None):
+        if self._finished:
+            return
+        self._finished = True
+        try:
+            self._locks.close()
+        finally:
+            if self.flight is not None:
+                _report_flights.resolve(self.cache_key, self.flight, result=(body, None), exception=exception)
+
+
+def _fetch_report(access_token: str, realm_id: str, report_name: str, params: dict, cache_key: str) -> tuple[bytes, dict]:
+    print("QBO DEBUG -> ENV:", QBO_ENV, "BASE:", _api_base(), "realm:", realm_id, "report:", report_name, "params:", params)
+
+    url = _company_url(realm_id, f"reports/{report_name}")
+
     r = _request("GET", url, access_token, params=params)
     if r.status_code >= 400:
         raise RuntimeError(f"QBO report '{report_name}' failed ({r.status_code}): {r.text}")
-    return r.json()
+    data = _decode_json(r, "report", report_name)
+    # Sólo respuestas válidas (Fault con 200 también llega como JSON, pero sin "Rows")
+    if "Fault" not in data:
+        store_report(cache_key, realm_id, report_name, params, r.content)
+    return r.content, data
 
 def qbo_get(access_token: str, realm_id: str, path: str, params: dict | None = None) -> dict:
-    url = f"{_api_base()}/v3/company/{realm_id}/{path.lstrip('/')}"
+    url = _company_url(realm_id, path)
     params = params or {}
     params["minorversion"] = QBO_MINORVERSION
     r = _request("GET", url, access_token, params=params)
@@ -197,37 +870,164 @@ def qbo_get(access_token: str, realm_id: str, path: str, params: dict | None = N
     return r.json()
 
 
+def get_cdc(access_token: str, realm_id: str, entities, changed_since: datetime) -> tuple[dict, datetime | None]:
+    """
+    Change Data Capture: objetos de `entities` creados/modificados/borrados desde changed_since
+    (QBO acepta hasta 30 días atrás y devuelve máx. 1000 objetos por entidad).
+    Retorna ({entity: [obj, ...]}, hora del servidor de QBO de la respuesta).
+    Los borrados vienen como {"Id": ..., "status": "Deleted"}.
+    """
+    url = _company_url(realm_id, "cdc")
+    params = {
+        "entities": ",".join(entities),
+        "changedSince": changed_since.astimezone(timezone.utc).isoformat(timespec="seconds"),
+        "minorversion": QBO_MINORVERSION,
+    }
+    r = _request("GET", url, access_token, realm_id=realm_id, params=params)
+    if r.status_code >= 400:
+        raise RuntimeError(f"QBO cdc failed ({r.status_code}): {r.text}")
+    data = _decode_json(r, "cdc", params["entities"])
+
+    out = {entity: [] for entity in entities}
+    for cdc in data.get("CDCResponse") or []:
+        for qr in cdc.get("QueryResponse") or []:
+            for entity in entities:
+                out[entity].extend(qr.get(entity) or [])
+
+    server_time = None
+    try:
+        server_time = datetime.fromisoformat(data["time"])
+    except (KeyError, TypeError, ValueError):
+        pass
+    return out, server_time
+
+
 def get_all_vendors_map(access_token: str, realm_id: str, max_per_page: int = 1000) -> dict:
     """
     Devuelve {displayname_lower: vendor_id} trayendo TODOS los vendors.
     Evita hacer 1 query por vendor.
     """
     out = {}
-    start = 1
 
-    while True:
-        q = f"SELECT Id, DisplayName FROM Vendor STARTPOSITION {start} MAXRESULTS {max_per_page}"
-        data = qbo_query(q, access_token, realm_id)
-        vendors = data.get("QueryResponse", {}).get("Vendor", []) or []
+    for v in iter_query(access_token, realm_id, "Vendor", "Id, DisplayName", page_size=max_per_page):
+        dn = (v.get("DisplayName") or "").strip()
+        if dn:
+            out[dn.lower()] = v.get("Id")
 
-        for v in vendors:
-            dn = (v.get("DisplayName") or "").strip()
-            if dn:
-                out[dn.lower()] = v.get("Id")
+    return out
 
-        if len(vendors) < max_per_page:
-            break
 
-        start += max_per_page
+# -------------------------
+# ✅ Directorio de vendors (1 pasada: nombre + RUC|DV + Otro + Notes)
+# -------------------------
+def normalize_vendor_key(s: str) -> str:
+    """
+    Llave de búsqueda por nombre: html unescape + espacios colapsados + lower.
+    """
+    s = html.unescape((s or "").strip())
+    s = re.sub(r"\s+", " ", s)
+    return s.lower().strip()
+
 
-    return out
+def split_ruc_dv_from_display(display_name: str) -> tuple[str, str]:
+    """
+    From vendor DisplayName like:
+    "ABOLU, S.A/2/16429-109-156121/61"
+    returns ("16429-109-156121", "61")
+    """
+    dn = html.unescape((display_name or "").strip())
+    m = re.match(r"^(.+?)/([123])/([^/]+)/([^/]+)\s*$", dn)
+    if not m:
+        return ("", "")
+    return ((m.group(3) or "").strip(), (m.group(4) or "").strip())
+
+
+def rucdv_key(ruc: str, dv: str) -> str:
+    return f"{(ruc or '').strip().upper()}|{(dv or '').strip().upper()}"
+
+
+def vendor_directory_record(v: dict) -> dict:
+    display_name = (v.get("DisplayName") or "").strip()
+    ruc, dv = split_ruc_dv_from_display(display_name)
+    # "Otro": AlternatePhone (UI) y, si no, CustomField 'Otro' (mismo criterio que extract_vendor_otro)
+    other = vendor_other_value(v) or extract_vendor_otro({"Vendor": {"CustomField": v.get("CustomField")}})
+    return {
+        "id": str(v.get("Id") or ""),
+        "display_name": display_name,
+        "name_key": normalize_vendor_key(display_name),
+        "ruc": ruc,
+        "dv": dv,
+        "other": other,
+        "notes": (v.get("Notes") or "").strip(),
+    }
+
+
+VENDOR_DIRECTORY_FIELDS = "Id, DisplayName, AlternatePhone, Notes, CustomField"
+
+
+def get_vendor_directory(access_token: str, realm_id: str, max_per_page: int = 1000) -> dict:
+    """
+    Trae TODOS los vendors con Id, DisplayName, AlternatePhone, Notes, CustomField en el mismo
+    SELECT paginado y devuelve índices listos para el INFORME 43:
+      {
+        "by_id":    {vendor_id: record},
+        "by_name":  {normalize_vendor_key(DisplayName): record},
+        "by_rucdv": {rucdv_key(ruc, dv): record},
+      }
+    record = {"id", "display_name", "name_key", "ruc", "dv", "other", "notes"}
+    Con esto no hace falta pedir el detalle de cada vendor por ID.
+    """
+    directory = new_vendor_directory()
+
+    for v in iter_query(access_token, realm_id, "Vendor", VENDOR_DIRECTORY_FIELDS, page_size=max_per_page):
+        add_to_vendor_directory(directory, vendor_directory_record(v))
+
+    return directory
+
+
+def new_vendor_directory() -> dict:
+    return {"by_id": {}, "by_name": {}, "by_rucdv": {}}
+
+
+def add_to_vendor_directory(directory: dict, rec: dict):
+    if not rec.get("id"):
+        return
+    directory["by_id"][rec["id"]] = rec
+    if rec["name_key"]:
+        directory["by_name"][rec["name_key"]] = rec
+    if rec["ruc"] and rec["dv"]:
+        directory["by_rucdv"][rucdv_key(rec["ruc"], rec["dv"])] = rec
+
+
+def find_vendor_in_directory(directory: dict, nombre_raw: str = "", nombre: str = "", ruc: str = "", dv: str = "") -> dict | None:
+    """
+    Resuelve un vendor del reporte: 1) por RUC|DV, 2) por DisplayName completo, 3) por nombre limpio.
+    """
+    rec = None
+    if ruc and dv:
+        rec = directory["by_rucdv"].get(rucdv_key(ruc, dv))
+    if not rec and nombre_raw:
+        rec = directory["by_name"].get(normalize_vendor_key(nombre_raw))
+    if not rec and nombre:
+        rec = directory["by_name"].get(normalize_vendor_key(nombre))
+    return rec
 
 
-def get_vendor_notes_by_ids(access_token, realm_id, vendor_ids, timeout=30):
+def _vendor_fetch_workers(ids: list[str], concurrency: int | None = None) -> int:
+    """
+    GETs por ID en paralelo (máx QBO_MAX_CONCURRENCY). > 1 corre como corutinas en qbo_async;
+    cada request pasa por el mismo throttle del realm (concurrencia + token bucket + reintentos).
+    """
+    workers = QBO_VENDOR_FETCH_CONCURRENCY if concurrency is None else concurrency
+    return max(1, min(int(workers), QBO_MAX_CONCURRENCY, len(ids) or 1))
+
+
+def get_vendor_notes_by_ids(access_token, realm_id, vendor_ids, timeout=None, concurrency=None):
     """
     Retorna {vendor_id: value} leyendo Vendor por ID:
     - Primero intenta "Otro" = Vendor.AlternatePhone.FreeFormNumber
     - Si no existe, fallback a Vendor.Notes
+    concurrency: GETs en paralelo (None = QBO_VENDOR_FETCH_CONCURRENCY, 1 = secuencial)
     """
     if not vendor_ids:
         return {}
@@ -235,58 +1035,153 @@ def get_vendor_notes_by_ids(access_token, realm_id, vendor_ids, timeout=30):
     ids = [str(x).strip() for x in vendor_ids if str(x).strip()]
     ids = list(dict.fromkeys(ids))  # unique
 
-    base = "https://quickbooks.api.intuit.com"
-    out = {}
+    workers = _vendor_fetch_workers(ids, concurrency)
+    if workers > 1:
+        import qbo_async  # import diferido: qbo_async importa este módulo
+        return qbo_async.fetch_vendor_other_by_ids(access_token, realm_id, ids, notes_fallback=True,
+                                                   concurrency=workers, timeout=timeout)
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-    }
+    def fetch_one(vid):
+        r = _request("GET", _company_url(realm_id, f"vendor/{vid}"), access_token, realm_id=realm_id, timeout=timeout)
 
-    for vid in ids:
-        url = f"{base}/v3/company/{realm_id}/vendor/{vid}"
-        r = requests.get(url, headers=headers, timeout=timeout)
+        # ✅ throttling / 5xx que persistió tras los reintentos: NO se convierte en "" (perdería el dato)
+        if _is_transient_status(r.status_code):
+            raise QBOTransientError(f"QBO vendor/{vid} failed ({r.status_code}): {r.text}")
 
         if r.status_code != 200:
-            out[vid] = ""
-            continue
+            return ""
 
         data = r.json() or {}
         v = (data.get("Vendor") or {})
 
-        # ✅ "OTRO" en UI te está quedando aquí (como en n8n):
-        other_val = ((v.get("AlternatePhone") or {}).get("FreeFormNumber") or "").strip()
+        # ✅ "OTRO" en UI te está quedando aquí (como en n8n), fallback a Notes
+        return vendor_other_value(v, notes_fallback=True)
 
-        # fallback si no hay AlternatePhone:
-        if not other_val:
-            other_val = (v.get("Notes") or "").strip()
+    return {vid: fetch_one(vid) for vid in ids}
 
-        out[vid] = other_val
-
-    return out
-
-def get_vendor_other_by_ids(access_token: str, realm_id: str, vendor_ids: list[str]) -> dict:
+def get_vendor_other_by_ids(access_token: str, realm_id: str, vendor_ids: list[str], concurrency: int | None = None) -> dict:
         """
         Devuelve {vendor_id: "2/1"} sacado de Vendor.AlternatePhone.FreeFormNumber (campo 'Otro')
+        concurrency: GETs en paralelo (None = QBO_VENDOR_FETCH_CONCURRENCY, 1 = secuencial)
         """
-        out = {}
-        base = f"https://quickbooks.api.intuit.com/v3/company/{realm_id}/vendor/"
-        headers = {"Authorization": f"Bearer {access_token}", "Accept": "application/json"}
+        ids = list(dict.fromkeys(str(vid) for vid in (vendor_ids or [])))
 
-        for vid in vendor_ids:
-            try:
-                r = requests.get(base + str(vid), headers=headers, timeout=30)
-                if r.status_code != 200:
-                    out[str(vid)] = ""
-                    continue
+        workers = _vendor_fetch_workers(ids, concurrency)
+        if workers > 1:
+            import qbo_async  # import diferido: qbo_async importa este módulo
+            return qbo_async.fetch_vendor_other_by_ids(access_token, realm_id, ids, concurrency=workers)
 
+        def fetch_one(vid):
+            r = _request("GET", _company_url(realm_id, f"vendor/{vid}"), access_token, realm_id=realm_id)
+            if _is_transient_status(r.status_code):
+                raise QBOTransientError(f"QBO vendor/{vid} failed ({r.status_code}): {r.text}")
+            if r.status_code != 200:
+                return ""
+
+            try:
                 vendor = (r.json() or {}).get("Vendor") or {}
-                other = ((vendor.get("AlternatePhone") or {}).get("FreeFormNumber") or "").strip()
-                out[str(vid)] = other
-            except:
-                out[str(vid)] = ""
+            except (KeyError, ValueError):
+                return ""
+            return vendor_other_value(vendor)
 
-        return out
+        return {vid: fetch_one(vid) for vid in ids}
+
+
+# -------------------------
+# ✅ Batch API: hasta 30 operaciones por POST
+# -------------------------
+QBO_BATCH_MAX_ITEMS = 30
+
+
+def qbo_batch(access_token: str, realm_id: str, items: list[dict]) -> list[dict]:
+    """
+    POST /v3/company/{realm_id}/batch con BatchItemRequest (máx QBO_BATCH_MAX_ITEMS).
+    Devuelve BatchItemResponse tal cual (cada item trae su bId y QueryResponse o Fault).
+    """
+    if len(items) > QBO_BATCH_MAX_ITEMS:
+        raise ValueError(f"QBO batch admite máximo {QBO_BATCH_MAX_ITEMS} operaciones ({len(items)} recibidas).")
+
+    url = _company_url(realm_id, "batch")
+    params = {"minorversion": QBO_MINORVERSION}
+    r = _request("POST", url, access_token, realm_id=realm_id, params=params, json={"BatchItemRequest": items})
+    if _is_transient_status(r.status_code):
+        raise QBOTransientError(f"QBO batch failed ({r.status_code}): {r.text}")
+    if r.status_code >= 400:
+        raise RuntimeError(f"QBO batch failed ({r.status_code}): {r.text}")
+    return (r.json() or {}).get("BatchItemResponse") or []
+
+
+def vendor_other_value(vendor: dict, notes_fallback: bool = False) -> str:
+    """
+    "Otro" del vendor = Vendor.AlternatePhone.FreeFormNumber (así queda en la UI de QBO).
+    Con notes_fallback=True, si no hay AlternatePhone usa Vendor.Notes.
+    """
+    vendor = vendor or {}
+    other = ((vendor.get("AlternatePhone") or {}).get("FreeFormNumber") or "").strip()
+    if not other and notes_fallback:
+        other = (vendor.get("Notes") or "").strip()
+    return other
+
+
+def get_vendors_by_ids_batch(access_token: str, realm_id: str, vendor_ids) -> dict:
+    """
+    Devuelve {vendor_id: Vendor dict} usando Batch API: 1 POST por cada 30 vendors
+    en vez de 1 GET por vendor. Los IDs que fallan o no existen no aparecen en el dict.
+    Incluye vendors inactivos (el query por defecto sólo trae Active = true; el GET por ID sí los traía).
+    """
+    return _batch_vendors(access_token, realm_id, vendor_ids)[0]
+
+
+def _batch_vendors(access_token: str, realm_id: str, vendor_ids) -> tuple[dict, list[str]]:
+    # ({vendor_id: Vendor}, IDs cuyo item / POST falló); los que no existen no están en ninguno
+    ids = [str(x).strip() for x in (vendor_ids or []) if str(x).strip()]
+    ids = [x for x in dict.fromkeys(ids) if x.isdigit()]  # unique + solo IDs numéricos (van dentro del query)
+
+    out, failed = {}, []
+    for i in range(0, len(ids), QBO_BATCH_MAX_ITEMS):
+        chunk = ids[i:i + QBO_BATCH_MAX_ITEMS]
+        items = [{"bId": vid, "Query": f"SELECT * FROM Vendor WHERE Id = '{vid}' AND Active IN (true, false)"} for vid in chunk]
+
+        try:
+            responses = qbo_batch(access_token, realm_id, items)
+        except QBOTransientError:
+            raise
+        except Exception as e:
+            print("QBO BATCH ERROR -> realm:", realm_id, "ids:", chunk, repr(e))
+            failed.extend(chunk)
+            continue
+
+        answered = set()
+        for resp in responses:
+            answered.add(str(resp.get("bId")))
+            if resp.get("Fault"):
+                print("QBO BATCH FAULT -> bId:", resp.get("bId"), resp.get("Fault"))
+                failed.append(str(resp.get("bId")))
+                continue
+            vendors = (resp.get("QueryResponse") or {}).get("Vendor") or []
+            if vendors:
+                out[str(resp.get("bId"))] = vendors[0]
+        failed.extend(vid for vid in chunk if vid not in answered)
+
+    return out, failed
+
+
+def get_vendor_other_by_ids_batch(access_token: str, realm_id: str, vendor_ids, notes_fallback: bool = False) -> dict:
+    """
+    Mismo resultado que get_vendor_other_by_ids / get_vendor_notes_by_ids ({vendor_id: "2/1"},
+    "" si falla), pero resolviendo ~N/30 llamadas con Batch API.
+    - notes_fallback=True  -> mismo criterio que get_vendor_notes_by_ids (Notes si no hay Otro)
+    - notes_fallback=False -> mismo criterio que get_vendor_other_by_ids
+    Los items del batch que fallan se reintentan por ID, en paralelo (get_vendor_*_by_ids).
+    """
+    ids = list(dict.fromkeys(str(x).strip() for x in (vendor_ids or []) if str(x).strip()))
+    vendors, failed = _batch_vendors(access_token, realm_id, ids)
+    out = {vid: vendor_other_value(vendors.get(vid), notes_fallback) for vid in ids}
+
+    if failed:
+        by_id = get_vendor_notes_by_ids if notes_fallback else get_vendor_other_by_ids
+        out.update(by_id(access_token, realm_id, failed) or {})
+    return out
 
 
 
@@ -300,7 +1195,30 @@ def get_profit_and_loss_detail(
     end_date: str,
     accounting_method: str = "Accrual",
     customer_id: str | None = None,
+    use_cache: bool = True,
+    columns=None,
 ) -> dict:
+    params = _pnl_detail_params(start_date, end_date, accounting_method, customer_id)
+    return get_report_chunked(access_token, realm_id, "ProfitAndLossDetail", use_cache=use_cache, columns=columns,
+                              **params)
+
+
+def stream_profit_and_loss_detail(
+    access_token: str,
+    realm_id: str,
+    start_date: str,
+    end_date: str,
+    accounting_method: str = "Accrual",
+    customer_id: str | None = None,
+    use_cache: bool = True,
+    columns=None,
+) -> ReportRowStream:
+    params = _pnl_detail_params(start_date, end_date, accounting_method, customer_id)
+    return stream_report_range(access_token, realm_id, "ProfitAndLossDetail", use_cache=use_cache, columns=columns,
+                               **params)
+
+
+def _pnl_detail_params(start_date: str, end_date: str, accounting_method: str, customer_id: str | None) -> dict:
     params = {
         "start_date": start_date,
         "end_date": end_date,
@@ -308,8 +1226,7 @@ def get_profit_and_loss_detail(
     }
     if customer_id and customer_id != "all":
         params["customer"] = customer_id
-
-    return get_report(access_token, realm_id, "ProfitAndLossDetail", **params)
+    return params
 
 
 
@@ -319,8 +1236,358 @@ def get_vat_tax_detail(
     realm_id: str,
     start_date: str,
     end_date: str,
+    use_cache: bool = True,
+    columns=None,
 ) -> dict:
-    return get_report(access_token, realm_id, "TaxDetail", start_date=start_date, end_date=end_date)
+    return get_report_chunked(access_token, realm_id, "TaxDetail", start_date, end_date, use_cache=use_cache,
+                              columns=columns)
+
+
+def stream_vat_tax_detail(
+    access_token: str,
+    realm_id: str,
+    start_date: str,
+    end_date: str,
+    use_cache: bool = True,
+    columns=None,
+) -> ReportRowStream:
+    return stream_report_range(access_token, realm_id, "TaxDetail", start_date, end_date, use_cache=use_cache,
+                               columns=columns)
+
+
+# -------------------------
+# ✅ Montos: parser canónico
+# -------------------------
+def parse_amount(value) -> float | None:
+    """
+    "1,234.56" / "(1,234.56)" / "1234.56-" / "−12.00" (menos unicode) / "$ 12" -> float.
+    "" o texto no numérico -> None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    s = str(value).strip()
+    if not s:
+        return None
+
+    negative = False
+    if s.startswith("(") and s.endswith(")"):
+        negative, s = True, s[1:-1].strip()
+    s = s.replace("\u2212", "-").replace("\u2013", "-")
+    if s.endswith("-"):
+        negative, s = not negative, s[:-1].strip()
+    if s.startswith("-"):
+        negative, s = not negative, s[1:].strip()
+    s = s.replace(",", "").replace("$", "").replace("B/.", "").replace(" ", "")
+
+    try:
+        n = float(s)
+    except ValueError:
+        return None
+    return -n if negative else n
+
+
+def parse_report_date(value) -> int | None:
+    """
+    Fecha de una celda -> AAAAMMDD como int (None si no es fecha).
+    "2024-01-31" (lo que manda Reports API) va por el camino rápido sin strptime;
+    "01/31/2024", "31/01/2024" y "20240131" también se aceptan.
+    """
+    s = str(value or "").strip()
+    if len(s) == 10 and s[4] == "-" and s[7] == "-":
+        digits = s[:4] + s[5:7] + s[8:10]
+        # días 29-31 se validan con strptime (meses cortos / bisiestos)
+        if digits.isdigit() and 1 <= int(s[5:7]) <= 12 and 1 <= int(s[8:10]) <= 28:
+            return int(digits)
+    if len(s) == 8 and s.isdigit():
+        return int(s)
+    for fmt in ("%Y-%m-%d", "%m/%d/%Y", "%d/%m/%Y"):
+        try:
+            d = datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+        return d.year * 10000 + d.month * 100 + d.day
+    return None
+
+
+def format_amount(n: float) -> str:
+    # Mismo formato que manda QBO en ColData ("1234.50")
+    return f"{n:.2f}"
+
+
+# -------------------------
+# ✅ Reportes por tramos de fechas (en paralelo) + merge
+# -------------------------
+def split_date_range(start_date: str, end_date: str) -> list[tuple[str, str]]:
+    """
+    [(inicio, fin), ...] por mes calendario; el primero y el último respetan el rango pedido.
+    """
+    start = datetime.strptime(start_date, "%Y-%m-%d").date()
+    end = datetime.strptime(end_date, "%Y-%m-%d").date()
+    out = []
+    cur = start
+    while cur <= end:
+        next_month = (cur.replace(day=1) + timedelta(days=32)).replace(day=1)
+        chunk_end = min(end, next_month - timedelta(days=1))
+        out.append((cur.isoformat(), chunk_end.isoformat()))
+        cur = chunk_end + timedelta(days=1)
+    return out
+
+
+def report_windows(start_date: str, end_date: str, chunking: str | None = None) -> list[tuple[str, str]]:
+    """
+    Tramos en los que get_report_chunked partiría el rango (1 tramo = una sola llamada).
+    """
+    mode = (chunking or QBO_REPORT_CHUNKING or "off").lower()
+    if mode not in ("month", "adaptive"):
+        return [(start_date, end_date)]
+    return split_date_range(start_date, end_date)
+
+
+def stream_report_range(access_token: str, realm_id: str, report_name: str, start_date: str, end_date: str,
+                        use_cache: bool = True, columns=None, **params) -> ReportRowStream:
+    """
+    Filas del reporte para el rango: un solo tramo -> stream del body (stream_report);
+    varios tramos -> get_report_chunked y recorrido del JSON unido.
+    """
+    if QBO_REPORT_STREAMING and len(report_windows(start_date, end_date)) <= 1:
+        return stream_report(access_token, realm_id, report_name, use_cache=use_cache, columns=columns,
+                             start_date=start_date, end_date=end_date, **params)
+    return ReportRowStream.from_report_json(
+        get_report_chunked(access_token, realm_id, report_name, start_date, end_date, use_cache=use_cache,
+                           columns=columns, **params)
+    )
+
+
+def _split_window(start_date: str, end_date: str) -> list[tuple[str, str]]:
+    start = datetime.strptime(start_date, "%Y-%m-%d").date()
+    end = datetime.strptime(end_date, "%Y-%m-%d").date()
+    mid = start + (end - start) // 2
+    return [(start.isoformat(), mid.isoformat()), ((mid + timedelta(days=1)).isoformat(), end.isoformat())]
+
+
+def count_report_data_rows(report_json: dict) -> int:
+    def walk(node) -> int:
+        n = 0
+        for r in ((node or {}).get("Row") or []):
+            if r.get("ColData"):
+                n += 1
+            n += walk(r.get("Rows"))
+        return n
+    return walk(report_json.get("Rows"))
+
+
+def get_report_chunked(access_token: str, realm_id: str, report_name: str, start_date: str, end_date: str,
+                       use_cache: bool = True, chunking: str | None = None, **params) -> dict:
+    """
+    Igual que get_report(start_date, end_date) pero, si el rango pasa de un mes, lo pide por
+    meses EN PARALELO (corutinas de qbo_async; cada tramo pasa por el mismo cache / coalescing /
+    throttle que get_report) y une las respuestas con merge_report_json. El rango total tarda
+    ~ lo que el mes más lento.
+      chunking="adaptive": además parte en mitades los tramos con >= QBO_REPORT_CHUNK_MAX_ROWS filas.
+    """
+    mode = (chunking or QBO_REPORT_CHUNKING or "off").lower()
+    windows = report_windows(start_date, end_date, mode)
+    if len(windows) <= 1:
+        return get_report(access_token, realm_id, report_name, use_cache=use_cache,
+                          start_date=start_date, end_date=end_date, **params)
+
+    import qbo_async  # import diferido: qbo_async importa este módulo
+
+    results: dict[tuple[str, str], dict] = {}
+    pending = windows
+    while pending:
+        reports = qbo_async.fetch_reports(access_token, realm_id, [
+            (report_name, dict(params, start_date=window[0], end_date=window[1])) for window in pending
+        ], use_cache=use_cache)
+        fetched = dict(zip(pending, reports))
+        pending = []
+        for window, data in fetched.items():
+            # Fault con 200: no se une como un mes vacío (faltaría ese tramo sin avisar)
+            if "Fault" in data:
+                raise RuntimeError(f"QBO report fault ({report_name} {window[0]}..{window[1]}): {data['Fault']}")
+            if (mode == "adaptive" and window[0] < window[1]
+                    and count_report_data_rows(data) >= QBO_REPORT_CHUNK_MAX_ROWS):
+                pending.extend(_split_window(*window))
+            else:
+                results[window] = data
+
+    ordered = [results[w] for w in sorted(results)]
+    print("QBO CHUNKS ->", report_name, "realm:", realm_id, start_date, end_date, "tramos:", len(ordered))
+    return merge_report_json(ordered, start_date, end_date)
+
+
+def _running_balance_columns(report_json: dict) -> set[int]:
+    """
+    Columnas de saldo acumulado (P&L Detail: ColKey rbal_nat_amount / "Saldo" / "Balance").
+    """
+    out = set()
+    cols = (report_json.get("Columns") or {}).get("Column") or []
+    for i, (c, key) in enumerate(zip(cols, report_col_keys(report_json))):
+        title = (c.get("ColTitle") or "").strip().lower()
+        if key.startswith("rbal") or title in ("saldo", "balance"):
+            out.add(i)
+    return out
+
+
+def _section_key(row: dict) -> tuple:
+    """
+    Identidad de una sección entre tramos: group + primera celda del Header (con su id de cuenta).
+    """
+    head = ((row.get("Header") or {}).get("ColData") or [{}])[0]
+    if not row.get("Header"):
+        head = ((row.get("Summary") or {}).get("ColData") or [{}])[0]
+    return ("section", row.get("group") or "", head.get("id") or "", (head.get("value") or "").strip())
+
+
+def _is_section(row: dict) -> bool:
+    return any(k in row for k in ("Header", "Rows", "Summary"))
+
+
+def merge_report_json(reports: list[dict], start_date: str, end_date: str) -> dict:
+    """
+    Une respuestas de un mismo reporte por tramos consecutivos:
+      - secciones con la misma identidad se funden (el orden respeta el de cada tramo)
+      - filas de datos: en orden de tramo (cronológico)
+      - Summary: columnas Money sumadas; texto = el primero no vacío
+      - columnas de saldo acumulado: cada tramo arranca en 0 -> se le suma lo arrastrado
+    """
+    if len(reports) == 1:
+        return reports[0]
+
+    base = next((r for r in reports if (r.get("Rows") or {}).get("Row")), reports[0])
+    col_types = [(c.get("ColType") or "").strip() for c in (base.get("Columns") or {}).get("Column") or []]
+    balance_cols = _running_balance_columns(base)
+    money_cols = {i for i, t in enumerate(col_types) if t == "Money"} - balance_cols
+
+    def merged_cells(coldatas: list[list[dict]]) -> list[dict]:
+        width = max(len(cd) for cd in coldatas)
+        out = []
+        for i in range(width):
+            values = [cd[i] for cd in coldatas if i < len(cd)]
+            cell = dict(values[0])
+            if i in money_cols:
+                nums = [parse_amount(v.get("value")) for v in values]
+                if any(n is not None for n in nums):
+                    cell["value"] = format_amount(sum(n for n in nums if n is not None))
+            elif i in balance_cols:
+                cell = dict(values[-1])
+            else:
+                cell = dict(next((v for v in values if (v.get("value") or "").strip()), values[0]))
+            out.append(cell)
+        return out
+
+    def shift_balances(row: dict, carry: float) -> dict:
+        if not carry or not balance_cols:
+            return row
+        row = dict(row)
+        cols = [dict(c) for c in row.get("ColData") or []]
+        for i in balance_cols:
+            if i < len(cols):
+                n = parse_amount(cols[i].get("value"))
+                if n is not None:
+                    cols[i]["value"] = format_amount(n + carry)
+        row["ColData"] = cols
+        return row
+
+    def last_balance(rows: list[dict]) -> float | None:
+        for r in reversed(rows):
+            if r.get("ColData") and not _is_section(r):
+                for i in balance_cols:
+                    if i < len(r["ColData"]):
+                        n = parse_amount(r["ColData"][i].get("value"))
+                        if n is not None:
+                            return n
+        return None
+
+    def merge_rows(row_lists: list[list[dict]]) -> list[dict]:
+        """
+        Orden = lista doblemente enlazada de nodos: una sección (por su llave) o una tanda de
+        filas de datos consecutivas de un tramo. Insertar es O(1) (sin index/insert por fila).
+        """
+        head, tail = ("head",), ("tail",)
+        nxt, prv = {head: tail}, {tail: head}
+        groups: dict = {}   # llave de sección -> ocurrencias
+        runs: dict = {}     # nodo de datos -> filas
+
+        def insert_after(anchor, node):
+            after = nxt[anchor]
+            nxt[anchor], prv[node], nxt[node], prv[after] = node, anchor, after, node
+
+        def last_node(kind: str):
+            # recorre nodos (secciones / tandas), no filas
+            node = prv[tail]
+            while node is not head and node[0] != kind:
+                node = prv[node]
+            return node
+
+        for chunk_idx, rows in enumerate(row_lists):
+            prev = None
+            run = None
+            for r in rows:
+                if not _is_section(r):
+                    if run is None:
+                        if prev is None and last_node("data") is not head:
+                            # primeras filas del tramo: siguen a las de tramos anteriores
+                            run = last_node("data")
+                        else:
+                            run = ("data", chunk_idx, len(runs))
+                            runs[run] = []
+                            insert_after(prev if prev is not None else head, run)
+                        prev = run
+                    runs[run].append(r)
+                    continue
+
+                run = None
+                key = _section_key(r)
+                if key not in groups:
+                    groups[key] = []
+                    # sección nueva: después de lo último visto en este tramo, o de la última sección ya ubicada
+                    insert_after(prev if prev is not None else last_node("section"), key)
+                groups[key].append(r)
+                prev = key
+
+        out = []
+        node = nxt[head]
+        while node is not tail:
+            if node[0] == "section":
+                out.append(_merge_group(groups[node]))
+            else:
+                out.extend(runs[node])
+            node = nxt[node]
+        return out
+
+    def _merge_group(occurrences: list[dict]) -> dict:
+        merged = {k: v for k, v in occurrences[0].items() if k not in ("Rows", "Summary")}
+
+        # Filas directas: datos de cada tramo con su saldo corrido + secciones hijas fundidas
+        child_lists = []
+        carry = 0.0
+        for occ in occurrences:
+            rows = list(((occ.get("Rows") or {}).get("Row")) or [])
+            child_lists.append([shift_balances(r, carry) if not _is_section(r) else r for r in rows])
+            lb = last_balance(rows)
+            if lb is not None:
+                carry += lb
+        if any(child_lists):
+            rows_obj = dict(next((o["Rows"] for o in occurrences if o.get("Rows")), {}))
+            rows_obj["Row"] = merge_rows(child_lists)
+            merged["Rows"] = rows_obj
+
+        summaries = [o["Summary"].get("ColData") or [] for o in occurrences if o.get("Summary")]
+        if summaries:
+            merged["Summary"] = {**occurrences[0].get("Summary", {}), "ColData": merged_cells(summaries)}
+        return merged
+
+    out = dict(base)
+    out["Header"] = dict(base.get("Header") or {})
+    out["Header"]["StartPeriod"] = start_date
+    out["Header"]["EndPeriod"] = end_date
+    out["Rows"] = dict(base.get("Rows") or {})
+    out["Rows"]["Row"] = merge_rows([((r.get("Rows") or {}).get("Row")) or [] for r in reports])
+    return out
 
 
 
@@ -333,6 +1600,7 @@ def parse_report_to_table(report_json: dict) -> dict:
       {
         "columns": [..titulos..],
         "col_types": [..tipos..],
+        "col_keys": [..ColKey ("tx_date", "subt_nat_amount", ...)..],
         "rows": [
           {"level":0, "row_type":"Header|Data|Summary", "cells":[...], "is_header":bool, "is_summary":bool},
           ...
@@ -399,4 +1667,4 @@ def parse_report_to_table(report_json: dict) -> dict:
 
     walk(report_json.get("Rows", {}), 0)
 
-    return {"columns": col_titles, "col_types": col_types, "rows": out_rows}
+    return {"columns": col_titles, "col_types": col_types, "col_keys": report_col_keys(report_json), "rows": out_rows}
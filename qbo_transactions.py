@@ -0,0 +1,275 @@
+"""
+Fuente alternativa del Detalle de Pérdidas y Ganancias (INFORME 43) para periodos grandes:
+en vez de Reports API (lento y con límite de celdas en trimestres / años de clientes grandes)
+se leen las transacciones con queries paginadas y filtro de TxnDate.
+
+  Purchase      (en la API los "Expense", cheques y tarjeta de crédito son Purchase)
+  Bill
+  JournalEntry
+
+Cada entidad: COUNT(*) + páginas en paralelo (qbo_client.query_all); las tres entidades
+también en paralelo. El costo crece lineal con la cantidad de transacciones.
+
+Salida: el mismo JSON que Reports API ProfitAndLossDetail (Columns / Rows con secciones
+por grupo y por cuenta, Summary con totales y saldo acumulado), así que pasa por
+parse_report_to_table() y todo lo de aguas abajo (vista previa, snapshots, INFORME 43)
+funciona igual.
+
+Es un detalle SÓLO DE GASTOS: como no se leen Invoice / SalesReceipt / Deposit, no hay
+grupos de ingresos ni "Ingresos netos" (saldrían mal para cualquier cliente con ventas).
+Header.Option lo indica: Source = Transactions, Scope = Expenses.
+Otra diferencia con el reporte de QBO: las subcuentas salen planas (sin anidar bajo la
+cuenta madre).
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from qbo_client import query_all, iter_query, format_amount
+from entity_sync import get_synced_accounts
+
+# Grupos de gastos del P&L en el orden del reporte: (group de Reports API, título, tipos de cuenta)
+# (sin Income / OtherIncome: las ventas no se leen)
+PNL_GROUPS = (
+    ("COGS", "Costo de las ventas", ("Cost of Goods Sold",)),
+    ("Expenses", "Gastos", ("Expense",)),
+    ("OtherExpenses", "Otros gastos", ("Other Expense",)),
+)
+_GROUP_BY_ACCOUNT_TYPE = {t: g for g in PNL_GROUPS for t in g[2]}
+
+# Mismas columnas (título, tipo, ColKey) que ProfitAndLossDetail
+PNL_DETAIL_COLUMNS = (
+    ("Fecha", "Date", "tx_date"),
+    ("Tipo de transacción", "String", "txn_type"),
+    ("N.º", "String", "doc_num"),
+    ("Nombre", "String", "name"),
+    ("Nota", "String", "memo"),
+    ("Dividir", "String", "split_acc"),
+    ("Importe", "Money", "subt_nat_amount"),
+    ("Saldo", "Money", "rbal_nat_amount"),
+)
+
+TRANSACTION_QUERIES = {
+    "Purchase": "Id, TxnDate, DocNumber, EntityRef, AccountRef, PaymentType, Credit, PrivateNote, Line",
+    "Bill": "Id, TxnDate, DocNumber, VendorRef, APAccountRef, PrivateNote, Line",
+    "JournalEntry": "Id, TxnDate, DocNumber, PrivateNote, Line",
+}
+
+_IN_CHUNK = 100  # ids por "WHERE Id IN (...)"
+
+
+def _ref(obj: dict | None, field: str = "value") -> str:
+    return str(((obj or {}).get(field)) or "")
+
+
+def fetch_transactions(access_token: str, realm_id: str, start_date: str, end_date: str) -> dict:
+    """
+    {"Purchase": [...], "Bill": [...], "JournalEntry": [...]} con TxnDate dentro del rango.
+    """
+    where = f"TxnDate >= '{start_date}' AND TxnDate <= '{end_date}'"
+    with ThreadPoolExecutor(max_workers=len(TRANSACTION_QUERIES), thread_name_prefix="qbo-txn") as pool:
+        futures = {
+            entity: pool.submit(query_all, access_token, realm_id, entity, select, where)
+            for entity, select in TRANSACTION_QUERIES.items()
+        }
+        return {entity: f.result() for entity, f in futures.items()}
+
+
+def _lookup_by_ids(access_token: str, realm_id: str, entity: str, select: str, ids) -> list[dict]:
+    ids = sorted({i for i in ids if i})
+    out = []
+    for k in range(0, len(ids), _IN_CHUNK):
+        in_list = ", ".join(f"'{i}'" for i in ids[k:k + _IN_CHUNK])
+        out.extend(iter_query(access_token, realm_id, entity, select,
+                              f"Id IN ({in_list}) AND Active IN (true, false)", prefetch=False))
+    return out
+
+
+def account_type_map(access_token: str, realm_id: str, account_ids) -> dict:
+    """
+    account_id -> {"name", "type"}: cuentas del cache sincronizado; las que falten (p.ej.
+    inactivas) se piden por Id.
+    """
+    accounts = {str(a["id"]): {"name": a.get("name") or "", "type": a.get("type") or ""}
+                for a in get_synced_accounts(access_token, realm_id)}
+    missing = set(account_ids) - set(accounts)
+    for a in _lookup_by_ids(access_token, realm_id, "Account", "Id, Name, AccountType", missing):
+        accounts[str(a["Id"])] = {"name": a.get("Name") or "", "type": a.get("AccountType") or ""}
+    return accounts
+
+
+def _item_expense_accounts(access_token: str, realm_id: str, item_ids) -> dict:
+    # Líneas por item (ItemBasedExpenseLineDetail): la cuenta es la de gasto del item
+    items = _lookup_by_ids(access_token, realm_id, "Item", "Id, ExpenseAccountRef", item_ids)
+    return {str(i["Id"]): (i.get("ExpenseAccountRef") or {}) for i in items}
+
+
+def _purchase_type(txn: dict) -> str:
+    payment_type = txn.get("PaymentType") or ""
+    if payment_type == "Check":
+        return "Check"
+    if payment_type == "CreditCard":
+        return "Credit Card Credit" if txn.get("Credit") else "Expense"
+    return "Expense"
+
+
+def _posting_lines(transactions: dict, item_accounts: dict) -> list[dict]:
+    """
+    Una entrada por línea que afecta una cuenta:
+      {txn_type, txn_id, date, doc, name, memo, split, account_id, account_name, debit, customer_id}
+    debit = monto con signo contable (débito +, crédito -).
+    """
+    out = []
+
+    for kind in ("Purchase", "Bill"):
+        for txn in transactions.get(kind) or []:
+            if kind == "Purchase":
+                txn_type = _purchase_type(txn)
+                name = _ref(txn.get("EntityRef"), "name")
+                split = _ref(txn.get("AccountRef"), "name")
+                sign = -1 if txn.get("Credit") else 1
+            else:
+                txn_type = "Bill"
+                name = _ref(txn.get("VendorRef"), "name")
+                split = _ref(txn.get("APAccountRef"), "name") or "Accounts Payable (A/P)"
+                sign = 1
+
+            for line in txn.get("Line") or []:
+                detail_type = line.get("DetailType") or ""
+                detail = line.get(detail_type) or {}
+                if detail_type == "AccountBasedExpenseLineDetail":
+                    account = detail.get("AccountRef") or {}
+                elif detail_type == "ItemBasedExpenseLineDetail":
+                    account = item_accounts.get(_ref(detail.get("ItemRef"))) or {}
+                else:
+                    continue
+                if not account.get("value"):
+                    continue
+                out.append({
+                    "txn_type": txn_type, "txn_id": str(txn.get("Id") or ""), "date": txn.get("TxnDate") or "",
+                    "doc": txn.get("DocNumber") or "", "name": name,
+                    "memo": line.get("Description") or txn.get("PrivateNote") or "", "split": split,
+                    "account_id": str(account["value"]), "account_name": account.get("name") or "",
+                    "debit": sign * float(line.get("Amount") or 0),
+                    "customer_id": _ref(detail.get("CustomerRef")),
+                })
+
+    for txn in transactions.get("JournalEntry") or []:
+        lines = [l for l in (txn.get("Line") or []) if l.get("DetailType") == "JournalEntryLineDetail"]
+        for line in lines:
+            detail = line["JournalEntryLineDetail"]
+            account = detail.get("AccountRef") or {}
+            if not account.get("value"):
+                continue
+            others = {_ref(o["JournalEntryLineDetail"].get("AccountRef"), "name") for o in lines if o is not line}
+            entity = detail.get("Entity") or {}
+            entity_ref = entity.get("EntityRef") or {}
+            sign = 1 if detail.get("PostingType") == "Debit" else -1
+            out.append({
+                "txn_type": "Journal Entry", "txn_id": str(txn.get("Id") or ""), "date": txn.get("TxnDate") or "",
+                "doc": txn.get("DocNumber") or "", "name": entity_ref.get("name") or "",
+                "memo": line.get("Description") or txn.get("PrivateNote") or "",
+                "split": others.pop() if len(others) == 1 else "-Split-",
+                "account_id": str(account["value"]), "account_name": account.get("name") or "",
+                "debit": sign * float(line.get("Amount") or 0),
+                "customer_id": _ref(entity_ref) if entity.get("Type") == "Customer" else "",
+            })
+
+    return out
+
+
+def _coldata(*values) -> list[dict]:
+    return [{"value": v} for v in values]
+
+
+def _empty_cells(first: str, last_values: dict | None = None) -> list[dict]:
+    cells = [first] + [""] * (len(PNL_DETAIL_COLUMNS) - 1)
+    for i, v in (last_values or {}).items():
+        cells[i] = v
+    return _coldata(*cells)
+
+
+def build_pnl_detail_report(postings: list[dict], accounts: dict, start_date: str, end_date: str) -> dict:
+    """
+    Arma el JSON de ProfitAndLossDetail (sólo gastos) a partir de las líneas: grupo -> cuenta
+    -> filas por fecha con saldo acumulado; totales por cuenta y por grupo.
+    """
+    amount_idx = 6
+    by_group: dict[str, dict[str, list[dict]]] = {}
+    for p in postings:
+        acc = accounts.get(p["account_id"]) or {}
+        group = _GROUP_BY_ACCOUNT_TYPE.get(acc.get("type") or "")
+        if not group:
+            continue  # cuentas de balance (banco, CxP, ...) e ingresos no van
+        by_group.setdefault(group[0], {}).setdefault(p["account_id"], []).append(p)
+
+    group_rows = []
+    for group_key, title, _ in PNL_GROUPS:
+        group_accounts = by_group.get(group_key)
+        if not group_accounts:
+            continue
+
+        account_sections = []
+        group_total = 0.0
+        for account_id, lines in sorted(group_accounts.items(), key=lambda kv: (accounts[kv[0]]["name"] or "").lower()):
+            account_name = accounts[account_id]["name"] or lines[0]["account_name"]
+            balance = 0.0
+            data_rows = []
+            for p in sorted(lines, key=lambda p: (p["date"], p["txn_type"], p["doc"], p["txn_id"])):
+                amount = p["debit"]
+                balance += amount
+                data_rows.append({
+                    "ColData": _coldata(p["date"], p["txn_type"], p["doc"], p["name"], p["memo"], p["split"],
+                                        format_amount(amount), format_amount(balance)),
+                    "type": "Data",
+                })
+            group_total += balance
+            account_sections.append({
+                "Header": {"ColData": [{"value": account_name, "id": account_id}] + _empty_cells("")[1:]},
+                "Rows": {"Row": data_rows},
+                "Summary": {"ColData": _empty_cells(f"Total {account_name}", {amount_idx: format_amount(balance)})},
+                "type": "Section",
+            })
+
+        group_rows.append({
+            "Header": {"ColData": _empty_cells(title)},
+            "Rows": {"Row": account_sections},
+            "Summary": {"ColData": _empty_cells(f"Total {title}", {amount_idx: format_amount(group_total)})},
+            "type": "Section",
+            "group": group_key,
+        })
+
+    return {
+        "Header": {"ReportName": "ProfitAndLossDetail", "StartPeriod": start_date, "EndPeriod": end_date,
+                   "Option": [{"Name": "Source", "Value": "Transactions"}, {"Name": "Scope", "Value": "Expenses"}]},
+        "Columns": {"Column": [
+            {"ColTitle": t, "ColType": ty, "MetaData": [{"Name": "ColKey", "Value": key}]}
+            for t, ty, key in PNL_DETAIL_COLUMNS
+        ]},
+        "Rows": {"Row": group_rows},
+    }
+
+
+def get_profit_and_loss_detail_from_transactions(access_token: str, realm_id: str, start_date: str, end_date: str,
+                                                 customer_id: str | None = None) -> dict:
+    """
+    Igual que qbo_client.get_profit_and_loss_detail (mismo JSON de reporte) pero armado desde
+    Purchase / Bill / JournalEntry: sólo grupos de gastos, sin ingresos ni "Ingresos netos".
+    """
+    transactions = fetch_transactions(access_token, realm_id, start_date, end_date)
+
+    item_ids = {
+        _ref((line.get("ItemBasedExpenseLineDetail") or {}).get("ItemRef"))
+        for kind in ("Purchase", "Bill") for txn in transactions[kind] for line in (txn.get("Line") or [])
+        if line.get("DetailType") == "ItemBasedExpenseLineDetail"
+    }
+    item_accounts = _item_expense_accounts(access_token, realm_id, item_ids) if item_ids else {}
+
+    postings = _posting_lines(transactions, item_accounts)
+    if customer_id:
+        postings = [p for p in postings if p["customer_id"] == str(customer_id)]
+
+    accounts = account_type_map(access_token, realm_id, {p["account_id"] for p in postings})
+    report = build_pnl_detail_report(postings, accounts, start_date, end_date)
+
+    print("QBO TRANSACTIONS -> realm:", realm_id, start_date, end_date,
+          {k: len(v) for k, v in transactions.items()}, "líneas:", len(postings))
+    return report
@@ -0,0 +1,128 @@
+"""
+Cache de respuestas de Reports API (debajo de qbo_client.get_report).
+
+Llave = realm + reporte + parámetros normalizados (+ minorversion). Se guarda el body JSON
+tal como llegó (bytes) para que cada lector decodifique su propia copia.
+
+Niveles:
+  1) memoria del proceso: LRU con presupuesto en bytes (REPORT_CACHE_MAX_BYTES)
+  2) Postgres (opcional, REPORT_CACHE_PG=1): qbo_report_cache con el body en gzip,
+     compartido entre workers / reinicios
+
+TTL: REPORT_CACHE_TTL_SECONDS si el rango toca el mes en curso (todavía se registran
+movimientos) y REPORT_CACHE_CLOSED_TTL_SECONDS si end_date es anterior al mes actual.
+Cualquier webhook del realm (cache_invalidation) borra sus reportes de ambos niveles.
+"""
+import os
+import gzip
+import json
+import hashlib
+from datetime import datetime, date, timezone, timedelta
+
+from token_store import get_cached_report_body, put_cached_report_body, delete_cached_reports
+from caching import ByteLRUCache
+from cache_invalidation import subscribe
+
+REPORT_CACHE_ENABLED = os.environ.get("REPORT_CACHE_ENABLED", "1") == "1"
+REPORT_CACHE_MAX_BYTES = int(os.environ.get("REPORT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+REPORT_CACHE_TTL_SECONDS = int(os.environ.get("REPORT_CACHE_TTL_SECONDS", "900"))
+REPORT_CACHE_CLOSED_TTL_SECONDS = int(os.environ.get("REPORT_CACHE_CLOSED_TTL_SECONDS", str(7 * 24 * 3600)))
+REPORT_CACHE_PG = os.environ.get("REPORT_CACHE_PG", "0") == "1"
+# Coalescing entre workers (advisory lock + releer qbo_report_cache); requiere REPORT_CACHE_PG=1
+REPORT_SINGLEFLIGHT_PG = REPORT_CACHE_PG and os.environ.get("REPORT_SINGLEFLIGHT_PG", "0") == "1"
+
+_memory = ByteLRUCache("reports", REPORT_CACHE_MAX_BYTES)
+
+
+def report_cache_key(realm_id: str, report_name: str, params: dict) -> str:
+    """
+    Parámetros normalizados: sin None, valores como texto sin espacios, listas unidas por
+    coma y ordenados por nombre (mismo reporte = misma llave sin importar el orden).
+    """
+    norm = {}
+    for k, v in (params or {}).items():
+        if v is None:
+            continue
+        if isinstance(v, (list, tuple)):
+            v = ",".join(str(x).strip() for x in v)
+        norm[str(k)] = str(v).strip()
+    raw = json.dumps([realm_id, report_name, sorted(norm.items())], separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def report_ttl_seconds(params: dict, today: date | None = None) -> int:
+    """
+    Periodo cerrado (end_date antes del 1ro del mes actual) -> TTL largo.
+    Sin end_date (date_macro, etc.) o mes en curso -> TTL corto.
+    """
+    end_date = str((params or {}).get("end_date") or "")[:10]
+    try:
+        end = date.fromisoformat(end_date)
+    except ValueError:
+        return REPORT_CACHE_TTL_SECONDS
+
+    month_start = (today or date.today()).replace(day=1)
+    return REPORT_CACHE_CLOSED_TTL_SECONDS if end < month_start else REPORT_CACHE_TTL_SECONDS
+
+
+def get_cached_report(cache_key: str, realm_id: str, newer_than: datetime | None = None) -> bytes | None:
+    """
+    newer_than: sólo lo que otro worker guardó después de ese momento (se salta la memoria).
+    """
+    if not REPORT_CACHE_ENABLED:
+        return None
+
+    if newer_than is None:
+        body = _memory.get(cache_key)
+        if body is not None:
+            return body
+    if not REPORT_CACHE_PG:
+        return None
+
+    try:
+        row = get_cached_report_body(cache_key, newer_than)
+    except Exception as e:
+        print("REPORT CACHE PG ERROR ->", repr(e))
+        return None
+    if not row:
+        return None
+
+    body_gzip, expires_at = row
+    body = gzip.decompress(body_gzip)
+    remaining = (expires_at - datetime.now(timezone.utc)).total_seconds()
+    _memory.put(cache_key, body, remaining, tag=realm_id)
+    return body
+
+
+def store_report(cache_key: str, realm_id: str, report_name: str, params: dict, body: bytes):
+    if not REPORT_CACHE_ENABLED:
+        return
+
+    ttl = report_ttl_seconds(params)
+    _memory.put(cache_key, body, ttl, tag=realm_id)
+
+    if REPORT_CACHE_PG:
+        try:
+            expires_at = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+            put_cached_report_body(cache_key, realm_id, report_name, gzip.compress(body, 6), expires_at)
+        except Exception as e:
+            print("REPORT CACHE PG ERROR ->", repr(e))
+
+
+def invalidate_realm_reports(realm_id: str):
+    dropped = _memory.invalidate_tag(realm_id)
+    if REPORT_CACHE_PG:
+        try:
+            dropped += delete_cached_reports(realm_id)
+        except Exception as e:
+            print("REPORT CACHE PG ERROR ->", repr(e))
+    print("REPORT CACHE -> realm:", realm_id, "invalidados:", dropped)
+
+
+def _on_cache_events(events: list[dict]):
+    # Cualquier cambio (transacciones, vendors, cuentas, ...) puede cambiar un reporte del realm
+    for realm_id in {e["realm_id"] for e in events}:
+        invalidate_realm_reports(realm_id)
+
+
+subscribe(None, _on_cache_events)
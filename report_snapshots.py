@@ -0,0 +1,72 @@
+"""
+Snapshots del reporte generado en /run-report.
+
+La tabla ya parseada (parse_report_to_table) + meta se guardan en Postgres con un ID y
+vencimiento. La vista previa y las descargas usan ese ID: no vuelven a llamar a QBO ni a
+parsear, y el Excel sale exactamente de lo que el usuario vio.
+
+Formato: JSON compacto en gzip con la tabla por columnas (ReportTable.to_payload); al leer
+se obtiene un ReportTable.
+"""
+import os
+import gzip
+import json
+import secrets
+from datetime import datetime, timezone, timedelta
+
+from token_store import save_report_snapshot, get_report_snapshot_payload
+from qbo_client import json_loads
+from report_table import ReportTable
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+REPORT_SNAPSHOT_TTL_SECONDS = int(os.environ.get("REPORT_SNAPSHOT_TTL_SECONDS", str(24 * 3600)))
+
+def _dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def encode_snapshot(meta: dict, table) -> bytes:
+    return gzip.compress(_dumps({"meta": meta, "table": ReportTable.from_dict(table).to_payload()}), 6)
+
+
+def decode_snapshot(payload: bytes) -> dict:
+    data = json_loads(gzip.decompress(payload))
+    data["table"] = ReportTable.from_payload(data["table"])
+    return data
+
+
+def create_snapshot(meta: dict, table) -> str | None:
+    """
+    Guarda meta + tabla y retorna el snapshot_id (None si Postgres no está disponible:
+    las descargas vuelven a traer el reporte como antes).
+    """
+    snapshot_id = secrets.token_urlsafe(16)
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=REPORT_SNAPSHOT_TTL_SECONDS)
+    try:
+        payload = encode_snapshot(meta, table)
+        save_report_snapshot(snapshot_id, meta.get("realm_id"), meta.get("report_type") or "", payload, expires_at)
+    except Exception as e:
+        print("SNAPSHOT SAVE ERROR ->", repr(e))
+        return None
+    print("SNAPSHOT ->", snapshot_id, "bytes:", len(payload), "rows:", len(table.get("rows") or []))
+    return snapshot_id
+
+
+def load_snapshot(snapshot_id: str) -> dict | None:
+    """
+    {"meta": ..., "table": ...} o None si no existe / venció / error.
+    """
+    if not snapshot_id:
+        return None
+    try:
+        payload = get_report_snapshot_payload(snapshot_id)
+    except Exception as e:
+        print("SNAPSHOT LOAD ERROR ->", repr(e))
+        return None
+    return decode_snapshot(payload) if payload else None
@@ -0,0 +1,320 @@
+"""
+Parser incremental de Reports API: lee el body como stream de bytes y va entregando filas
+(mismo formato y misma semántica que qbo_client.parse_report_to_table) sin armar el árbol
+JSON completo. Pila explícita en vez de recursión.
+
+  stream = ReportRowStream(r.iter_content(65536))
+  stream.columns / stream.col_types / stream.col_keys   (lee hasta "Columns")
+  for row in stream: ...                                 ({"level", "row_type", "cells", "is_header", "is_summary"})
+  stream.to_table()                                      (dict igual a parse_report_to_table)
+
+Con ijson instalado la memoria queda acotada a una fila (más lo que guarde el caller);
+sin ijson se decodifica el body completo y se recorre el árbol con la misma pila.
+
+reopen / retry_on: si la lectura falla con `retry_on` ANTES de entregar la primera fila,
+se vuelve a empezar con reopen() (chunks nuevos). on_close() se llama una vez al terminar
+(fin del body, close() o error).
+
+Orden de emisión por fila de QBO: Header, ColData propia, hijas (Rows), Summary. Se asume
+el orden de llaves que manda QBO (Header / RowType antes de Rows, Columns antes de Rows).
+"""
+import json
+from collections import deque
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _loads(body: bytes):
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def _row(level: int, row_type: str, cells: list, is_header: bool, is_summary: bool) -> dict:
+    return {"level": level, "row_type": row_type, "cells": cells, "is_header": is_header, "is_summary": is_summary}
+
+
+class _ChunkReader:
+    """
+    file-like (read) sobre un iterable de bytes, para ijson.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b""
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buf) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buf += chunk
+        if size < 0:
+            out, self._buf = self._buf, b""
+        else:
+            out, self._buf = self._buf[:size], self._buf[size:]
+        return out
+
+
+class _Frame:
+    __slots__ = ("prefix", "level", "child_level", "rt", "header", "coldata", "summary", "flushed")
+
+    def __init__(self, prefix: str, level: int):
+        self.prefix = prefix
+        self.level = level
+        self.child_level = level
+        self.rt = ""
+        self.header = None
+        self.coldata = None
+        self.summary = None
+        self.flushed = False
+
+
+class ReportRowStream:
+    def __init__(self, chunks, reopen=None, retry_on: tuple = (), max_retries: int = 0, on_close=None):
+        self._reopen = reopen
+        self._retry_on = retry_on
+        self._retries_left = max_retries
+        self._on_close = on_close
+        self._rows_out = 0
+        self._done = False
+        self._start(chunks)
+
+    def _start(self, chunks):
+        self.columns: list[str] | None = None
+        self.col_types: list[str] = []
+        self.col_keys: list[str] = []
+        self._pending: deque = deque()
+        self._source = self._events_ijson(chunks) if ijson is not None else self._events_tree(chunks)
+
+    @classmethod
+    def from_report_json(cls, report_json: dict) -> "ReportRowStream":
+        # Reporte ya decodificado (p.ej. merge de tramos): misma interfaz, recorrido con pila
+        stream = cls(())
+        stream._source = stream._walk_tree(report_json)
+        return stream
+
+    # -------------------------
+    # API
+    # -------------------------
+    def __iter__(self):
+        while True:
+            while self._pending:
+                self._rows_out += 1
+                yield self._pending.popleft()
+            if not self._advance():
+                return
+
+    def read_columns(self):
+        while self.columns is None and self._advance():
+            pass
+        if self.columns is None:
+            self.columns = []
+        return self.columns
+
+    def to_table(self) -> dict:
+        rows = list(self)
+        self.read_columns()
+        return {"columns": self.columns, "col_types": self.col_types, "col_keys": self.col_keys, "rows": rows}
+
+    def close(self):
+        if self._done:
+            return
+        close = getattr(self._source, "close", None)
+        try:
+            if close:
+                close()
+        finally:
+            self._finish()
+
+    def __del__(self):
+        # Stream abandonado sin terminar: liberar igual (on_close)
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def _finish(self):
+        self._done = True
+        on_close, self._on_close = self._on_close, None
+        if on_close:
+            on_close()
+
+    def _advance(self) -> bool:
+        # Procesa eventos hasta producir algo (fila o columnas); False al terminar
+        if self._done:
+            return False
+        try:
+            item = next(self._source, None)
+        except self._retry_on as e:
+            if self._rows_out or self._reopen is None or self._retries_left <= 0:
+                self._finish()
+                raise
+            self._retries_left -= 1
+            print("REPORT STREAM RETRY ->", repr(e))
+            try:
+                self._start(self._reopen())
+            except BaseException:
+                self._finish()
+                raise
+            return True
+        except BaseException:
+            self._finish()
+            raise
+        if item is None:
+            self._finish()
+            return False
+        return True
+
+    def _set_columns(self, cols: list[dict]):
+        self.columns = [(c.get("ColTitle") or c.get("Title") or c.get("Name") or "").strip() or "Column" for c in cols]
+        self.col_types = [(c.get("ColType") or "").strip() for c in cols]
+        self.col_keys = [c.get("_key") or "" for c in cols]
+
+    def _cells(self, coldata: list) -> list:
+        width = len(self.columns) if self.columns is not None else len(coldata)
+        return [(coldata[i] if i < len(coldata) else "") or "" for i in range(width)]
+
+    # -------------------------
+    # ijson: eventos del stream
+    # -------------------------
+    def _events_ijson(self, chunks):
+        stack: list[_Frame] = []
+        cols: list[dict] = []
+        meta: dict | None = None
+        fault: list[str] = []
+
+        def flush(f: _Frame):
+            if f.flushed:
+                return
+            f.flushed = True
+            if f.header is not None:
+                self._pending.append(_row(f.level, "Header", self._cells(f.header), True, False))
+            if f.coldata:
+                if f.rt.lower() == "summary":
+                    self._pending.append(_row(f.level, "Summary", self._cells(f.coldata), False, True))
+                else:
+                    self._pending.append(_row(f.level, f.rt or "Data", self._cells(f.coldata), False, False))
+
+        for prefix, event, value in ijson.parse(_ChunkReader(chunks), use_float=True):
+            f = stack[-1] if stack else None
+            p = f.prefix if f else None
+
+            if f is not None and prefix.startswith(p):
+                rel = prefix[len(p):]
+                if event == "map_key" and rel == "":
+                    if value == "Rows":
+                        flush(f)
+                        f.child_level = f.level + 1 if f.rt.lower() == "section" else f.level
+                elif event == "end_map" and rel == "":
+                    flush(f)
+                    if f.summary is not None:
+                        self._pending.append(_row(f.level, "Summary", self._cells(f.summary), False, True))
+                    stack.pop()
+                    if self._pending:
+                        yield True
+                elif rel == ".RowType" and event == "string":
+                    f.rt = (value or "").strip()
+                elif event == "start_map" and rel == ".Header":
+                    f.header = []
+                elif event == "start_map" and rel == ".Summary":
+                    f.summary = []
+                elif event == "start_array" and rel == ".ColData":
+                    f.coldata = []
+                elif event == "start_map" and rel == ".Header.ColData.item":
+                    f.header.append("")
+                elif event == "start_map" and rel == ".Summary.ColData.item":
+                    f.summary.append("")
+                elif event == "start_map" and rel == ".ColData.item":
+                    f.coldata.append("")
+                elif rel == ".Header.ColData.item.value":
+                    f.header[-1] = value
+                elif rel == ".Summary.ColData.item.value":
+                    f.summary[-1] = value
+                elif rel == ".ColData.item.value":
+                    f.coldata[-1] = value
+                elif event == "start_map" and rel == ".Rows.Row.item":
+                    stack.append(_Frame(prefix, f.child_level))
+                continue
+
+            if event == "start_map" and prefix == "Rows.Row.item":
+                stack.append(_Frame(prefix, 0))
+            elif prefix.startswith("Columns.Column"):
+                if event == "start_map" and prefix == "Columns.Column.item":
+                    cols.append({})
+                elif event == "start_map" and prefix == "Columns.Column.item.MetaData.item":
+                    meta = {}
+                elif event == "end_map" and prefix == "Columns.Column.item.MetaData.item":
+                    if meta.get("Name") == "ColKey" and not cols[-1].get("_key"):
+                        cols[-1]["_key"] = meta.get("Value") or ""
+                elif prefix.startswith("Columns.Column.item.MetaData.item.") and event == "string":
+                    meta[prefix.rsplit(".", 1)[1]] = value
+                elif prefix.count(".") == 3 and event == "string":
+                    cols[-1][prefix.rsplit(".", 1)[1]] = value
+                elif event == "end_array" and prefix == "Columns.Column":
+                    self._set_columns(cols)
+                    yield True
+            elif prefix.startswith("Fault.") and event == "string" and prefix.endswith((".Message", ".Detail")):
+                fault.append(value)
+
+        if fault:
+            raise RuntimeError(f"QBO report fault: {' | '.join(fault)}")
+        if self.columns is None:
+            self._set_columns(cols)
+
+    # -------------------------
+    # sin ijson: árbol decodificado + pila
+    # -------------------------
+    def _events_tree(self, chunks):
+        yield from self._walk_tree(_loads(b"".join(chunks)))
+
+    def _walk_tree(self, report_json: dict):
+        if "Fault" in report_json:
+            raise RuntimeError(f"QBO report fault: {report_json['Fault']}")
+        cols = []
+        for c in (report_json.get("Columns") or {}).get("Column") or []:
+            keys = [m.get("Value") or "" for m in (c.get("MetaData") or []) if m.get("Name") == "ColKey"]
+            cols.append(dict(c, _key=keys[0] if keys else ""))
+        self._set_columns(cols)
+        yield True
+
+        # ("node", obj, level) o ("summary", obj, level); se apila en orden inverso
+        stack = [("node", report_json.get("Rows") or {}, 0)]
+        while stack:
+            kind, node, level = stack.pop()
+            if kind == "summary":
+                self._pending.append(_row(level, "Summary", self._cells([c.get("value") for c in node.get("ColData") or []]), False, True))
+                yield True
+                continue
+            if not node or not isinstance(node, dict):
+                continue
+
+            if isinstance(node.get("Row"), list):
+                stack.extend(("node", r, level) for r in reversed(node["Row"]))
+                continue
+
+            rt = (node.get("RowType") or "").strip()
+            if isinstance(node.get("Header"), dict):
+                self._pending.append(_row(level, "Header", self._cells([c.get("value") for c in node["Header"].get("ColData") or []]), True, False))
+            coldata = node.get("ColData")
+            if isinstance(coldata, list) and coldata:
+                cells = self._cells([c.get("value") for c in coldata])
+                if rt.lower() == "summary":
+                    self._pending.append(_row(level, "Summary", cells, False, True))
+                else:
+                    self._pending.append(_row(level, rt or "Data", cells, False, False))
+
+            if isinstance(node.get("Summary"), dict):
+                stack.append(("summary", node["Summary"], level))
+            if "Rows" in node:
+                stack.append(("node", node["Rows"], level + 1 if rt.lower() == "section" else level))
+            if self._pending:
+                yield True
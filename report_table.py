@@ -0,0 +1,255 @@
+"""
+Tabla compacta (por columnas) para reportes parseados.
+
+Misma interfaz que el dict de parse_report_to_table:
+  table["columns"] / table.get("col_types") / table.get("col_keys") / table["rows"]
+  row["cells"] / row.get("is_header") / row.level (Jinja)
+pero sin un dict + lista por fila:
+  - level / row_type / flags en array (1-2 bytes por fila)
+  - celdas guardadas por columna, con los textos repetidos (cuentas, proveedores, tipos)
+    internados: una sola copia por tabla
+  - las filas son vistas con __slots__ que se arman al leerlas
+  - columnas Money / Date (col_types) decodificadas una sola vez al armar la tabla:
+    row.amount(idx) -> float, row.yyyymmdd(idx) -> "AAAAMMDD"
+
+Para snapshots: to_payload() / ReportTable.from_payload() (JSON por columnas).
+"""
+import math
+from array import array
+
+from qbo_client import parse_amount, parse_report_date
+
+_HEADER = 1
+_SUMMARY = 2
+
+_TABLE_KEYS = ("columns", "col_types", "col_keys", "rows")
+
+
+class ReportRow:
+    __slots__ = ("_table", "_i", "_cells")
+
+    def __init__(self, table: "ReportTable", i: int):
+        self._table = table
+        self._i = i
+        self._cells = None
+
+    @property
+    def level(self) -> int:
+        return self._table._levels[self._i]
+
+    @property
+    def row_type(self) -> str:
+        return self._table._row_type_names[self._table._row_types[self._i]]
+
+    @property
+    def is_header(self) -> bool:
+        return bool(self._table._flags[self._i] & _HEADER)
+
+    @property
+    def is_summary(self) -> bool:
+        return bool(self._table._flags[self._i] & _SUMMARY)
+
+    @property
+    def cells(self) -> list:
+        if self._cells is None:
+            i = self._i
+            self._cells = [col[i] for col in self._table._cells]
+        return self._cells
+
+    # acceso tipo dict (igual que las filas de parse_report_to_table)
+    def __getitem__(self, key: str):
+        if key not in ReportTable.ROW_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in ReportTable.ROW_FIELDS else default
+
+    def to_dict(self) -> dict:
+        return {f: getattr(self, f) for f in ReportTable.ROW_FIELDS}
+
+    # valores decodificados (columnas tipadas); otras columnas se parsean en el momento
+    def amount(self, idx: int | None, default: float = 0.0) -> float:
+        if idx is None:
+            return default
+        values = self._table._money.get(idx)
+        if values is None:
+            n = parse_amount(self.cells[idx] if 0 <= idx < len(self.cells) else "")
+            return default if n is None else n
+        n = values[self._i]
+        return default if math.isnan(n) else n
+
+    def yyyymmdd(self, idx: int | None) -> str:
+        if idx is None:
+            return ""
+        values = self._table._dates.get(idx)
+        if values is None:
+            d = parse_report_date(self.cells[idx] if 0 <= idx < len(self.cells) else "")
+        else:
+            d = values[self._i] or None
+        return f"{d:08d}" if d else ""
+
+
+class _Rows:
+    """
+    Secuencia de filas (len, índice, slice, iteración) sobre la tabla.
+    """
+    __slots__ = ("_table",)
+
+    def __init__(self, table: "ReportTable"):
+        self._table = table
+
+    def __len__(self) -> int:
+        return len(self._table._levels)
+
+    def __iter__(self):
+        table = self._table
+        for i in range(len(table._levels)):
+            yield ReportRow(table, i)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ReportRow(self._table, j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return ReportRow(self._table, i)
+
+
+class ReportTable:
+    ROW_FIELDS = ("level", "row_type", "cells", "is_header", "is_summary")
+
+    __slots__ = ("columns", "col_types", "col_keys", "_levels", "_row_types", "_row_type_names", "_flags",
+                 "_cells", "_intern", "_money", "_dates")
+
+    def __init__(self, columns: list[str], col_types: list[str] | None = None, col_keys: list[str] | None = None):
+        self.columns = list(columns or [])
+        self.col_types = list(col_types or [])
+        self.col_keys = list(col_keys or [])
+        self._levels = array("H")
+        self._row_types = array("B")
+        self._row_type_names: list[str] = []
+        self._flags = array("B")
+        self._cells: list[list] = [[] for _ in self.columns]
+        self._intern: dict = {}
+        self._money: dict[int, array] = {}  # idx -> array("d"), NaN = vacío
+        self._dates: dict[int, array] = {}  # idx -> array("l") AAAAMMDD, 0 = vacío
+
+    # -------------------------
+    # construcción
+    # -------------------------
+    def append(self, level: int, row_type: str, cells, is_header: bool, is_summary: bool):
+        intern = self._intern
+        self._levels.append(level)
+        if row_type not in self._row_type_names:
+            self._row_type_names.append(row_type)
+        self._row_types.append(self._row_type_names.index(row_type))
+        self._flags.append((_HEADER if is_header else 0) | (_SUMMARY if is_summary else 0))
+        n = len(cells)
+        for j, col in enumerate(self._cells):
+            v = cells[j] if j < n else ""
+            if isinstance(v, str):
+                v = intern.setdefault(v, v)
+            col.append(v)
+
+    def append_row(self, row):
+        # row: dict de parse_report_to_table (o cualquier cosa con .get de esas llaves)
+        self.append(row.get("level") or 0, row.get("row_type") or "", row.get("cells") or [],
+                    bool(row.get("is_header")), bool(row.get("is_summary")))
+
+    @classmethod
+    def from_rows(cls, columns, col_types, col_keys, rows) -> "ReportTable":
+        table = cls(columns, col_types, col_keys)
+        for r in rows:
+            table.append_row(r)
+        table.compact()
+        return table
+
+    @classmethod
+    def from_dict(cls, table: dict) -> "ReportTable":
+        if isinstance(table, cls):
+            return table
+        return cls.from_rows(table.get("columns"), table.get("col_types"), table.get("col_keys"),
+                             table.get("rows") or [])
+
+    @classmethod
+    def from_stream(cls, stream) -> "ReportTable":
+        # stream: report_stream.ReportRowStream (las columnas llegan antes que las filas)
+        table = cls(stream.read_columns(), stream.col_types, stream.col_keys)
+        for r in stream:
+            table.append_row(r)
+        table.compact()
+        return table
+
+    def compact(self):
+        # El diccionario de internado sólo hace falta mientras se agregan filas
+        self._intern = {}
+        self._decode_typed_columns()
+
+    def _decode_typed_columns(self):
+        nan = math.nan
+        self._money, self._dates = {}, {}
+        for idx, col_type in enumerate(self.col_types):
+            if idx >= len(self._cells):
+                break
+            if col_type == "Money":
+                values = array("d")
+                for v in self._cells[idx]:
+                    n = parse_amount(v)
+                    values.append(nan if n is None else n)
+                self._money[idx] = values
+            elif col_type == "Date":
+                self._dates[idx] = array("l", (parse_report_date(v) or 0 for v in self._cells[idx]))
+
+    # -------------------------
+    # lectura (interfaz tipo dict)
+    # -------------------------
+    @property
+    def rows(self) -> _Rows:
+        return _Rows(self)
+
+    def __getitem__(self, key: str):
+        if key not in _TABLE_KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in _TABLE_KEYS else default
+
+    def __contains__(self, key) -> bool:
+        return key in _TABLE_KEYS
+
+    def __len__(self) -> int:
+        return len(self._levels)
+
+    def column_values(self, idx: int) -> list:
+        return self._cells[idx]
+
+    # -------------------------
+    # serialización (snapshots)
+    # -------------------------
+    def to_payload(self) -> dict:
+        return {
+            "columns": self.columns,
+            "col_types": self.col_types,
+            "col_keys": self.col_keys,
+            "levels": self._levels.tolist(),
+            "row_types": self._row_types.tolist(),
+            "row_type_names": self._row_type_names,
+            "flags": self._flags.tolist(),
+            "cells": self._cells,
+        }
+
+    @classmethod
+    def from_payload(cls, payload: dict) -> "ReportTable":
+        table = cls(payload.get("columns"), payload.get("col_types"), payload.get("col_keys"))
+        table._levels = array("H", payload.get("levels") or [])
+        table._row_types = array("B", payload.get("row_types") or [])
+        table._row_type_names = list(payload.get("row_type_names") or [])
+        table._flags = array("B", payload.get("flags") or [])
+        intern = {}
+        table._cells = [[intern.setdefault(v, v) if isinstance(v, str) else v for v in col]
+                        for col in (payload.get("cells") or [])]
+        table._decode_typed_columns()
+        return table
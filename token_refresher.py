@@ -0,0 +1,112 @@
+"""
+Refresco proactivo del access_token de QuickBooks.
+
+Renueva el token de cada empresa conectada QBO_REFRESH_MARGIN_SECONDS antes de
+access_expires_at para que ningún request interactivo tenga que esperar a oauth.platform.intuit.com.
+
+Uso:
+  - Proceso aparte (Procfile):  worker: python token_refresher.py
+  - Thread dentro de la app:     QBO_REFRESHER_IN_PROCESS=1  (app.py llama start_background_refresher)
+Correr varias copias es seguro: el refresh es single-flight (advisory lock en Postgres).
+
+Con QBO_SYNC_IN_WORKER=1 (default) también mantiene al día los caches de Vendor / Customer /
+Account vía CDC (entity_sync.ensure_synced) cada ENTITY_SYNC_MAX_AGE_SECONDS, y en cuanto
+llega un webhook de esas entidades (cache_invalidation).
+"""
+import os
+import threading
+from datetime import datetime, timezone
+
+from token_store import init_db, list_realms
+from qbo_client import refresh_access_token_if_needed, get_valid_access_token
+from entity_sync import ensure_synced, SYNC_ENTITIES
+import cache_invalidation
+
+QBO_REFRESH_MARGIN_SECONDS = int(os.environ.get("QBO_REFRESH_MARGIN_SECONDS", "600"))
+QBO_REFRESH_POLL_SECONDS = int(os.environ.get("QBO_REFRESH_POLL_SECONDS", "60"))
+QBO_SYNC_IN_WORKER = os.environ.get("QBO_SYNC_IN_WORKER", "1") == "1"
+
+_started = False
+_started_lock = threading.Lock()
+
+
+def run_once() -> float:
+    """
+    Un ciclo de refresco para todas las empresas conectadas.
+    Devuelve cuántos segundos dormir antes del siguiente.
+    """
+    try:
+        realms = list_realms()
+    except Exception as e:
+        print("TOKEN REFRESHER ERROR ->", repr(e))
+        return QBO_REFRESH_POLL_SECONDS
+
+    sleep_for = float(QBO_REFRESH_POLL_SECONDS)
+    for realm in realms:
+        realm_id = realm["realm_id"]
+        try:
+            expires_at = refresh_access_token_if_needed(QBO_REFRESH_MARGIN_SECONDS, realm_id)
+        except Exception as e:
+            print("TOKEN REFRESHER ERROR -> realm:", realm_id, repr(e))
+            continue
+
+        if QBO_SYNC_IN_WORKER:
+            try:
+                access_token, _ = get_valid_access_token(realm_id)
+                ensure_synced(access_token, realm_id)
+            except Exception as e:
+                print("ENTITY SYNC ERROR -> realm:", realm_id, repr(e))
+
+        if not expires_at:
+            continue
+
+        # Despierta justo cuando la próxima empresa entra en la ventana de margen
+        remaining = (expires_at - datetime.now(timezone.utc)).total_seconds() - QBO_REFRESH_MARGIN_SECONDS
+        sleep_for = min(sleep_for, remaining)
+
+    return max(1.0, sleep_for)
+
+
+def _sync_on_events(events: list[dict]):
+    """
+    Webhook de Vendor / Customer / Account -> delta CDC de ese realm ya (no al próximo ciclo).
+    """
+    by_realm: dict[str, set] = {}
+    for e in events:
+        by_realm.setdefault(e["realm_id"], set()).add(e["entity"])
+
+    for realm_id, entities in by_realm.items():
+        try:
+            access_token, _ = get_valid_access_token(realm_id)
+            ensure_synced(access_token, realm_id, sorted(entities), force=True)
+        except Exception as e:
+            print("ENTITY SYNC ERROR -> realm:", realm_id, repr(e))
+
+
+def run_forever(stop_event: threading.Event | None = None):
+    stop_event = stop_event or threading.Event()
+    if QBO_SYNC_IN_WORKER:
+        cache_invalidation.subscribe(SYNC_ENTITIES, _sync_on_events)
+        cache_invalidation.start_listener(stop_event)
+    while not stop_event.is_set():
+        stop_event.wait(run_once())
+
+
+def start_background_refresher() -> bool:
+    """
+    Arranca el refresher como thread daemon (una vez por proceso).
+    """
+    global _started
+    with _started_lock:
+        if _started:
+            return False
+        _started = True
+
+    threading.Thread(target=run_forever, name="qbo-token-refresher", daemon=True).start()
+    return True
+
+
+if __name__ == "__main__":
+    init_db()
+    print("TOKEN REFRESHER -> margin:", QBO_REFRESH_MARGIN_SECONDS, "poll:", QBO_REFRESH_POLL_SECONDS)
+    run_forever()
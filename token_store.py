@@ -1,20 +1,72 @@
 import os
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timezone
 
 import psycopg
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
 
 DATABASE_URL = os.environ.get("DATABASE_URL", "")
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = max(2, int(os.environ.get("DB_POOL_MAX_SIZE", "5")))
+TOKEN_SKEW_SECONDS = int(os.environ.get("TOKEN_SKEW_SECONDS", "60"))
+
+# Namespace arbitrario (int4) para pg_advisory_xact_lock(namespace, hashtext(realm_id))
+TOKEN_REFRESH_LOCK_KEY = 731_904_001
+REPORT_FETCH_LOCK_KEY = 731_904_002
+
+# Empresa por defecto cuando el caller no indica realm (si no, la última conectada)
+QBO_DEFAULT_REALM_ID = os.environ.get("QBO_DEFAULT_REALM_ID", "").strip()
+# Cada cuánto se vuelve a mirar en la DB cuál es "la última conectada" (otro worker pudo conectar una)
+DEFAULT_REALM_TTL_SECONDS = int(os.environ.get("DEFAULT_REALM_TTL_SECONDS", "60"))
+
+# Pool compartido por proceso (cada worker de gunicorn abre el suyo)
+_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+
+# Cache en memoria por realm: {realm_id: fila} (vive hasta access_expires_at - skew)
+_token_cache: dict[str, dict] = {}
+_default_realm_id: str | None = None
+_default_realm_loaded_at = 0.0  # time.monotonic()
+_token_cache_lock = threading.Lock()
+
+
+def _get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                if not DATABASE_URL:
+                    raise RuntimeError("DATABASE_URL no está configurado.")
+                # Render Postgres normalmente requiere SSL
+                _pool = ConnectionPool(
+                    DATABASE_URL,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    kwargs={"sslmode": "require", "row_factory": dict_row},
+                    check=ConnectionPool.check_connection,  # Render cierra conexiones ociosas
+                    open=True,
+                )
+    return _pool
+
 
 def _conn():
+    return _get_pool().connection()
+
+
+def _lock_conn() -> psycopg.Connection:
+    # Conexión fuera del pool para advisory locks que se mantienen durante una llamada a QBO
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL no está configurado.")
-    # Render Postgres normalmente requiere SSL
-    return psycopg.connect(DATABASE_URL, sslmode="require", row_factory=dict_row)
+    return psycopg.connect(DATABASE_URL, sslmode="require")
+
 
 def init_db():
     with _conn() as conn:
         with conn.cursor() as cur:
+            # Tabla legacy (una sola empresa, fila id=1). Se conserva para migrar.
             cur.execute("""
             CREATE TABLE IF NOT EXISTS qbo_tokens (
               id INT PRIMARY KEY DEFAULT 1,
@@ -25,36 +77,563 @@ def init_db():
               updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
             );
             """)
-            # Asegura fila id=1
+            # ✅ Tokens por empresa (realm_id)
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS qbo_realm_tokens (
+              realm_id TEXT PRIMARY KEY,
+              company_name TEXT,
+              access_token TEXT,
+              refresh_token TEXT,
+              access_expires_at TIMESTAMPTZ,
+              updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            );
+            """)
+            # Migra la empresa que ya estaba conectada en qbo_tokens
+            cur.execute("""
+            INSERT INTO qbo_realm_tokens (realm_id, access_token, refresh_token, access_expires_at, updated_at)
+            SELECT realm_id, access_token, refresh_token, access_expires_at, updated_at
+            FROM qbo_tokens
+            WHERE realm_id IS NOT NULL AND refresh_token IS NOT NULL
+            ON CONFLICT (realm_id) DO NOTHING;
+            """)
+            # ✅ Cache del directorio de vendors (INFORME 43), por realm
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS qbo_vendor_cache (
+              realm_id TEXT NOT NULL,
+              vendor_id TEXT NOT NULL,
+              display_name TEXT NOT NULL DEFAULT '',
+              name_key TEXT NOT NULL DEFAULT '',
+              ruc TEXT NOT NULL DEFAULT '',
+              dv TEXT NOT NULL DEFAULT '',
+              otro TEXT NOT NULL DEFAULT '',
+              notes TEXT NOT NULL DEFAULT '',
+              updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+              PRIMARY KEY (realm_id, vendor_id)
+            );
+            """)
+            cur.execute("""
+            CREATE INDEX IF NOT EXISTS qbo_vendor_cache_name_idx
+            ON qbo_vendor_cache (realm_id, name_key);
+            """)
+            cur.execute(f"""
+            CREATE INDEX IF NOT EXISTS qbo_vendor_cache_rucdv_idx
+            ON qbo_vendor_cache (realm_id, ({_VENDOR_RUCDV_EXPR}));
+            """)
+            # ✅ Cache de customers / cuentas (listas del formulario de reportes)
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS qbo_entity_cache (
+              realm_id TEXT NOT NULL,
+              entity TEXT NOT NULL,
+              entity_id TEXT NOT NULL,
+              name TEXT NOT NULL DEFAULT '',
+              type TEXT,
+              subtype TEXT,
+              updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+              PRIMARY KEY (realm_id, entity, entity_id)
+            );
+            """)
+            # ✅ High-water mark de la sincronización (CDC) por realm + entidad
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS qbo_sync_state (
+              realm_id TEXT NOT NULL,
+              entity TEXT NOT NULL,
+              synced_at TIMESTAMPTZ NOT NULL,
+              PRIMARY KEY (realm_id, entity)
+            );
+            """)
+            # dirty_at: webhook avisó de un cambio posterior al último sync
+            cur.execute("ALTER TABLE qbo_sync_state ADD COLUMN IF NOT EXISTS dirty_at TIMESTAMPTZ;")
+            # ✅ Cola de invalidaciones (webhooks de QBO) que lee cada proceso
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS qbo_cache_events (
+              id BIGSERIAL PRIMARY KEY,
+              realm_id TEXT NOT NULL,
+              entity TEXT NOT NULL,
+              entity_id TEXT NOT NULL DEFAULT '',
+              operation TEXT NOT NULL DEFAULT '',
+              received_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            );
+            """)
+            cur.execute("""
+            CREATE INDEX IF NOT EXISTS qbo_cache_events_received_idx
+            ON qbo_cache_events (received_at);
+            """)
+            # ✅ Cache de reportes (segundo nivel, compartido entre workers; body gzip)
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS qbo_report_cache (
+              cache_key TEXT PRIMARY KEY,
+              realm_id TEXT NOT NULL,
+              report_name TEXT NOT NULL,
+              body BYTEA NOT NULL,
+              created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+              expires_at TIMESTAMPTZ NOT NULL
+            );
+            """)
+            cur.execute("""
+            CREATE INDEX IF NOT EXISTS qbo_report_cache_realm_idx
+            ON qbo_report_cache (realm_id);
+            """)
+            cur.execute("""
+            CREATE INDEX IF NOT EXISTS qbo_report_cache_expires_idx
+            ON qbo_report_cache (expires_at);
+            """)
+            # ✅ Snapshots del reporte generado (lo que vio el usuario = lo que descarga)
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS qbo_report_snapshots (
+              snapshot_id TEXT PRIMARY KEY,
+              realm_id TEXT,
+              report_type TEXT NOT NULL,
+              payload BYTEA NOT NULL,
+              created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+              expires_at TIMESTAMPTZ NOT NULL
+            );
+            """)
             cur.execute("""
-            INSERT INTO qbo_tokens (id) VALUES (1)
-            ON CONFLICT (id) DO NOTHING;
+            CREATE INDEX IF NOT EXISTS qbo_report_snapshots_expires_idx
+            ON qbo_report_snapshots (expires_at);
             """)
         conn.commit()
 
-def save_tokens(realm_id: str, access_token: str, refresh_token: str, access_expires_at):
+
+def save_tokens(realm_id: str, access_token: str, refresh_token: str, access_expires_at, company_name: str | None = None):
+    if not realm_id:
+        raise RuntimeError("save_tokens requiere realm_id.")
+
     with _conn() as conn:
         with conn.cursor() as cur:
             cur.execute("""
-            UPDATE qbo_tokens
-            SET realm_id=%s,
-                access_token=%s,
-                refresh_token=%s,
-                access_expires_at=%s,
+            INSERT INTO qbo_realm_tokens (realm_id, company_name, access_token, refresh_token, access_expires_at, updated_at)
+            VALUES (%s, %s, %s, %s, %s, NOW())
+            ON CONFLICT (realm_id) DO UPDATE
+            SET company_name=COALESCE(EXCLUDED.company_name, qbo_realm_tokens.company_name),
+                access_token=EXCLUDED.access_token,
+                refresh_token=EXCLUDED.refresh_token,
+                access_expires_at=EXCLUDED.access_expires_at,
                 updated_at=NOW()
-            WHERE id=1;
-            """, (realm_id, access_token, refresh_token, access_expires_at))
+            RETURNING *;
+            """, (realm_id, company_name, access_token, refresh_token, access_expires_at))
+            row = cur.fetchone()
+        conn.commit()
+
+    global _default_realm_id, _default_realm_loaded_at
+    with _token_cache_lock:
+        if row:
+            _token_cache[realm_id] = dict(row)
+            # Esta empresa pasa a ser la de updated_at más reciente
+            _default_realm_id = realm_id
+            _default_realm_loaded_at = time.monotonic()
+
+
+def get_default_realm_id() -> str | None:
+    """
+    Realm a usar cuando el caller no indica empresa:
+    QBO_DEFAULT_REALM_ID o, si no, la empresa conectada/refrescada más recientemente
+    (se vuelve a leer de la DB cada DEFAULT_REALM_TTL_SECONDS).
+    """
+    global _default_realm_id, _default_realm_loaded_at
+    if QBO_DEFAULT_REALM_ID:
+        return QBO_DEFAULT_REALM_ID
+
+    with _token_cache_lock:
+        if _default_realm_id and time.monotonic() - _default_realm_loaded_at < DEFAULT_REALM_TTL_SECONDS:
+            return _default_realm_id
+
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT realm_id FROM qbo_realm_tokens ORDER BY updated_at DESC LIMIT 1;")
+            row = cur.fetchone()
+
+    realm_id = row["realm_id"] if row else None
+    with _token_cache_lock:
+        _default_realm_id = realm_id
+        _default_realm_loaded_at = time.monotonic()
+    return realm_id
+
+
+def get_tokens(realm_id: str | None = None, use_cache: bool = True):
+    """
+    Lee la fila de tokens de una empresa (realm_id; None = empresa por defecto).
+    - Con use_cache=True devuelve la copia en memoria mientras el access_token siga vigente
+      (access_expires_at - TOKEN_SKEW_SECONDS), sin ir a la DB.
+    - Si expiró (o use_cache=False) lee de la DB y refresca el cache de ese realm.
+    """
+    realm_id = realm_id or get_default_realm_id()
+    if not realm_id:
+        return None
+
+    if use_cache:
+        with _token_cache_lock:
+            cached = _token_cache.get(realm_id)
+        if cached and cached.get("access_token") and is_access_token_valid(cached.get("access_expires_at"), TOKEN_SKEW_SECONDS):
+            return dict(cached)
+
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT * FROM qbo_realm_tokens WHERE realm_id=%s;", (realm_id,))
+            row = cur.fetchone()
+
+    with _token_cache_lock:
+        if row:
+            _token_cache[realm_id] = dict(row)
+        else:
+            _token_cache.pop(realm_id, None)
+    return row
+
+
+def list_realms() -> list[dict]:
+    """
+    Empresas conectadas: [{realm_id, company_name, access_expires_at, updated_at}, ...]
+    """
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+            SELECT realm_id, company_name, access_expires_at, updated_at
+            FROM qbo_realm_tokens
+            WHERE refresh_token IS NOT NULL
+            ORDER BY COALESCE(company_name, realm_id);
+            """)
+            return cur.fetchall()
+
+
+@contextmanager
+def token_refresh_lock(realm_id: str):
+    """
+    Lock exclusivo entre procesos para refrescar los tokens de UNA empresa
+    (pg_advisory_xact_lock por realm: empresas distintas no se bloquean entre sí).
+    Se mantiene tomado mientras dure el bloque `with`; se libera al cerrar la transacción
+    (commit o rollback), así que un worker caído nunca deja el lock colgado.
+    Conexión propia, fuera del pool: el lock dura todo el POST a Intuit y get_tokens /
+    save_tokens siguen usando conexiones del pool mientras tanto.
+    """
+    with _lock_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s));", (TOKEN_REFRESH_LOCK_KEY, realm_id))
+        yield
+        conn.commit()
+
+
+@contextmanager
+def report_fetch_lock(cache_key: str):
+    """
+    Lock entre procesos para traer UN reporte (mismo realm + reporte + parámetros):
+    el primer worker lo trae y los demás esperan y lo leen del cache en Postgres.
+    Conexión propia, fuera del pool: el lock dura todo el GET a QBO y mientras tanto el
+    cache (lectura / escritura) sigue usando conexiones del pool.
+    Entrega NOW() de la base al pedir el lock (antes de esperar), para comparar con
+    created_at del cache con el mismo reloj.
+    """
+    with _lock_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT NOW();")
+            requested_at = cur.fetchone()[0]
+            cur.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s));", (REPORT_FETCH_LOCK_KEY, cache_key))
+        yield requested_at
+        conn.commit()
+
+
+def invalidate_token_cache(realm_id: str | None = None):
+    global _default_realm_id
+    with _token_cache_lock:
+        if realm_id:
+            _token_cache.pop(realm_id, None)
+        else:
+            _token_cache.clear()
+            _default_realm_id = None
+
+
+# -------------------------
+# ✅ Cache de vendors (Id, DisplayName, RUC, DV, Otro, Notes)
+# -------------------------
+# Misma llave que qbo_client.rucdv_key(): "RUC|DV" en mayúsculas
+_VENDOR_RUCDV_EXPR = "upper(ruc) || '|' || upper(dv)"
+
+_VENDOR_CACHE_COLUMNS = ("vendor_id", "display_name", "name_key", "ruc", "dv", "otro", "notes")
+
+
+def _set_sync_watermark(cur, realm_id: str, entity: str, synced_at):
+    cur.execute("""
+    INSERT INTO qbo_sync_state (realm_id, entity, synced_at) VALUES (%s, %s, %s)
+    ON CONFLICT (realm_id, entity) DO UPDATE SET synced_at=EXCLUDED.synced_at;
+    """, (realm_id, entity, synced_at))
+
+
+def get_sync_watermarks(realm_id: str) -> dict:
+    """
+    {entity: synced_at} de la última sincronización completa o incremental del realm.
+    """
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT entity, synced_at FROM qbo_sync_state WHERE realm_id=%s;", (realm_id,))
+            return {row["entity"]: row["synced_at"] for row in cur.fetchall()}
+
+
+def get_sync_state(realm_id: str) -> dict:
+    """
+    {entity: {"synced_at": ..., "dirty": bool}}; dirty = llegó un webhook que el último sync no vio.
+    """
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+            SELECT entity, synced_at, dirty_at IS NOT NULL AS dirty
+            FROM qbo_sync_state WHERE realm_id=%s;
+            """, (realm_id,))
+            return {row["entity"]: {"synced_at": row["synced_at"], "dirty": row["dirty"]} for row in cur.fetchall()}
+
+
+def _vendor_cache_rows(realm_id: str, vendors) -> list[tuple]:
+    return [(realm_id, *[(v.get(c) or "") for c in _VENDOR_CACHE_COLUMNS]) for v in vendors]
+
+
+_UPSERT_VENDOR_SQL = """
+INSERT INTO qbo_vendor_cache (realm_id, vendor_id, display_name, name_key, ruc, dv, otro, notes)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+ON CONFLICT (realm_id, vendor_id) DO UPDATE SET
+  display_name=EXCLUDED.display_name,
+  name_key=EXCLUDED.name_key,
+  ruc=EXCLUDED.ruc,
+  dv=EXCLUDED.dv,
+  otro=EXCLUDED.otro,
+  notes=EXCLUDED.notes,
+  updated_at=NOW();
+"""
+
+
+def replace_vendor_cache(realm_id: str, vendors: list[dict], synced_at):
+    """
+    Reemplaza el directorio completo de un realm (una transacción: los lectores nunca ven
+    el cache a medias). vendors: [{vendor_id, display_name, name_key, ruc, dv, otro, notes}, ...]
+    """
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM qbo_vendor_cache WHERE realm_id=%s;", (realm_id,))
+            cur.executemany(_UPSERT_VENDOR_SQL, _vendor_cache_rows(realm_id, vendors))
+            _set_sync_watermark(cur, realm_id, "Vendor", synced_at)
+        conn.commit()
+
+
+def apply_vendor_changes(realm_id: str, upserts: list[dict], deleted_ids: list[str], synced_at):
+    """
+    Aplica un delta (CDC): upsert de los vendors cambiados y borra los eliminados/inactivos.
+    """
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            if upserts:
+                cur.executemany(_UPSERT_VENDOR_SQL, _vendor_cache_rows(realm_id, upserts))
+            if deleted_ids:
+                cur.execute("DELETE FROM qbo_vendor_cache WHERE realm_id=%s AND vendor_id = ANY(%s);",
+                            (realm_id, list(deleted_ids)))
+            _set_sync_watermark(cur, realm_id, "Vendor", synced_at)
+        conn.commit()
+
+
+def lookup_cached_vendors(realm_id: str, name_keys=(), rucdv_keys=(), vendor_ids=()) -> list[dict]:
+    """
+    Búsqueda indexada en el cache: por name_key, por "RUC|DV" o por vendor_id.
+    """
+    name_keys, rucdv_keys, vendor_ids = list(name_keys), list(rucdv_keys), list(vendor_ids)
+    if not (name_keys or rucdv_keys or vendor_ids):
+        return []
+
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+            SELECT vendor_id, display_name, name_key, ruc, dv, otro, notes
+            FROM qbo_vendor_cache
+            WHERE realm_id=%s
+              AND (name_key = ANY(%s)
+                   OR ({_VENDOR_RUCDV_EXPR}) = ANY(%s)
+                   OR vendor_id = ANY(%s))
+            ORDER BY vendor_id;
+            """, (realm_id, name_keys, rucdv_keys, vendor_ids))
+            return cur.fetchall()
+
+
+# -------------------------
+# ✅ Cache de customers / cuentas (qbo_entity_cache)
+# -------------------------
+_UPSERT_ENTITY_SQL = """
+INSERT INTO qbo_entity_cache (realm_id, entity, entity_id, name, type, subtype)
+VALUES (%s, %s, %s, %s, %s, %s)
+ON CONFLICT (realm_id, entity, entity_id) DO UPDATE SET
+  name=EXCLUDED.name,
+  type=EXCLUDED.type,
+  subtype=EXCLUDED.subtype,
+  updated_at=NOW();
+"""
+
+
+def _entity_cache_rows(realm_id: str, entity: str, items) -> list[tuple]:
+    return [(realm_id, entity, it["id"], it.get("name") or "", it.get("type"), it.get("subtype")) for it in items]
+
+
+def replace_entity_cache(realm_id: str, entity: str, items: list[dict], synced_at):
+    """
+    items: [{id, name, type?, subtype?}, ...] (mismo formato que get_customers / get_accounts)
+    """
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM qbo_entity_cache WHERE realm_id=%s AND entity=%s;", (realm_id, entity))
+            cur.executemany(_UPSERT_ENTITY_SQL, _entity_cache_rows(realm_id, entity, items))
+            _set_sync_watermark(cur, realm_id, entity, synced_at)
+        conn.commit()
+
+
+def apply_entity_changes(realm_id: str, entity: str, upserts: list[dict], deleted_ids: list[str], synced_at):
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            if upserts:
+                cur.executemany(_UPSERT_ENTITY_SQL, _entity_cache_rows(realm_id, entity, upserts))
+            if deleted_ids:
+                cur.execute("DELETE FROM qbo_entity_cache WHERE realm_id=%s AND entity=%s AND entity_id = ANY(%s);",
+                            (realm_id, entity, list(deleted_ids)))
+            _set_sync_watermark(cur, realm_id, entity, synced_at)
+        conn.commit()
+
+
+def list_cached_entities(realm_id: str, entity: str) -> list[dict]:
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+            SELECT entity_id AS id, name, type, subtype
+            FROM qbo_entity_cache
+            WHERE realm_id=%s AND entity=%s
+            ORDER BY lower(name), entity_id;
+            """, (realm_id, entity))
+            return cur.fetchall()
+
+
+# -------------------------
+# ✅ Cola de eventos de cache (webhooks)
+# -------------------------
+CACHE_EVENTS_RETENTION = os.environ.get("CACHE_EVENTS_RETENTION", "1 day")
+
+
+def clear_sync_dirty(realm_id: str, entities, started_at):
+    """
+    Limpia el dirty de las entidades sincronizadas, salvo que el webhook llegara después de
+    started_at (ese cambio pudo no entrar en el sync que acaba de terminar).
+    """
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+            UPDATE qbo_sync_state SET dirty_at=NULL
+            WHERE realm_id=%s AND entity = ANY(%s) AND dirty_at <= %s;
+            """, (realm_id, list(entities), started_at))
+        conn.commit()
+
+
+def enqueue_cache_events(events: list[dict]) -> int:
+    """
+    Guarda eventos [{realm_id, entity, entity_id, operation}, ...] y marca como "dirty" las
+    entidades sincronizadas afectadas, todo en una transacción. Retorna cuántos guardó.
+    """
+    if not events:
+        return 0
+    received_at = datetime.now(timezone.utc)
+    rows = [(e["realm_id"], e["entity"], e.get("entity_id") or "", e.get("operation") or "") for e in events]
+    pairs = [(received_at, realm_id, entity) for realm_id, entity in sorted({(e["realm_id"], e["entity"]) for e in events})]
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.executemany("""
+            INSERT INTO qbo_cache_events (realm_id, entity, entity_id, operation)
+            VALUES (%s, %s, %s, %s);
+            """, rows)
+            cur.executemany("""
+            UPDATE qbo_sync_state SET dirty_at=%s WHERE realm_id=%s AND entity=%s;
+            """, pairs)
+            cur.execute("DELETE FROM qbo_cache_events WHERE received_at < NOW() - %s::interval;",
+                        (CACHE_EVENTS_RETENTION,))
         conn.commit()
+    return len(rows)
+
 
-def get_tokens():
+def get_last_cache_event_id() -> int:
     with _conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM qbo_tokens WHERE id=1;")
-            return cur.fetchone()
+            cur.execute("SELECT COALESCE(MAX(id), 0) AS id FROM qbo_cache_events;")
+            return cur.fetchone()["id"]
+
 
-def is_access_token_valid(access_expires_at, skew_seconds=60) -> bool:
+def get_cache_events_after(after_id: int, limit: int = 500) -> list[dict]:
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+            SELECT id, realm_id, entity, entity_id, operation
+            FROM qbo_cache_events WHERE id > %s ORDER BY id LIMIT %s;
+            """, (after_id, limit))
+            return cur.fetchall()
+
+
+# -------------------------
+# ✅ Cache de reportes (qbo_report_cache)
+# -------------------------
+def get_cached_report_body(cache_key: str, newer_than=None):
+    """
+    Retorna (body_gzip, expires_at) si existe y no venció (y, con newer_than, si se guardó
+    después de ese momento); si no, None.
+    """
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+            SELECT body, expires_at FROM qbo_report_cache
+            WHERE cache_key=%s AND expires_at > NOW()
+              AND (%s::timestamptz IS NULL OR created_at >= %s::timestamptz);
+            """, (cache_key, newer_than, newer_than))
+            row = cur.fetchone()
+    return (bytes(row["body"]), row["expires_at"]) if row else None
+
+
+def put_cached_report_body(cache_key: str, realm_id: str, report_name: str, body_gzip: bytes, expires_at):
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+            INSERT INTO qbo_report_cache (cache_key, realm_id, report_name, body, expires_at)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (cache_key) DO UPDATE SET
+              body=EXCLUDED.body,
+              created_at=NOW(),
+              expires_at=EXCLUDED.expires_at;
+            """, (cache_key, realm_id, report_name, body_gzip, expires_at))
+            cur.execute("DELETE FROM qbo_report_cache WHERE expires_at <= NOW();")
+        conn.commit()
+
+
+def delete_cached_reports(realm_id: str) -> int:
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM qbo_report_cache WHERE realm_id=%s;", (realm_id,))
+            deleted = cur.rowcount
+        conn.commit()
+    return deleted
+
+
+# -------------------------
+# ✅ Snapshots de reportes (qbo_report_snapshots)
+# -------------------------
+def save_report_snapshot(snapshot_id: str, realm_id: str | None, report_type: str, payload: bytes, expires_at):
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+            INSERT INTO qbo_report_snapshots (snapshot_id, realm_id, report_type, payload, expires_at)
+            VALUES (%s, %s, %s, %s, %s);
+            """, (snapshot_id, realm_id, report_type, payload, expires_at))
+            cur.execute("DELETE FROM qbo_report_snapshots WHERE expires_at <= NOW();")
+        conn.commit()
+
+
+def get_report_snapshot_payload(snapshot_id: str) -> bytes | None:
+    with _conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+            SELECT payload FROM qbo_report_snapshots
+            WHERE snapshot_id=%s AND expires_at > NOW();
+            """, (snapshot_id,))
+            row = cur.fetchone()
+    return bytes(row["payload"]) if row else None
+
+
+def is_access_token_valid(access_expires_at, skew_seconds=TOKEN_SKEW_SECONDS) -> bool:
     if not access_expires_at:
         return False
     now = datetime.now(timezone.utc)
     return (access_expires_at - now).total_seconds() > skew_seconds
-
@@ -0,0 +1,94 @@
+"""
+Simulador local de webhooks de QuickBooks: arma un payload como los de Intuit, lo firma
+(intuit-signature) con QBO_WEBHOOK_VERIFIER_TOKEN y lo envía a /webhooks/qbo.
+
+Ejemplos:
+  python webhook_simulator.py --realm 9130350 Vendor:58:Update
+  python webhook_simulator.py --realm 9130350 --format cloudevents Customer:12:Create Bill:301:Delete
+  python webhook_simulator.py --bad-signature Vendor:1:Update      (debe responder 401)
+"""
+import os
+import sys
+import json
+import hmac
+import base64
+import hashlib
+import argparse
+import uuid
+from datetime import datetime, timezone
+
+import requests
+
+from cache_invalidation import CLOUDEVENT_OPERATIONS
+
+
+def sign(body: bytes, verifier_token: str) -> str:
+    return base64.b64encode(hmac.new(verifier_token.encode("utf-8"), body, hashlib.sha256).digest()).decode()
+
+
+def build_payload(realm_id: str, changes: list[tuple[str, str, str]], fmt: str = "classic"):
+    now = datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+    if fmt == "cloudevents":
+        return [
+            {
+                "specversion": "1.0",
+                "id": str(uuid.uuid4()),
+                "source": "intuit.simulator",
+                "type": f"qbo.{entity.lower()}.{CLOUDEVENT_OPERATIONS.get(operation, operation.lower())}.v1",
+                "datacontenttype": "application/json",
+                "time": now,
+                "intuitentityid": entity_id,
+                "intuitaccountid": realm_id,
+                "data": {},
+            }
+            for entity, entity_id, operation in changes
+        ]
+
+    return {
+        "eventNotifications": [{
+            "realmId": realm_id,
+            "dataChangeEvent": {
+                "entities": [
+                    {"name": entity, "id": entity_id, "operation": operation, "lastUpdated": now}
+                    for entity, entity_id, operation in changes
+                ]
+            },
+        }]
+    }
+
+
+def parse_change(s: str) -> tuple[str, str, str]:
+    parts = s.split(":")
+    if len(parts) != 3:
+        raise argparse.ArgumentTypeError(f"Formato esperado Entidad:Id:Operacion, recibido: {s}")
+    return parts[0], parts[1], parts[2]
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Envía webhooks firmados de QBO al portal local.")
+    ap.add_argument("changes", nargs="+", type=parse_change, help="Entidad:Id:Operacion (p.ej. Vendor:58:Update)")
+    ap.add_argument("--url", default=os.environ.get("WEBHOOK_URL", "http://127.0.0.1:5000/webhooks/qbo"))
+    ap.add_argument("--realm", default=os.environ.get("QBO_DEFAULT_REALM_ID", "0"))
+    ap.add_argument("--format", choices=("classic", "cloudevents"), default="classic")
+    ap.add_argument("--token", default=os.environ.get("QBO_WEBHOOK_VERIFIER_TOKEN", ""))
+    ap.add_argument("--bad-signature", action="store_true", help="firma inválida (prueba de rechazo)")
+    args = ap.parse_args(argv)
+
+    if not args.token and not args.bad_signature:
+        print("Falta QBO_WEBHOOK_VERIFIER_TOKEN (o --token).")
+        return 2
+
+    body = json.dumps(build_payload(args.realm, args.changes, args.format)).encode("utf-8")
+    signature = "invalid" if args.bad_signature else sign(body, args.token)
+
+    r = requests.post(args.url, data=body, headers={
+        "Content-Type": "application/json",
+        "intuit-signature": signature,
+    }, timeout=10)
+    print("WEBHOOK SIMULATOR ->", r.status_code, args.url, len(args.changes), "eventos")
+    return 0 if r.ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())